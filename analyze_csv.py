@@ -1,15 +1,243 @@
-import sys
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from itertools import repeat
 
-import matplotlib.pyplot as plt
 import numpy as np
+from config import load_config, pump_channel
+from run_features import run_features
+from run_file import (
+    RUN_FILE_EXTENSION,
+    RUN_TIME_FORMAT,
+    load_csv_run,
+    parse_stem,
+    read_run,
+)
 
-file = sys.argv[1]
-print(file)
+# python3 analyze_csv.py <file>       plots one .run or CSV file
+# python3 analyze_csv.py <directory>  summarizes every run in it
+#
+# Batch mode finds the .run files (and RAW_ CSV runs without one), reads
+# them memory mapped in a process pool and writes one row per run to a CSV
+# summary: duration, gallons, mean and peak amps, inrush peak, settling time
+# and sample interval jitter (run_features.py). --plots also saves the
+# features over time and their distributions as PNGs. Runs recorded with an
+# idle rate and first seen at it have inrush_sampled False: no inrush peak
+# and usually only the steady amps as their peak.
 
-plot = np.loadtxt(file, delimiter=",", unpack=True)
+SUMMARY_COLUMNS = (
+    "run_id",
+    "start",
+    "channel",
+    "name",
+    "samples",
+    "sample_rate_hz",
+    "seconds",
+    "gallons",
+    "mean_amps",
+    "peak_amps",
+    "inrush_peak_amps",
+    "inrush_sampled",
+    "steady_amps",
+    "settling_seconds",
+    "interval_mean_ns",
+    "interval_std_ns",
+    "interval_max_ns",
+)
+PLOTTED_COLUMNS = (
+    ("seconds", "Seconds"),
+    ("gallons", "Gallons"),
+    ("mean_amps", "Mean amps"),
+    ("inrush_peak_amps", "Inrush peak amps"),
+    ("settling_seconds", "Settling seconds"),
+    ("interval_std_ns", "Interval jitter (ns)"),
+)
 
-fig = plt.figure(figsize=(4, 2))
-plt.scatter(range(0, len(plot)), plot, marker="o", s=(72. / fig.dpi)**2)
-plt.ylabel("Amps")
-plt.xlabel("Samples")
-plt.show()
+
+def plot_file(file):
+    import matplotlib.pyplot as plt
+    from waveform import run_waveform
+
+    print(file)
+
+    fig = plt.figure(figsize=(4, 2))
+    if file.endswith(RUN_FILE_EXTENSION):
+        # Only as many points as the figure is wide, from the run's pyramid
+        max_points = int(fig.get_figwidth() * fig.dpi) * 2
+        header, samples, times, plot = run_waveform(file, max_points)
+        print(
+            "{} run of {} @ {:.1f} hz, {} samples".format(
+                header["name"],
+                header["start"],
+                header["sample_rate_hz"],
+                header["samples"],
+            )
+        )
+    else:
+        plot = np.loadtxt(file, delimiter=",", unpack=True)
+        samples = range(0, len(plot))
+
+    plt.scatter(samples, plot, marker="o", s=(72.0 / fig.dpi) ** 2)
+    plt.ylabel("Amps")
+    plt.xlabel("Samples")
+    plt.show()
+
+
+def run_stems(directory):
+    # {stem: path}, the .run file where a run has both
+    stems = {}
+    for path in glob.glob(os.path.join(directory, "RAW_*.csv")):
+        stems[os.path.basename(path)[len("RAW_") : -len(".csv")]] = path
+    for path in glob.glob(os.path.join(directory, "*" + RUN_FILE_EXTENSION)):
+        stems[os.path.basename(path)[: -len(RUN_FILE_EXTENSION)]] = path
+    return stems
+
+
+def runs_between(directory, start=None, end=None):
+    # [(start, stem, path)] in time order, start <= day < end
+    runs = []
+    for stem, path in run_stems(directory).items():
+        try:
+            run_start = parse_stem(stem)[1]
+        except ValueError:
+            print("Skipping {}: can't tell when it ran".format(path))
+            continue
+        if start is not None and run_start.date() < start:
+            continue
+        if end is not None and run_start.date() >= end:
+            continue
+        runs.append((run_start, stem, path))
+    runs.sort()
+    return runs
+
+
+def summarize_run(path, pump):
+    # One summary row, or None if the run can't be read
+    try:
+        if path.endswith(RUN_FILE_EXTENSION):
+            stem = os.path.basename(path)[: -len(RUN_FILE_EXTENSION)]
+            header, raw_volts, times = read_run(path)
+        else:
+            stem = os.path.basename(path)[len("RAW_") : -len(".csv")]
+            header, raw_volts, times = load_csv_run(os.path.dirname(path), stem)
+    except (OSError, ValueError) as e:
+        print("Skipping {}: {}".format(path, e))
+        return None
+
+    seconds = (header["end_ns"] - header["start_ns"]) / 1_000_000_000
+    row = {
+        "run_id": stem,
+        "start": datetime.strptime(header["start"], RUN_TIME_FORMAT).isoformat(),
+        "channel": header["channel"],
+        "name": header["name"],
+        "samples": header["samples"],
+        "sample_rate_hz": header["sample_rate_hz"],
+        "seconds": seconds,
+    }
+    if header["channel"] == pump.number:
+        row["gallons"] = pump.pumped_gallons(seconds)
+    row.update(
+        run_features(
+            raw_volts * header["conversion_factor"],
+            times,
+            header.get("sample_rates"),
+        )
+    )
+    return row
+
+
+def write_summary(path, rows):
+    with open(path, "w", newline="") as summary_file:
+        writer = csv.DictWriter(summary_file, SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def plot_summary(rows, plots_dir):
+    from plotting import pyplot
+
+    plt = pyplot()
+    starts = np.array([np.datetime64(row["start"]) for row in rows])
+    figure, axes = plt.subplots(len(PLOTTED_COLUMNS), 1, figsize=(10, 14), sharex=True)
+    for axis, (column, label) in zip(axes, PLOTTED_COLUMNS):
+        values = np.array([row.get(column, np.nan) for row in rows], dtype=float)
+        axis.scatter(starts, values, marker=".", s=4)
+        axis.set_ylabel(label)
+    axes[0].set_title("{} runs".format(len(rows)))
+    figure.autofmt_xdate()
+    figure.savefig(os.path.join(plots_dir, "RunFeatures.png"))
+    plt.close(figure)
+
+    figure, axes = plt.subplots(2, len(PLOTTED_COLUMNS) // 2, figsize=(12, 6))
+    for axis, (column, label) in zip(axes.ravel(), PLOTTED_COLUMNS):
+        values = np.array([row.get(column, np.nan) for row in rows], dtype=float)
+        axis.hist(values[np.isfinite(values)], bins=40)
+        axis.set_xlabel(label)
+    figure.tight_layout()
+    figure.savefig(os.path.join(plots_dir, "RunFeatureHistograms.png"))
+    plt.close(figure)
+
+
+def summarize_directory(directory, output, start, end, plots_dir, workers, pump):
+    runs = runs_between(directory, start, end)
+    paths = [path for run_start, stem, path in runs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = [
+            row
+            for row in executor.map(summarize_run, paths, repeat(pump), chunksize=8)
+            if row is not None
+        ]
+    write_summary(output, rows)
+    print("Summarized {} of {} run(s) into {}".format(len(rows), len(runs), output))
+    unsampled = sum(1 for row in rows if row.get("inrush_sampled") is False)
+    if unsampled:
+        print(
+            "{} run(s) were first seen at the idle rate, their inrush wasn't sampled and their peak amps may be the steady draw's".format(
+                unsampled
+            )
+        )
+    if plots_dir and rows:
+        plot_summary(rows, plots_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Plot one run, or summarize every run in a directory"
+    )
+    parser.add_argument("path", help="A .run/CSV file, or a directory of runs")
+    parser.add_argument("--start", help="First day to summarize, YYYY-MM-DD")
+    parser.add_argument("--end", help="Day after the last one, YYYY-MM-DD")
+    parser.add_argument(
+        "--output", default="run_summary.csv", help="Summary CSV to write"
+    )
+    parser.add_argument("--plots", help="Directory to save the aggregate plots in")
+    parser.add_argument("--workers", type=int, help="Worker processes")
+    parser.add_argument("--config", help="Settings file with the pump's numbers")
+    parser.add_argument(
+        "--pump-gallons-per-minute", type=float, help="Overrides the config"
+    )
+    parser.add_argument("--transport-volume", type=float, help="Overrides the config")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.pump_gallons_per_minute is not None:
+        config["pump"]["gallons_per_minute"] = args.pump_gallons_per_minute
+    if args.transport_volume is not None:
+        config["pump"]["transport_volume"] = args.transport_volume
+
+    if not os.path.isdir(args.path):
+        plot_file(args.path)
+    else:
+        pump = pump_channel(config)
+        summarize_directory(
+            args.path,
+            args.output,
+            date.fromisoformat(args.start) if args.start else None,
+            date.fromisoformat(args.end) if args.end else None,
+            args.plots,
+            args.workers,
+            pump,
+        )
@@ -0,0 +1,167 @@
+import math
+import os
+import threading
+import time
+
+import numpy as np
+from channels import NUMBER_OF_CHANNELS
+
+# Acquisition backends. Each one answers read_channel(channel) with one voltage
+# and read_all() with the voltages of all eight inputs, like the DAQC2 does.
+
+# Every plate hangs off the same SPI bus and piplates isn't thread safe, so
+# plates sampled from different threads take turns reading
+SPI_LOCK = threading.Lock()
+
+
+class Daqc2Backend:
+    def __init__(self, address=0):
+        # Only imported here so everything else runs without a Pi
+        import piplates.DAQC2plate as das
+
+        self.das = das
+        self.address = address
+
+    def read_channel(self, channel):
+        with SPI_LOCK:
+            return self.das.getADC(self.address, channel)
+
+    def read_all(self):
+        with SPI_LOCK:
+            return self.das.getADCall(self.address)
+
+
+def load_recorded_run(path):
+    # (raw volts, nanosecond offsets from the first sample) from a .run file
+    # or from RAW_<ts>.csv with its NS_<ts>.csv next to it
+    if path.endswith(".run"):
+        from run_file import read_run
+
+        header, raw_volts, times = read_run(path)
+        raw_volts = np.array(raw_volts, dtype=np.float32)
+        times = np.array(times, dtype=np.int64)
+        rate_hz = header["sample_rate_hz"]
+    else:
+        directory, name = os.path.split(path)
+        if name.startswith("RAW_"):
+            name = name[len("RAW_") :]
+        raw_volts = np.loadtxt(
+            os.path.join(directory, "RAW_{}".format(name)), delimiter=",", ndmin=1
+        ).astype(np.float32)
+        ns_path = os.path.join(directory, "NS_{}".format(name))
+        rate_hz = 120
+        if os.path.exists(ns_path):
+            times = np.loadtxt(ns_path, delimiter=",", ndmin=1).astype(np.int64)
+        else:
+            times = np.arange(len(raw_volts), dtype=np.int64) * (
+                1_000_000_000 // rate_hz
+            )
+    if len(times) == 0:
+        raise ValueError("{} has no samples".format(path))
+    return raw_volts, times - times[0], rate_hz
+
+
+class ReplayBackend:
+    # Plays a recorded run back in real time, or speed times faster. The run is
+    # framed by idle_seconds of 0V on both sides and repeats when loop is set.
+    def __init__(self, path, channel=0, speed=1.0, idle_seconds=2.0, loop=True):
+        self.raw_volts, self.offsets, self.rate_hz = load_recorded_run(path)
+        self.channel = channel
+        self.speed = speed
+        self.idle_ns = int(idle_seconds * 1_000_000_000)
+        self.loop = loop
+        self.cycle_ns = self.offsets[-1] + 2 * self.idle_ns
+        self.started_ns = None
+
+    def recorded_ns(self):
+        now = time.monotonic_ns()
+        if self.started_ns is None:
+            self.started_ns = now
+        elapsed = int((now - self.started_ns) * self.speed)
+        if self.loop:
+            elapsed %= self.cycle_ns
+        return elapsed - self.idle_ns
+
+    def replayed_volts(self):
+        offset = self.recorded_ns()
+        if offset < 0 or offset > self.offsets[-1]:
+            return 0.0
+        index = np.searchsorted(self.offsets, offset, side="right") - 1
+        return float(self.raw_volts[index])
+
+    def read_channel(self, channel):
+        if channel != self.channel:
+            return 0.0
+        return self.replayed_volts()
+
+    def read_all(self):
+        values = [0.0] * NUMBER_OF_CHANNELS
+        values[self.channel] = self.replayed_volts()
+        return values
+
+
+class PumpProfile:
+    # Defaults follow the dosing pump: ~3 minute doses at 11.3A that start
+    # with a ~38A inrush, read through the 5A/V current sensor
+    def __init__(
+        self,
+        on_seconds=185.0,
+        off_seconds=60.0,
+        steady_volts=2.25,
+        inrush_volts=5.5,
+        inrush_seconds=0.05,
+        noise_volts=0.01,
+        phase_seconds=0.0,
+    ):
+        self.on_seconds = on_seconds
+        self.off_seconds = off_seconds
+        self.steady_volts = steady_volts
+        self.inrush_volts = inrush_volts
+        self.inrush_seconds = inrush_seconds
+        self.noise_volts = noise_volts
+        self.phase_seconds = phase_seconds
+
+    def volts(self, seconds, noise):
+        position = (seconds + self.phase_seconds) % (self.on_seconds + self.off_seconds)
+        if position >= self.on_seconds:
+            # Idle noise stays well under the 0.1V run threshold
+            return abs(noise) * self.noise_volts
+        inrush = self.inrush_volts * math.exp(-position / self.inrush_seconds)
+        return max(self.steady_volts + inrush + noise * self.noise_volts, 0.0)
+
+
+class SyntheticBackend:
+    # Generates pump runs from PumpProfiles keyed by channel, speed times faster
+    # than real time, so the loop can be pushed far past 120 Hz on any box.
+    def __init__(self, profiles=None, speed=1.0, seed=0):
+        if profiles is None:
+            profiles = {0: PumpProfile()}
+        self.profiles = profiles
+        self.speed = speed
+        # Noise is drawn in blocks, one random call per sample would dominate
+        self.noise = np.random.default_rng(seed).standard_normal(8192).tolist()
+        self.noise_index = 0
+        self.started_ns = None
+
+    def seconds(self):
+        now = time.monotonic_ns()
+        if self.started_ns is None:
+            self.started_ns = now
+        return (now - self.started_ns) * self.speed / 1_000_000_000
+
+    def next_noise(self):
+        self.noise_index = (self.noise_index + 1) % len(self.noise)
+        return self.noise[self.noise_index]
+
+    def read_channel(self, channel):
+        profile = self.profiles.get(channel)
+        if profile is None:
+            return 0.0
+        return profile.volts(self.seconds(), self.next_noise())
+
+    def read_all(self):
+        seconds = self.seconds()
+        values = [0.0] * NUMBER_OF_CHANNELS
+        for channel, profile in self.profiles.items():
+            values[channel] = profile.volts(seconds, self.next_noise())
+        return values
@@ -0,0 +1,438 @@
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+
+import numpy as np
+from config import load_config, pump_channel
+from database import connect
+from run_file import RUN_TIME_FORMAT, load_csv_run, read_run, run_file_path
+from run_summaries import init_run_summary_table, insert_run_summaries
+from sample_writer import SampleWriter
+from waveform import add_to_septic_data_minmax
+from water_usage import init_water_usage_tables, rebuild_rollups
+
+# Loads history from home_das.log (and its rotated copies) into the database:
+# a RUN_SUMMARIES row per run, a WATER_USAGE_DATA row for every pump run that
+# isn't there yet, and with --samples the run's samples into SEPTIC_data.
+#
+# The log has had a few formats over the years:
+#
+#   20200709-13:35:44: Septic pump ran for 25.9 seconds with a max amperage
+#       of 21.5A and an average amperage of 11.1A
+#   ...: Septic pump ran for 184.8 seconds with a max amperage of 21.6A, an
+#       average amperage of 11.2A, and an average wattage of 1346.5W
+#   ...: Dosing pump ran for 176.65 seconds, pumped 115.27 gallons with ...
+#   {"time": ..., "event": "run", "run_id": ..., "seconds": ...}   (JSON)
+#
+# each followed by "The average time between samples is: ..." and
+# "Parsing, Logging, ... took N ms" lines for the same run. Some 2020 runs
+# wrote their time day first (20201309-...), those are read whichever way
+# lands closest to the startup/shutdown lines and unambiguous runs around
+# them. Runs logged without gallons get them from the pump constants.
+#
+# Log files are parsed in a process pool, one file per worker, and so are
+# the run files when loading samples. Everything is keyed so importing twice
+# changes nothing: summaries by run id (rows the DAQ wrote are kept), water
+# usage by start time (within MATCH_SECONDS of an existing row), samples by
+# whether SEPTIC_data already has any for the run's channel and time span.
+
+SWAPPED_RUN_TIME_FORMAT = "%Y%d%m-%H:%M:%S"
+ANCHOR_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+MATCH_SECONDS = 2.0
+
+NUMBER = r"[-+.\w]+"
+RUN_LINE = re.compile(
+    r"^(?P<stamp>\d{{8}}-\d{{2}}:\d{{2}}:\d{{2}}): (?P<name>.+?) ran for (?P<seconds>{0}) seconds(?:, pumped (?P<gallons>{0}) gallons)? with a max amperage of (?P<max_amps>{0})A(?:,| and) an average amperage of (?P<average_amps>{0})A".format(
+        NUMBER
+    )
+)
+TIMING_LINE = re.compile(
+    r"^The average time between samples is: (?P<mean>{0})ns, std dev is: (?P<std>{0})ns".format(
+        NUMBER
+    )
+)
+PROCESSING_LINE = re.compile(r"^Parsing, Logging, .*took (?P<ms>{0}) ms".format(NUMBER))
+# "Amperage conversion factor is: ..." from main.py and the first main2.py,
+# "Channel <n> (<name>) amperage conversion factor is: ..." since channels
+FACTOR_LINE = re.compile(
+    r"^(?:Channel (?P<channel>\d+) \(.*\) a|A)mperage conversion factor is: (?P<factor>{0})".format(
+        NUMBER
+    )
+)
+ANCHOR_LINE = re.compile(
+    r"^(?:Startup|Graceful Shutdown) @ (?P<when>\w+ \w+ +\d+ [\d:]+ \d+)"
+)
+
+
+def log_files(base_dir):
+    # Oldest first: home_das.log.10, ..., home_das.log.1, home_das.log
+    paths = glob.glob(os.path.join(base_dir, "home_das.log.*"))
+    paths = [path for path in paths if path.rsplit(".", 1)[1].isdigit()]
+    paths.sort(key=lambda path: -int(path.rsplit(".", 1)[1]))
+    current = os.path.join(base_dir, "home_das.log")
+    if os.path.exists(current):
+        paths.append(current)
+    return paths
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def stamp_candidates(stamp):
+    candidates = []
+    for time_format in (RUN_TIME_FORMAT, SWAPPED_RUN_TIME_FORMAT):
+        try:
+            candidate = datetime.strptime(stamp, time_format)
+        except ValueError:
+            continue
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+
+def resolve_starts(entries, anchors):
+    # entries are [(position, candidates, summary)], anchors [(position, time)]
+    # in file order. Ambiguous starts take the candidate closest to the
+    # nearest anchor before or after them.
+    anchors = anchors + [
+        (position, candidates[0])
+        for position, candidates, summary in entries
+        if len(candidates) == 1
+    ]
+    anchors.sort(key=lambda anchor: anchor[0])
+    positions = [anchor[0] for anchor in anchors]
+    for position, candidates, summary in entries:
+        if len(candidates) == 1 or not anchors:
+            summary["start"] = candidates[0]
+            continue
+        index = np.searchsorted(positions, position)
+        near = [anchors[i][1] for i in (index - 1, index) if 0 <= i < len(anchors)]
+        summary["start"] = min(
+            candidates,
+            key=lambda candidate: min(
+                abs((candidate - anchor).total_seconds()) for anchor in near
+            ),
+        )
+
+
+def parse_log_file(path, pump):
+    # [summary dicts] for every run logged in path
+    summaries = {}
+    entries = []
+    anchors = []
+    # channel -> the last conversion factor logged for it
+    conversion_factors = {}
+    last_run = None
+    with open(path, "r", encoding="utf-8", errors="replace") as log_file:
+        for position, line in enumerate(log_file):
+            line = line.replace("\0", "").strip()
+            fields = {}
+            if line.startswith("{"):
+                try:
+                    fields = json.loads(line)
+                except ValueError:
+                    continue
+                line = fields.get("message", "")
+                if "time" in fields:
+                    anchors.append((position, datetime.fromisoformat(fields["time"])))
+
+            event = fields.get("event")
+            run = summaries.get(fields.get("run_id"), last_run)
+            if event == "run":
+                last_run = summaries[fields["run_id"]] = {
+                    "run_id": fields["run_id"],
+                    "start": datetime.fromisoformat(fields["start"]),
+                    "channel": fields.get("channel", 0),
+                    "name": fields.get("name"),
+                    "seconds": fields.get("seconds"),
+                    "samples": fields.get("samples"),
+                    "gallons_pumped": fields.get("gallons"),
+                    "max_amperage": fields.get("max_amps"),
+                    "average_amperage": fields.get("average_amps"),
+                    "conversion_factor": conversion_factors.get(
+                        fields.get("channel", 0)
+                    ),
+                }
+                continue
+            if event == "sample_timing" and run is not None:
+                run["interval_mean_ns"] = to_float(fields.get("interval_mean_ns"))
+                run["interval_std_ns"] = to_float(fields.get("interval_std_ns"))
+                continue
+            if event == "processing" and run is not None:
+                run["processing_ms"] = to_float(fields.get("processing_ms"))
+                continue
+
+            match = RUN_LINE.match(line)
+            if match:
+                seconds = to_float(match.group("seconds"))
+                candidates = stamp_candidates(match.group("stamp"))
+                if seconds is None or not candidates:
+                    continue
+                gallons = to_float(match.group("gallons"))
+                if gallons is None:
+                    gallons = pump.pumped_gallons(seconds)
+                last_run = summaries[match.group("stamp")] = {
+                    "run_id": match.group("stamp"),
+                    "channel": pump.number,
+                    "name": match.group("name"),
+                    "seconds": seconds,
+                    "gallons_pumped": gallons,
+                    "max_amperage": to_float(match.group("max_amps")),
+                    "average_amperage": to_float(match.group("average_amps")),
+                    "conversion_factor": conversion_factors.get(pump.number),
+                }
+                entries.append((position, candidates, last_run))
+                continue
+            match = TIMING_LINE.match(line)
+            if match and last_run is not None:
+                last_run["interval_mean_ns"] = to_float(match.group("mean"))
+                last_run["interval_std_ns"] = to_float(match.group("std"))
+                continue
+            match = PROCESSING_LINE.match(line)
+            if match and last_run is not None:
+                last_run["processing_ms"] = to_float(match.group("ms"))
+                continue
+            match = FACTOR_LINE.match(line)
+            if match:
+                channel = match.group("channel")
+                channel = pump.number if channel is None else int(channel)
+                conversion_factors[channel] = to_float(match.group("factor"))
+                continue
+            match = ANCHOR_LINE.match(line)
+            if match and not fields:
+                try:
+                    anchor = datetime.strptime(match.group("when"), ANCHOR_TIME_FORMAT)
+                except ValueError:
+                    continue
+                anchors.append((position, anchor))
+    resolve_starts(entries, anchors)
+    return list(summaries.values())
+
+
+def find_run_file(base_dir, run_id):
+    # The binary run file if there is one, otherwise the CSV files'
+    if os.path.exists(run_file_path(base_dir, run_id)):
+        return os.path.basename(run_file_path(base_dir, run_id))
+    for name in ("RAW_{}.csv", "{}.csv"):
+        if os.path.exists(os.path.join(base_dir, name.format(run_id))):
+            return name.format(run_id)
+    return None
+
+
+def local_timestamps(times):
+    # SEPTIC_data timestamps, local time like datetime.fromtimestamp() gives
+    if len(times) == 0:
+        return np.zeros(0, dtype=str)
+    offset = time.localtime(times[0] / 1_000_000_000).tm_gmtoff
+    local = (np.asarray(times, dtype=np.int64) + offset * 1_000_000_000).astype(
+        "datetime64[ns]"
+    )
+    return np.char.replace(
+        np.datetime_as_string(local.astype("datetime64[us]")), "T", " "
+    )
+
+
+def load_samples(base_dir, summary):
+    # (channel, timestamps, raw volts, amps, times) of one run, or None
+    try:
+        if summary["run_file"].endswith(".csv"):
+            header, raw_volts, times = load_csv_run(
+                base_dir,
+                summary["run_id"],
+                start=summary["start"] if summary["channel"] == 0 else None,
+                default_conversion_factor=summary["conversion_factor"] or 5.0,
+            )
+        else:
+            header, raw_volts, times = read_run(
+                os.path.join(base_dir, summary["run_file"])
+            )
+    except (OSError, ValueError) as e:
+        print("Skipping samples of {}: {}".format(summary["run_id"], e))
+        return None
+    raw_volts = np.asarray(raw_volts, dtype=float)
+    times = np.asarray(times, dtype=np.int64)
+    amps = raw_volts * header["conversion_factor"]
+    return summary["channel"], local_timestamps(times), raw_volts, amps, times
+
+
+def has_samples(connection, summary):
+    end = datetime.fromtimestamp(summary["start"].timestamp() + summary["seconds"])
+    return (
+        connection.execute(
+            "SELECT 1 FROM SEPTIC_data WHERE timestamp >= ? AND timestamp <= ? AND channel = ? LIMIT 1",
+            (summary["start"], end, summary["channel"]),
+        ).fetchone()
+        is not None
+    )
+
+
+def write_samples(connection, loaded):
+    with connection:
+        cursor = connection.cursor()
+        for channel, timestamps, raw_volts, amps, times in loaded:
+            cursor.executemany(
+                "INSERT INTO SEPTIC_data(timestamp, raw_sensor_voltage, amperage, channel) VALUES(?, ?, ?, ?)",
+                zip(
+                    timestamps.tolist(),
+                    raw_volts.tolist(),
+                    amps.tolist(),
+                    repeat(channel),
+                ),
+            )
+            add_to_septic_data_minmax(cursor, channel, times, amps)
+
+
+def new_water_usage(connection, summaries):
+    # [(start, gallons)] of pump runs WATER_USAGE_DATA doesn't have yet
+    existing = np.sort(
+        np.array(
+            [
+                datetime.fromisoformat(str(row[0])).timestamp()
+                for row in connection.execute("SELECT timestamp FROM WATER_USAGE_DATA")
+            ],
+            dtype=float,
+        )
+    )
+    rows = []
+    for summary in summaries:
+        if summary["gallons_pumped"] is None:
+            continue
+        start_s = summary["start"].timestamp()
+        index = np.searchsorted(existing, start_s)
+        nearest = existing[max(index - 1, 0) : index + 1]
+        if len(nearest) and np.abs(nearest - start_s).min() <= MATCH_SECONDS:
+            continue
+        rows.append((summary["start"], summary["gallons_pumped"]))
+    return rows
+
+
+def backfill(
+    base_dir, db_file, paths, pump, samples=False, workers=None, batch_rows=500_000
+):
+    backfill_start = time.monotonic()
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, parsed in zip(
+            paths, executor.map(parse_log_file, paths, repeat(pump))
+        ):
+            print("{}: {} run(s)".format(path, len(parsed)))
+            for summary in parsed:
+                summaries[summary["run_id"]] = summary
+        summaries = sorted(summaries.values(), key=lambda summary: summary["start"])
+        for summary in summaries:
+            summary["run_file"] = find_run_file(base_dir, summary["run_id"])
+
+        connection = connect(db_file)
+        init_water_usage_tables(connection)
+        init_run_summary_table(connection)
+        SampleWriter(db_file).init_table(connection)
+
+        water_usage = new_water_usage(connection, summaries)
+        with connection:
+            cursor = connection.cursor()
+            insert_run_summaries(cursor, summaries, replace=False)
+            cursor.executemany(
+                "INSERT INTO WATER_USAGE_DATA(timestamp, gallons_pumped) VALUES(?, ?)",
+                water_usage,
+            )
+        if water_usage:
+            rebuild_rollups(connection)
+        print(
+            "{} run summaries, {} new water usage row(s), {} run(s) with files".format(
+                len(summaries),
+                len(water_usage),
+                sum(summary["run_file"] is not None for summary in summaries),
+            )
+        )
+
+        if samples:
+            to_load = [
+                summary
+                for summary in summaries
+                if summary["run_file"] is not None
+                and not has_samples(connection, summary)
+            ]
+            pending = []
+            pending_rows = 0
+            loaded_rows = 0
+            for loaded in executor.map(
+                load_samples, repeat(base_dir), to_load, chunksize=4
+            ):
+                if loaded is None:
+                    continue
+                pending.append(loaded)
+                pending_rows += len(loaded[1])
+                if pending_rows >= batch_rows:
+                    write_samples(connection, pending)
+                    loaded_rows += pending_rows
+                    pending = []
+                    pending_rows = 0
+            write_samples(connection, pending)
+            loaded_rows += pending_rows
+            print(
+                "{} sample(s) from {} run(s) added to SEPTIC_data".format(
+                    loaded_rows, len(to_load)
+                )
+            )
+        connection.close()
+    print("Backfill took {:.2f} seconds".format(time.monotonic() - backfill_start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load run history from home_das.log and the run archive"
+    )
+    parser.add_argument(
+        "--base-dir",
+        help="Directory holding the logs and run files, base_dir from the config by default",
+    )
+    parser.add_argument(
+        "--db-file", help="Database to load into, home_das_db.db in --base-dir"
+    )
+    parser.add_argument(
+        "--log-file",
+        action="append",
+        help="Log file(s) to parse, home_das.log and its rotated copies by default",
+    )
+    parser.add_argument(
+        "--samples",
+        action="store_true",
+        help="Also load the samples of every run that has a run or CSV file",
+    )
+    parser.add_argument("--workers", type=int, help="Worker processes")
+    parser.add_argument(
+        "--config", help="Settings file with the data directory and pump's numbers"
+    )
+    parser.add_argument(
+        "--pump-gallons-per-minute", type=float, help="Overrides the config"
+    )
+    parser.add_argument("--transport-volume", type=float, help="Overrides the config")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.pump_gallons_per_minute is not None:
+        config["pump"]["gallons_per_minute"] = args.pump_gallons_per_minute
+    if args.transport_volume is not None:
+        config["pump"]["transport_volume"] = args.transport_volume
+
+    base_dir = args.base_dir or config["base_dir"]
+
+    pump = pump_channel(config)
+    backfill(
+        base_dir,
+        args.db_file or os.path.join(base_dir, "home_das_db.db"),
+        args.log_file or log_files(base_dir),
+        pump,
+        args.samples,
+        args.workers,
+    )
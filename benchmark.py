@@ -0,0 +1,352 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+from backends import PumpProfile, SyntheticBackend
+from config import DEFAULT_CONFIG
+from database import connect
+from main2 import DAQ, Run
+from plotting import render_run_plots
+from run_buffer import RunBuffer
+from run_stats import RunStats
+from water_usage import (
+    init_water_usage_tables,
+    insert_water_usage,
+    total_water_usage,
+    water_usage_between,
+)
+
+# Hardware-free benchmarks for the acquisition loop, run processing, the
+# water usage tables and per-run memory. Results are written as JSON so two
+# versions can be compared with --compare.
+
+LOOP_RATES_HZ = (120, 500, 1000, 2000)
+RUN_SECONDS = (30, 3 * 60, 60 * 60)
+WATER_USAGE_ROWS = (1_000, 10_000, 100_000)
+
+
+class TimedBackend:
+    # Records when every read happens, without disturbing the loop much
+    def __init__(self, backend, capacity):
+        self.backend = backend
+        self.read_times = np.zeros(capacity, dtype=np.int64)
+        self.read_ns = np.zeros(capacity, dtype=np.int64)
+        self.reads = 0
+
+    def record(self, started):
+        if self.reads < len(self.read_times):
+            self.read_times[self.reads] = started
+            self.read_ns[self.reads] = time.perf_counter_ns() - started
+        self.reads += 1
+
+    def read_channel(self, channel):
+        started = time.perf_counter_ns()
+        value = self.backend.read_channel(channel)
+        self.record(started)
+        return value
+
+    def read_all(self):
+        started = time.perf_counter_ns()
+        values = self.backend.read_all()
+        self.record(started)
+        return values
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return {}
+    return {
+        "mean": float(np.mean(values)),
+        "std": float(np.std(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(np.max(values)),
+    }
+
+
+def make_daq(base_dir, data_rate_hz, backend, scheduler="deadline"):
+    # The built in settings rather than whatever home_das.json is next to this
+    # file, so results only depend on the version
+    return DAQ(
+        data_rate_hz,
+        scheduler,
+        plots="off",
+        backend=backend,
+        base_dir=base_dir,
+        config=copy.deepcopy(DEFAULT_CONFIG),
+    )
+
+
+def bench_loop(base_dir, data_rate_hz, seconds, scheduler):
+    # A pump that runs half the time, so the loop records and hands off runs
+    profile = PumpProfile(on_seconds=seconds / 4, off_seconds=seconds / 4)
+    backend = TimedBackend(
+        SyntheticBackend({0: profile}), int(data_rate_hz * seconds * 1.5) + 16
+    )
+    daq = make_daq(base_dir, data_rate_hz, backend, scheduler)
+    loop = threading.Thread(target=daq.start_daq_loop)
+    cpu_start = time.process_time()
+    loop.start()
+    time.sleep(seconds)
+    daq.stop()
+    loop.join()
+    cpu_seconds = time.process_time() - cpu_start
+    daq.shutdown()
+
+    reads = min(backend.reads, len(backend.read_times))
+    intervals = np.diff(backend.read_times[:reads])
+    expected_ns = 1_000_000_000 / data_rate_hz
+    return {
+        "data_rate_hz": data_rate_hz,
+        "scheduler": scheduler,
+        "seconds": seconds,
+        "samples": int(backend.reads),
+        "achieved_hz": backend.reads / seconds,
+        "interval_ns": percentiles(intervals),
+        "interval_error_ns": percentiles(np.abs(intervals - expected_ns)),
+        "read_ns": percentiles(backend.read_ns[:reads]),
+        "missed_deadlines": daq.missed_deadlines(),
+        "cpu_percent": 100 * cpu_seconds / seconds,
+    }
+
+
+def synthetic_run(daq, seconds):
+    # Sized for the run, an hour is longer than the DAQ's own buffers hold
+    samples = int(seconds * daq.data_rate_hz)
+    buffer = RunBuffer(samples, 1)
+    buffer.retain()
+    rng = np.random.default_rng(0)
+    start_ns = time.time_ns()
+    for first in range(0, samples, 65536):
+        last = min(first + 65536, samples)
+        rows = np.arange(first, last)
+        buffer.values[first:last, 0] = 2.25 + rng.normal(0, 0.01, last - first)
+        buffer.times[first:last] = start_ns + rows * daq.one_sample_time
+    buffer.rows = samples
+    values, times = buffer.column(0, 0, samples)
+    stats = RunStats(daq.channels[0].conversion_factor, start_ns)
+    stats.add_block(values, times)
+    return Run(
+        daq.channels[0],
+        datetime.now(),
+        start_ns,
+        start_ns + samples * daq.one_sample_time,
+        values,
+        times,
+        buffer=buffer,
+        stats=stats,
+        sample_rates=[(0.0, daq.data_rate_hz)],
+    )
+
+
+def bench_processing(base_dir, run_seconds):
+    daq = make_daq(base_dir, 120, SyntheticBackend())
+    run = synthetic_run(daq, run_seconds)
+    run.start = datetime.now() - timedelta(days=1)
+
+    tracemalloc.start()
+    started = time.perf_counter_ns()
+    daq.parse_save_and_graph_data(run)
+    processing_ms = (time.perf_counter_ns() - started) / 1_000_000
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    file_time = run.start.strftime("%Y%m%d-%H:%M:%S")
+    run_path = os.path.join(base_dir, "{}.run".format(file_time))
+    plot_ms = render_run_plots(run_path, base_dir, file_time)
+    result = {
+        "run_seconds": run_seconds,
+        "samples": len(run.samples),
+        "processing_ms": processing_ms,
+        "plot_ms": plot_ms,
+        "run_file_bytes": os.path.getsize(run_path),
+        "buffer_bytes": run.buffer.nbytes(),
+        "peak_processing_bytes": peak_bytes,
+    }
+    run.release()
+    daq.shutdown()
+    return result
+
+
+def time_ms(function, repeat):
+    started = time.perf_counter_ns()
+    for i in range(repeat):
+        function()
+    return (time.perf_counter_ns() - started) / 1_000_000 / repeat
+
+
+def bench_water_usage(base_dir, row_counts):
+    connection = connect(os.path.join(base_dir, "water_usage_bench.db"))
+    init_water_usage_tables(connection)
+    results = []
+    timestamp = datetime(2020, 9, 1)
+    rows = 0
+    for row_count in row_counts:
+        # Grow the table with runs a few hours apart
+        batch = []
+        while rows < row_count:
+            timestamp += timedelta(hours=5)
+            batch.append((timestamp, 107.2))
+            rows += 1
+        for run_timestamp, gallons in batch:
+            insert_water_usage(connection, run_timestamp, gallons)
+
+        def insert():
+            nonlocal timestamp
+            timestamp += timedelta(hours=5)
+            insert_water_usage(connection, timestamp, 107.2)
+
+        insert_ms = time_ms(insert, 20)
+        rows += 20
+        today = timestamp.date()
+        results.append(
+            {
+                "rows": rows,
+                "insert_ms": insert_ms,
+                "total_ms": time_ms(lambda: total_water_usage(connection), 50),
+                "pay_period_ms": time_ms(
+                    lambda: water_usage_between(
+                        connection, today - timedelta(days=120), today
+                    ),
+                    50,
+                ),
+                "full_scan_ms": time_ms(
+                    lambda: connection.execute(
+                        "SELECT * FROM WATER_USAGE_DATA"
+                    ).fetchall(),
+                    3,
+                ),
+            }
+        )
+    connection.close()
+    return results
+
+
+def git_version():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_dir(base_dir):
+    # A fresh directory and database for each bench, so none sees what an
+    # earlier one wrote
+    return tempfile.mkdtemp(dir=base_dir)
+
+
+def run_benchmarks(args):
+    base_dir = tempfile.mkdtemp(prefix="home_das_bench_")
+    results = {
+        "version": git_version(),
+        "date": datetime.now().isoformat(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "loop": [],
+        "processing": [],
+        "water_usage": [],
+    }
+    try:
+        for rate in args.rates:
+            for scheduler in args.schedulers:
+                print("Loop @ {} hz with the {} scheduler".format(rate, scheduler))
+                results["loop"].append(
+                    bench_loop(bench_dir(base_dir), rate, args.loop_seconds, scheduler)
+                )
+        for run_seconds in args.run_seconds:
+            print("Processing a {} s run".format(run_seconds))
+            results["processing"].append(
+                bench_processing(bench_dir(base_dir), run_seconds)
+            )
+        print("Water usage tables")
+        results["water_usage"] = bench_water_usage(
+            bench_dir(base_dir), args.water_usage_rows
+        )
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def flatten(results, prefix=""):
+    # {"loop[120hz deadline].achieved_hz": ...} style keys for comparisons
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            flat.update(flatten(value, "{}.{}".format(prefix, key) if prefix else key))
+    elif isinstance(results, list):
+        for item in results:
+            label = " ".join(
+                str(item[key])
+                for key in ("data_rate_hz", "scheduler", "run_seconds", "rows")
+                if key in item
+            )
+            flat.update(flatten(item, "{}[{}]".format(prefix, label)))
+    elif isinstance(results, (int, float)):
+        flat[prefix] = results
+    return flat
+
+
+def compare(old_results, new_results):
+    old = flatten(old_results)
+    new = flatten(new_results)
+    for key in sorted(set(old) & set(new)):
+        if old[key] == 0:
+            continue
+        change = 100 * (new[key] - old[key]) / abs(old[key])
+        print(
+            "{:<60} {:>14.3f} {:>14.3f} {:>+8.1f}%".format(
+                key, old[key], new[key], change
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark home_das without hardware")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Earlier results to compare against")
+    parser.add_argument("--rates", type=int, nargs="+", default=list(LOOP_RATES_HZ))
+    parser.add_argument(
+        "--schedulers",
+        nargs="+",
+        default=["deadline", "busy"],
+        choices=["deadline", "busy"],
+    )
+    parser.add_argument("--loop-seconds", type=float, default=10.0)
+    parser.add_argument("--run-seconds", type=int, nargs="+", default=list(RUN_SECONDS))
+    parser.add_argument(
+        "--water-usage-rows", type=int, nargs="+", default=list(WATER_USAGE_ROWS)
+    )
+    args = parser.parse_args()
+
+    # The same GIL switch interval main2.py runs with
+    sys.setswitchinterval(0.0005)
+    results = run_benchmarks(args)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), results)
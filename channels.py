@@ -0,0 +1,85 @@
+NUMBER_OF_CHANNELS = 8
+
+
+def get_raw_to_voltage_to_amps_conversion_factor(
+    vin_min=0.0, vin_max=10.0, amps_min=0.0, amps_max=50.0
+):
+    return (amps_max - amps_min) / (vin_max - vin_min)
+
+
+class Channel:
+    def __init__(
+        self,
+        index,
+        name,
+        conversion_factor,
+        threshold=0.1,
+        pump_gallons_per_second=None,
+        transport_volume=0.0,
+        off_threshold=None,
+        min_on_seconds=0.05,
+        min_off_seconds=0.25,
+        plate=0,
+    ):
+        if not 0 <= index < NUMBER_OF_CHANNELS:
+            raise ValueError("DAQC2 channel must be 0-7, got {}".format(index))
+        self.index = index
+        # The DAQC2 plate address, 0-7. Channels are numbered across plates
+        # in the database and the log, plate 0's keep their index.
+        self.plate = plate
+        self.number = plate * NUMBER_OF_CHANNELS + index
+        self.name = name
+        self.conversion_factor = conversion_factor
+        # A run starts above threshold and ends below off_threshold, each
+        # only after holding for min_on_seconds / min_off_seconds
+        self.threshold = threshold
+        self.off_threshold = threshold / 2 if off_threshold is None else off_threshold
+        self.min_on_seconds = min_on_seconds
+        self.min_off_seconds = min_off_seconds
+        # Only pump channels know how much water a run moves
+        self.pump_gallons_per_second = pump_gallons_per_second
+        self.transport_volume = transport_volume
+        # Channel 0 keeps the original file names so the archive stays uniform
+        self.file_prefix = "" if index == 0 else "CH{}_".format(index)
+        if plate != 0:
+            self.file_prefix = "P{}_CH{}_".format(plate, index)
+
+        # Run detection state
+        self.running = False
+        self.run_start = None
+        self.run_start_ns = 0
+        self.run_start_row = 0
+        self.run_written_row = 0
+        self.run_missed_deadlines = 0
+        self.stats = None
+
+    def tracks_water_usage(self):
+        return self.pump_gallons_per_second is not None
+
+    def pumped_gallons(self, seconds):
+        return (seconds * self.pump_gallons_per_second) - self.transport_volume
+
+
+def channels_from_schema(schema, plate=0):
+    # schema mirrors data_schema in main.py, keyed by channel number
+    channels = []
+    for key, config in sorted(schema.items(), key=lambda item: int(item[0])):
+        if config.get("name", "Empty") == "Empty":
+            continue
+        channels.append(
+            Channel(
+                int(key),
+                config["name"],
+                config.get(
+                    "conversion_factor", get_raw_to_voltage_to_amps_conversion_factor()
+                ),
+                config.get("threshold", 0.1),
+                config.get("pump_gallons_per_second"),
+                config.get("transport_volume", 0.0),
+                config.get("off_threshold"),
+                config.get("min_on_seconds", 0.05),
+                config.get("min_off_seconds", 0.25),
+                plate,
+            )
+        )
+    return channels
@@ -0,0 +1,93 @@
+import copy
+import json
+import os
+
+from channels import Channel, get_raw_to_voltage_to_amps_conversion_factor
+
+# Settings for main2.py and the tools that need the pump's numbers, read from
+# a JSON file (home_das.json next to this file unless another is given).
+# Anything the file leaves out keeps its value from DEFAULT_CONFIG, nested
+# sections key by key.
+#
+#   data_rate_hz, idle_rate_hz  samples/s while a pump runs and while none does
+#                               (null samples at data_rate_hz all the time). A
+#                               run is first seen at the idle rate, so its
+#                               inrush isn't sampled and its max amps are low
+#   scheduler                   "busy" (the old busy-wait loop) or "deadline"
+#   plots                       "process" or "off"
+#   base_dir                    where logs, runs and the database live
+#   plate_address, data_schema  the DAQC2 plate, and the data_schema of
+#                               main.py for it (null: the dosing pump only)
+#   plates                      {address: data_schema} for stacked plates
+#   pump                        gallons per minute (per Anette's engineering
+#                               docs, a dose should be 107.2 gallons), the
+#                               gallons that drain back from the pipe after a
+#                               run, and the site's elevations in feet
+#   sensor                      the current sensor's input and output range
+#   retention                   days of raw samples, rollups and run files
+
+DEFAULT_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "home_das.json"
+)
+DEFAULT_CONFIG = {
+    "data_rate_hz": 120,
+    "idle_rate_hz": None,
+    "scheduler": "busy",
+    "plots": "process",
+    "base_dir": os.path.join(os.path.sep, "home", "pi", "home_das"),
+    "plate_address": 0,
+    "data_schema": None,
+    "plates": None,
+    "pump": {
+        "gallons_per_minute": 43.5,
+        "transport_volume": 12.8,
+        "threshold": 0.1,
+        "tank_elevation": 7458,  # Best Guess
+        "field_elevation": 7558,  # Best Guess
+        "tank_depth": 6,
+        "pump_distance": 100,
+        "head_loss": 10.4,
+    },
+    "sensor": {"vin_min": 0.0, "vin_max": 10.0, "amps_min": 0.0, "amps_max": 50.0},
+    "retention": {"raw_sample_days": 30, "rollup_days": 365, "file_days": 90},
+}
+
+
+def merge(defaults, overrides):
+    merged = copy.deepcopy(defaults)
+    for key, value in overrides.items():
+        if isinstance(merged.get(key), dict) and isinstance(value, dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_config(path=None):
+    # An explicitly given file has to exist, the default one is optional
+    if path is None:
+        path = DEFAULT_CONFIG_PATH
+        if not os.path.exists(path):
+            return copy.deepcopy(DEFAULT_CONFIG)
+    with open(path) as config_file:
+        return merge(DEFAULT_CONFIG, json.load(config_file))
+
+
+def conversion_factor(config):
+    return get_raw_to_voltage_to_amps_conversion_factor(**config["sensor"])
+
+
+def pump_channel(config, factor=None):
+    # The dosing pump on channel 0, with the sensor's conversion factor unless
+    # the caller knows better
+    pump = config["pump"]
+    if factor is None:
+        factor = conversion_factor(config)
+    return Channel(
+        0,
+        "Dosing pump",
+        factor,
+        pump["threshold"],
+        pump["gallons_per_minute"] / 60,
+        pump["transport_volume"],
+    )
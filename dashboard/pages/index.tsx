@@ -4,18 +4,10 @@ import clsx from "clsx";
 import { formatDistance } from "date-fns";
 import parse from "date-fns/parse";
 import format from "date-fns/format";
-import add from "date-fns/add";
-import sub from "date-fns/sub";
-import compareAsc from "date-fns/compareAsc";
 import intervalToDuration from "date-fns/intervalToDuration";
-import differenceInSeconds from "date-fns/differenceInSeconds";
 import differenceInDays from "date-fns/differenceInDays";
 import formatDuration from "date-fns/formatDuration";
 import startOfQuarter from "date-fns/startOfQuarter";
-import isAfter from "date-fns/isAfter";
-import isEqual from "date-fns/isEqual";
-import isBefore from "date-fns/isBefore";
-import sqlite3 from "sqlite3";
 import { BarChart, CartesianGrid, XAxis, YAxis, Tooltip, Bar } from "recharts";
 import { ResponsiveCalendar } from "@nivo/calendar";
 import {
@@ -46,21 +38,29 @@ import ButtonGroup from "@material-ui/core/ButtonGroup";
 
 import Head from "next/head";
 
+// query_service.py, which serves the aggregates from the water usage rollups
+// so a page load never reads every row of WATER_USAGE_DATA
+const apiUrl = process.env.HOME_DAS_API_URL || "http://127.0.0.1:8001";
+// Newest runs shown in the log
+const runLogSize = 1000;
+
+const getJson = async (path: string) => {
+  const response = await fetch(`${apiUrl}${path}`);
+  if (!response.ok) {
+    throw new Error(`${path}: ${response.status} ${await response.text()}`);
+  }
+  return response.json();
+};
+
 export async function getServerSideProps() {
-  return new Promise((resolve, reject) => {
-    const db = new sqlite3.Database("/home/pi/home_das/home_das_db.db");
-    // const db = new sqlite3.Database(
-    //   "/Users/macuser/Desktop/Programming/python/home_das/home_das_db.db"
-    // );
-    db.serialize(() => {
-      db.all("SELECT * from WATER_USAGE_DATA", function (err, rows) {
-        if (err) {
-          reject(err);
-        }
-        resolve({ props: { dosingPumpRecords: rows } });
-      });
-    });
-  });
+  const [weekdayUsage, calendarUsage, payPeriodUsage, runLog] =
+    await Promise.all([
+      getJson("/api/weekday"),
+      getJson("/api/calendar"),
+      getJson("/api/pay-periods"),
+      getJson(`/api/runs?per_page=${runLogSize}`),
+    ]);
+  return { props: { weekdayUsage, calendarUsage, payPeriodUsage, runLog } };
 }
 
 // From a pump run witnessed on Jan 31 21
@@ -82,29 +82,56 @@ const derivedGallonsPerSecond = (): number => {
 const actualGallonsPerSecond = derivedGallonsPerSecond();
 
 const transportVolume = 12.8; // Gallons
+const pumpGallonsPerSecond = 0.725;
 const calcActualDosedValue = (originalDosedGallons: number): number => {
   const fullDose = Math.abs(originalDosedGallons) + transportVolume;
-  const pumpGallonsPerSecond = 0.725;
   const dosedSeconds = fullDose / pumpGallonsPerSecond;
 
   const newFullDose = dosedSeconds * actualGallonsPerSecond;
   return newFullDose - transportVolume;
 };
 
-type DosingPumpRecord = {
-  timestamp: "string";
+// calcActualDosedValue summed over the runs of an aggregate. It is linear in
+// the gallons, so this is exact as long as no run recorded negative gallons
+// (shorter than the transport volume takes to pump)
+const calcActualDosedTotal = (gallons: number, runs: number): number => {
+  const scale = actualGallonsPerSecond / pumpGallonsPerSecond;
+  return scale * gallons + runs * transportVolume * (scale - 1);
+};
+
+type WeekdayUsage = {
+  day: string;
   gallons_pumped: number;
+  runs: number;
 };
 
-type DosingPumpRecords = Array<DosingPumpRecord>;
+type DayUsage = {
+  day: string;
+  gallons_pumped: number;
+  runs: number;
+};
 
-type HomeProps = {
-  dosingPumpRecords: DosingPumpRecords;
+type PayPeriodUsage = {
+  name: string;
+  start: string;
+  end: string;
+  days: number;
+  days_so_far: number;
+  gallons_pumped: number;
+  runs: number;
 };
 
-type CalDataDict = {
-  [date: string]: number;
+type DosingPumpRecord = {
+  timestamp: string;
+  gallons_pumped: number;
+  seconds_since_previous: number | null;
+};
+
+type RunLog = {
+  total_runs: number;
+  runs: Array<DosingPumpRecord>;
 };
+
 type DayOfWeekDict = {
   [dayOfWeek: string]: number;
 };
@@ -119,31 +146,14 @@ const dayOrder = [
   "Sunday",
 ];
 
-function compareTimestamps(a: string, b: string): number {
-  const aDate = parseSqliteTimestamp(a);
-  const bDate = parseSqliteTimestamp(b);
-
-  if (aDate < bDate) {
-    return -1;
-  }
-
-  if (aDate > bDate) {
-    return 1;
-  }
-  return 0;
-}
-
-function compareDosingRecords(
-  a: DosingPumpRecord,
-  b: DosingPumpRecord
-): number {
-  return compareTimestamps(a.timestamp, b.timestamp);
-}
-
 const parseSqliteTimestamp = (timestamp: string): Date => {
   return parse(timestamp.split(".")[0], "yyyy-MM-dd HH:mm:ss", new Date());
 };
 
+const parseDay = (day: string): Date => {
+  return parse(day, "yyyy-MM-dd", new Date());
+};
+
 const waterBlue = "#1E88E5";
 const theme = createMuiTheme({
   palette: {
@@ -198,79 +208,24 @@ const SectionTitle = (props: SectionTitleProps) => {
   );
 };
 
-type PayPeriod = {
-  name: string;
-  start: Date;
-  end: Date;
-  numDays: number;
-};
-
-// Generate pay periods up to the current date
-const getPayPeriods = (): PayPeriod[] => {
-  const firstPayPeriod = new Date(2020, 9, 1);
-  const monthsBetweenPayPeriods = 4;
-  const result = [];
-  let payPeriod = firstPayPeriod;
-
-  while (compareAsc(payPeriod, new Date()) === -1) {
-    const nextPayPeriodStart = add(payPeriod, {
-      months: monthsBetweenPayPeriods,
-    });
-    const payPeriodEnd = sub(nextPayPeriodStart, { minutes: 1 });
-
-    const startAndEndInSameYear =
-      format(payPeriod, "u") === format(payPeriodEnd, "u");
-
-    const startFormat = startAndEndInSameYear
-      ? format(payPeriod, "MMM")
-      : format(payPeriod, "MMM u");
-
-    result.push({
-      name: `${startFormat} - ${format(payPeriodEnd, "MMM u")}`,
-      start: payPeriod,
-      end: payPeriodEnd,
-      numDays: differenceInDays(payPeriodEnd, payPeriod),
-    });
-    payPeriod = nextPayPeriodStart;
-  }
-  return result;
-};
-
-const payPeriods: PayPeriod[] = getPayPeriods();
-
-const getPayPeriodNameFromTimestamp = (timestamp: Date): string => {
-  let result = "bad pay period";
-  payPeriods.map((payPeriod: PayPeriod) => {
-    if (
-      isEqual(timestamp, payPeriod.start) ||
-      isEqual(timestamp, payPeriod.end)
-    ) {
-      result = payPeriod.name;
-    } else if (
-      isAfter(timestamp, payPeriod.start) &&
-      isBefore(timestamp, payPeriod.end)
-    ) {
-      result = payPeriod.name;
-    }
-  });
-  return result;
-};
-
 type HomeState = {
   usageDataIndex: number;
 };
 
 interface HomeStyledProps extends WithStyles<typeof styles> {
-  dosingPumpRecords: DosingPumpRecords;
+  weekdayUsage: WeekdayUsage[];
+  calendarUsage: DayUsage[];
+  payPeriodUsage: PayPeriodUsage[];
+  runLog: RunLog;
 }
 
 class Home extends React.Component<HomeStyledProps, HomeState> {
-  usageDataIndexMax = payPeriods.length - 1;
+  usageDataIndexMax = this.props.payPeriodUsage.length - 1;
   usageDataIndexMin = 0;
   constructor(props: HomeStyledProps) {
     super(props);
     this.state = {
-      usageDataIndex: payPeriods.length - 1,
+      usageDataIndex: props.payPeriodUsage.length - 1,
     };
   }
 
@@ -291,13 +246,15 @@ class Home extends React.Component<HomeStyledProps, HomeState> {
   }
 
   render() {
-    const { dosingPumpRecords, classes } = this.props;
-    const calDataDict: CalDataDict = {};
+    const { weekdayUsage, calendarUsage, payPeriodUsage, runLog, classes } =
+      this.props;
     const dayOfWeekDict: DayOfWeekDict = {};
-    const thisPayPeriod: PayPeriod = payPeriods[payPeriods.length - 1];
-    const thisPayPeriodStart = thisPayPeriod.start;
-    const thisPayPeriodEnd = thisPayPeriod.end;
-    let gallonsPumpedThisPayPeriod = 0;
+    weekdayUsage.map((usage: WeekdayUsage) => {
+      dayOfWeekDict[usage.day] = calcActualDosedTotal(
+        usage.gallons_pumped,
+        usage.runs
+      );
+    });
 
     type PayPeriodData = {
       total_gallons_dosed: number;
@@ -306,118 +263,55 @@ class Home extends React.Component<HomeStyledProps, HomeState> {
       days: number;
       start: Date;
       end: Date;
-      mostRecentDosingPumpRun: Date;
     };
 
     const payPeriodData: { [key: string]: PayPeriodData } = {};
-    payPeriods.map((payPeriod: PayPeriod) => {
+    payPeriodUsage.map((payPeriod: PayPeriodUsage) => {
+      const total = calcActualDosedTotal(
+        payPeriod.gallons_pumped,
+        payPeriod.runs
+      );
+      const average = total / payPeriod.days_so_far;
       payPeriodData[payPeriod.name] = {
-        total_gallons_dosed: 0,
-        average_daily_gallons_dosed: 0,
-        estimated_gallons_dosed: 0,
-        days: payPeriod.numDays,
-        start: payPeriod.start,
-        end: payPeriod.end,
-        mostRecentDosingPumpRun: payPeriod.start,
+        total_gallons_dosed: total,
+        average_daily_gallons_dosed: average,
+        estimated_gallons_dosed: average * payPeriod.days,
+        days: payPeriod.days,
+        start: parseDay(payPeriod.start),
+        end: parseDay(payPeriod.end),
       };
     });
-
-    const completeCalData = dosingPumpRecords.map(
-      (record: DosingPumpRecord) => {
-        const timestampTime = parseSqliteTimestamp(record.timestamp);
-        const timeForCal = format(timestampTime, "yyyy-MM-dd");
-        const actualGallonsPumped = calcActualDosedValue(record.gallons_pumped);
-        if (calDataDict.hasOwnProperty(timeForCal)) {
-          calDataDict[timeForCal] =
-            calDataDict[timeForCal] + actualGallonsPumped;
-        } else {
-          calDataDict[timeForCal] = actualGallonsPumped;
-        }
-
-        const dayOfWeek = format(timestampTime, "EEEE");
-        if (dayOfWeekDict.hasOwnProperty(dayOfWeek)) {
-          dayOfWeekDict[dayOfWeek] =
-            dayOfWeekDict[dayOfWeek] + actualGallonsPumped;
-        } else {
-          dayOfWeekDict[dayOfWeek] = actualGallonsPumped;
-        }
-
-        if (isAfter(timestampTime, thisPayPeriodStart)) {
-          gallonsPumpedThisPayPeriod += actualGallonsPumped;
-        }
-
-        const payPeriodName = getPayPeriodNameFromTimestamp(timestampTime);
-        payPeriodData[payPeriodName].total_gallons_dosed += actualGallonsPumped;
-
-        return {
-          day: timeForCal,
-          value: actualGallonsPumped,
-        };
-      }
-    );
-
-    Object.keys(payPeriodData).map((key) => {
-      let daysForAverage = payPeriodData[key].days;
-      if (isAfter(payPeriodData[key].end, new Date())) {
-        daysForAverage =
-          differenceInDays(new Date(), payPeriodData[key].start) + 1;
-      }
-      payPeriodData[key].average_daily_gallons_dosed =
-        payPeriodData[key].total_gallons_dosed / daysForAverage;
-      payPeriodData[key].estimated_gallons_dosed =
-        payPeriodData[key].average_daily_gallons_dosed *
-        payPeriodData[key].days;
-    });
-
-    const payPeriodGallonsPerDay =
-      gallonsPumpedThisPayPeriod /
-      (differenceInDays(new Date(), thisPayPeriodStart) + 1.0);
-
-    const formattedCalData = Object.keys(calDataDict).map((key) => {
-      return { day: key, value: calDataDict[key] };
-    });
-
     const payPeriodDataKeys = Object.keys(payPeriodData);
+    const thisPayPeriod: PayPeriodData =
+      payPeriodData[payPeriodDataKeys[payPeriodDataKeys.length - 1]];
+    const thisPayPeriodStart = thisPayPeriod.start;
 
-    const parseDate = (timestamp: string): Date => {
-      return parse(timestamp.split(".")[0], "yyyy-MM-dd HH:mm:ss", new Date());
-    };
+    const formattedCalData = calendarUsage.map((usage: DayUsage) => {
+      return {
+        day: usage.day,
+        value: calcActualDosedTotal(usage.gallons_pumped, usage.runs),
+      };
+    });
 
-    let lastRuntime: Date = parseDate(dosingPumpRecords[0].timestamp);
     let allSecondsBetween: number[] = [];
     let allGallonsPumped: number[] = [];
-    const dosingPumpRecordsWithId = dosingPumpRecords
-      .reverse()
-      .map((record: DosingPumpRecord, x: number) => {
+    const dosingPumpRecordsWithId = runLog.runs.map(
+      (record: DosingPumpRecord, x: number) => {
         const actualGallonsPumped = calcActualDosedValue(record.gallons_pumped);
-        const timestampTime: Date = parseDate(record.timestamp);
-        const hoursBetween = intervalToDuration({
-          start: timestampTime,
-          end: lastRuntime,
-        });
-        const secondsBetween = differenceInSeconds(timestampTime, lastRuntime);
+        const timestampTime: Date = parseSqliteTimestamp(record.timestamp);
+        const secondsBetween = record.seconds_since_previous || 0;
         allSecondsBetween.push(secondsBetween);
         allGallonsPumped.push(actualGallonsPumped);
-        lastRuntime = timestampTime;
         return {
           ...record,
           timeSince: formatDistance(timestampTime, new Date()) + " ago",
           timestamp: format(timestampTime, "PPpp"),
-          hoursBetween: formatDuration(hoursBetween, {
-            format: ["years", "months", "weeks", "days", "hours", "minutes"],
-          }),
           secondsBetween,
-          id: x,
+          id: runLog.total_runs - 1 - x,
           gallons_pumped: parseFloat(actualGallonsPumped.toFixed(3)),
         };
-      })
-      .reverse();
-
-    let total = 0;
-    for (let i = 0; i < allSecondsBetween.length; i++) {
-      total += Math.abs(allSecondsBetween[i]);
-    }
-    const secondsBetweenAverage = total / allSecondsBetween.length;
+      }
+    );
 
     const median = (arr: number[]) => {
       const mid = Math.floor(arr.length / 2),
@@ -550,7 +444,7 @@ class Home extends React.Component<HomeStyledProps, HomeState> {
                 <>
                   <SectionTitle>
                     Estimated Gallons to be Dosed This Pay Period (
-                    {thisPayPeriod.start.toLocaleDateString("en-US")} to{" "}
+                    {thisPayPeriodStart.toLocaleDateString("en-US")} to{" "}
                     {thisPayPeriod.end.toLocaleDateString("en-US")}):{" "}
                   </SectionTitle>
                   <Typography variant="h2" component="h2" align="center">
@@ -648,8 +542,8 @@ class Home extends React.Component<HomeStyledProps, HomeState> {
               >
                 <ResponsiveCalendar
                   data={formattedCalData}
-                  from={completeCalData[completeCalData.length - 1].day}
-                  to={completeCalData[0].day}
+                  from={formattedCalData[0].day}
+                  to={formattedCalData[formattedCalData.length - 1].day}
                   colors={[
                     "#90CAF9",
                     "#42A5F5",
@@ -0,0 +1,43 @@
+import os
+import sqlite3 as db
+from urllib.parse import quote
+
+# The DAQ, the sample writer and the dashboard all share one database file.
+# WAL lets the dashboard read while a run is being written, and
+# synchronous=NORMAL only syncs at checkpoints, which is safe in WAL mode.
+# auto_vacuum only takes on a new database, before its first table, and lets
+# retention.py give the pages of expired rows back a few at a time.
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA wal_autocheckpoint=2000",
+)
+BUSY_TIMEOUT_SECONDS = 30
+
+
+def connect(path, check_same_thread=True):
+    connection = db.connect(
+        path,
+        detect_types=db.PARSE_DECLTYPES | db.PARSE_COLNAMES,
+        check_same_thread=check_same_thread,
+        timeout=BUSY_TIMEOUT_SECONDS,
+    )
+    for pragma in PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
+
+def connect_read_only(path, check_same_thread=True):
+    # For readers in another process, which leave the schema, the pragmas
+    # and the rollups to the DAQ
+    connection = db.connect(
+        "file:{}?mode=ro".format(quote(os.path.abspath(path))),
+        detect_types=db.PARSE_DECLTYPES | db.PARSE_COLNAMES,
+        check_same_thread=check_same_thread,
+        timeout=BUSY_TIMEOUT_SECONDS,
+        uri=True,
+    )
+    return connection
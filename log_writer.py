@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# The DAQ's log. log() only puts a record on a queue, a listener thread does
+# the formatting and file I/O, so logging never stalls the sampling loop.
+#
+# The file holds one JSON object per line: time, level, message and whatever
+# fields were passed with it, e.g. {"event": "run", "run_id": ...,
+# "seconds": ...}. It is rotated once it reaches max_bytes or is
+# max_age_seconds old, keeping backup_count old files (home_das.log.1, ...).
+# The console still gets the plain message.
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SizeAndAgeRotatingFileHandler(RotatingFileHandler):
+    def __init__(self, path, max_bytes, max_age_seconds, backup_count):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backup_count)
+        self.max_age_seconds = max_age_seconds
+        self.rollover_at = self.file_created() + max_age_seconds
+
+    def file_created(self):
+        # The time of the file's first record. st_ctime changes with every
+        # write, so after a restart it would be the time of the last record
+        # and a log written across restarts would never be rotated by age.
+        # A new file, or one from before the JSON log, starts now.
+        try:
+            with open(self.baseFilename) as log_file:
+                first_line = log_file.readline()
+            return datetime.fromisoformat(json.loads(first_line)["time"]).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            return time.time()
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.max_age_seconds
+
+
+class LogWriter:
+    def __init__(
+        self,
+        path,
+        max_bytes=10_000_000,
+        max_age_seconds=7 * 24 * 60 * 60,
+        backup_count=10,
+        console=True,
+    ):
+        self.queue = queue.Queue()
+        self.logger = logging.getLogger("home_das.{}".format(path))
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.queue_handler = QueueHandler(self.queue)
+
+        file_handler = SizeAndAgeRotatingFileHandler(
+            path, max_bytes, max_age_seconds, backup_count
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers = [file_handler]
+        if console:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(logging.Formatter("%(message)s"))
+            handlers.append(console_handler)
+        self.handlers = handlers
+        self.listener = QueueListener(self.queue, *handlers)
+
+    def start(self):
+        self.logger.addHandler(self.queue_handler)
+        self.listener.start()
+
+    def stop(self):
+        # Everything logged so far is written before this returns
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+    def log(self, message, level=logging.INFO, **fields):
+        self.logger.log(level, message, extra={"fields": fields})
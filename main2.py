@@ -1,68 +1,755 @@
-import copy
+import argparse
+import json
 import os
 import pwd
-import sqlite3 as db
+import queue
+import sys
+import threading
 import time
 from datetime import datetime
 
-import matplotlib.pyplot as plt
 import numpy as np
-import piplates.DAQC2plate as das
+from backends import Daqc2Backend, ReplayBackend, SyntheticBackend
+from channels import channels_from_schema, get_raw_to_voltage_to_amps_conversion_factor
+from config import load_config, pump_channel
+from log_writer import LogWriter
+from metrics import LatencyHistogram, MetricsExporter
+from plotting import PlotRenderer
+from run_buffer import RunBufferPool
+from run_detection import RunDetector
+from run_stats import RunStats
+from sample_writer import SampleBlock, SampleWriter
+from scheduler import DeadlineScheduler
+
+# Only what sampling needs is imported up front. The database, run files,
+# waveform, water usage, pump health and retention modules (and sqlite3) are
+# imported where they are used, by the startup thread, the sample writer and
+# the run processor once sampling has begun. plotting.py and sample_writer.py
+# import them lazily for the same reason.
+#
+# The first PROBE_READS reads of each plate double as the old maximum data
+# rate probe, so nothing reads the plate before the sampling loop does.
+PROBE_READS = 10
+
+
+def run_sample_rates(start_ns, run_rate_since_ns, idle_rate_hz, data_rate_hz):
+    # A run that started before its plate last switched to the run rate was
+    # first seen at the idle rate
+    if idle_rate_hz and start_ns < run_rate_since_ns:
+        return [
+            (0.0, idle_rate_hz),
+            ((run_rate_since_ns - start_ns) / 1_000_000_000, data_rate_hz),
+        ]
+    return [(0.0, data_rate_hz)]
+
+
+class Run:
+    def __init__(
+        self,
+        channel,
+        start,
+        start_ns,
+        end_ns,
+        samples,
+        sample_times,
+        missed_deadlines=0,
+        buffer=None,
+        stats=None,
+        sample_rates=None,
+        journal_entry=None,
+    ):
+        self.channel = channel
+        self.start = start
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.samples = samples
+        self.sample_times = sample_times
+        self.missed_deadlines = missed_deadlines
+        # samples and sample_times are views into buffer
+        self.buffer = buffer
+        # Summary statistics gathered while the run was in progress
+        self.stats = stats
+        # [(seconds into the run, sample rate)], more than one when the run
+        # was first seen while sampling at the idle rate
+        self.sample_rates = sample_rates
+        # The run's entry in the buffer's journal, marked done on release
+        self.journal_entry = journal_entry
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.journal_run_done(self.journal_entry)
+            self.buffer.release()
+            self.buffer = None
+
+
+class Plate:
+    # One DAQC2 plate, sampled on its own schedule by its own thread (or the
+    # caller's when it is the only one). Finished runs go to the DAQ's shared
+    # processing queue and run samples to its shared sample writer.
+    def __init__(self, daq, address, channels, backend, scheduler="busy"):
+        self.daq = daq
+        self.address = address
+        self.backend = backend
+        self.channels = channels
+        self.data_rate_hz = daq.data_rate_hz
+        self.idle_rate_hz = daq.idle_rate_hz
+        self.one_sample_time = daq.one_sample_time
+        self.idle_sample_time = daq.idle_sample_time
+        self.max_run_seconds = daq.max_run_seconds
+
+        self.loop_time = 0
+        self.running = False
+        self.thread = None
+        self.error = None
+
+        self.sampling_idle = True
+        self.tick_ns = self.idle_sample_time
+        self.run_rate_since_ns = 0
+        # "busy" spins between samples, "deadline" sleeps on an absolute grid
+        if scheduler == "deadline":
+            self.scheduler = DeadlineScheduler(self.tick_ns)
+        elif scheduler == "busy":
+            self.scheduler = None
+        else:
+            raise ValueError("Unknown scheduler: {}".format(scheduler))
+
+        self.channel_indices = np.array([channel.index for channel in channels])
+        self.detector = RunDetector(
+            [channel.threshold for channel in channels],
+            [channel.off_threshold for channel in channels],
+            [int(channel.min_on_seconds * 1_000_000_000) for channel in channels],
+            [int(channel.min_off_seconds * 1_000_000_000) for channel in channels],
+        )
+        # Readings are collected into blocks of about 100ms and runs are
+        # detected a block at a time
+        self.detection_block_rows = max(1, self.data_rate_hz // 10)
+        self.block_times = np.zeros(self.detection_block_rows, dtype=np.int64)
+        self.block_values = np.zeros(
+            (self.detection_block_rows, len(channels)), dtype=np.float32
+        )
+        self.block_rows = 0
+        # More than one channel is read with a single getADCall per tick
+        self.batched = len(channels) > 1
+
+        # Each plate has its own run buffers and journal files, plate 0 keeps
+        # using <base_dir>/journal
+        journal_dir = os.path.join(daq.base_dir, "journal")
+        if address != 0:
+            journal_dir = os.path.join(journal_dir, "plate{}".format(address))
+        self.buffer_pool = RunBufferPool(
+            self.max_run_seconds * self.data_rate_hz,
+            len(channels),
+            daq.run_queue_size + 2,
+            journal_dir,
+            log=daq.log,
+        )
+        # Journals left by the last run are adopted now so sampling never
+        # reuses one, their runs are queued by recover_journal()
+        self.recovered_buffers = self.buffer_pool.recover()
+        self.buffer = None
+        self.sample_block_rows = self.data_rate_hz
+        self.dropped_runs = 0
+
+        # Recorded by the sampling loop
+        self.ticks = 0
+        self.probe_ns = 0
+        self.busy_overruns = 0
+        self.busy_missed_deadlines = 0
+        self.read_latency = LatencyHistogram()
+        self.tick_interval = LatencyHistogram()
+        self.idle_tick_interval = LatencyHistogram()
+
+    def add_metrics(self, metrics):
+        labels = {"plate": self.address}
+        metrics.add_histogram(
+            "home_das_read_latency_ns",
+            "Time to read the plate each tick",
+            self.read_latency,
+            labels,
+        )
+        metrics.add_histogram(
+            "home_das_tick_interval_ns",
+            "Time between ticks",
+            self.tick_interval,
+            dict(labels, rate="run"),
+        )
+        metrics.add_histogram(
+            "home_das_tick_interval_ns",
+            "Time between ticks",
+            self.idle_tick_interval,
+            dict(labels, rate="idle"),
+        )
+        metrics.add_counter("home_das_ticks_total", "Ticks", lambda: self.ticks, labels)
+        metrics.add_counter(
+            "home_das_samples_total",
+            "Readings taken, one per channel each tick",
+            lambda: self.ticks * len(self.channels),
+            labels,
+        )
+        metrics.add_counter(
+            "home_das_overruns_total",
+            "Ticks that took longer than the sample period",
+            self.overruns,
+            labels,
+        )
+        metrics.add_counter(
+            "home_das_missed_deadlines_total",
+            "Sample deadlines skipped after overruns",
+            self.missed_deadlines,
+            labels,
+        )
+        metrics.add_gauge(
+            "home_das_sampling_idle",
+            "1 while polling at the idle rate",
+            lambda: int(self.sampling_idle),
+            labels,
+        )
+
+    def missed_deadlines(self):
+        if self.scheduler is None:
+            return self.busy_missed_deadlines
+        return self.scheduler.missed_deadlines
+
+    def overruns(self):
+        if self.scheduler is None:
+            return self.busy_overruns
+        return self.scheduler.overruns
+
+    def recover_journal(self):
+        # Runs that were queued or still going when the DAQ last stopped
+        # without a graceful shutdown are processed now
+        for buffer in self.recovered_buffers:
+            idle_rate_hz, data_rate_hz = buffer.sample_rates_hz()
+            for (
+                column,
+                start_row,
+                end_row,
+                start_ns,
+                end_ns,
+                run_rate_since_ns,
+                entry,
+            ) in buffer.unfinished_runs():
+                channel = self.channels[column]
+                samples, sample_times = buffer.column(column, start_row, end_row)
+                stats = RunStats(channel.conversion_factor, start_ns)
+                stats.add_block(samples, sample_times)
+                # Samples still queued for the writer when the DAQ stopped
+                # never reached SEPTIC_data, the writer skips those that did
+                self.daq.sample_writer.add(
+                    SampleBlock(
+                        channel, samples.copy(), sample_times.copy(), recovered=True
+                    )
+                )
+                buffer.retain()
+                run = Run(
+                    channel,
+                    datetime.fromtimestamp(start_ns / 1_000_000_000),
+                    start_ns,
+                    end_ns,
+                    samples,
+                    sample_times,
+                    buffer=buffer,
+                    stats=stats,
+                    sample_rates=run_sample_rates(
+                        start_ns, run_rate_since_ns, idle_rate_hz, data_rate_hz
+                    ),
+                    journal_entry=entry,
+                )
+                self.daq.log(
+                    "Recovered a {:.2f} second run of {} from {} from the journal".format(
+                        (end_ns - start_ns) / 1_000_000_000,
+                        channel.name,
+                        run.start.strftime("%Y%m%d-%H:%M:%S"),
+                    ),
+                    event="run_recovered",
+                    channel=channel.number,
+                    start=run.start.isoformat(),
+                )
+                self.daq.run_queue.put(run)
+            buffer.release()
+
+    def flush_samples(self, column, end_row):
+        # Folds the samples since the last flush into the run statistics and
+        # hands them to the sample writer
+        channel = self.channels[column]
+        start_row = channel.run_written_row
+        if end_row <= start_row:
+            return
+        raw_voltages, sample_times = self.buffer.column(column, start_row, end_row)
+        channel.stats.add_block(raw_voltages, sample_times)
+        # Blocks are small copies so the writer never holds a run buffer
+        self.daq.sample_writer.add(
+            SampleBlock(channel, raw_voltages.copy(), sample_times.copy())
+        )
+        channel.run_written_row = end_row
+
+    def queue_run(self, column, end_row, run_end_ns):
+        channel = self.channels[column]
+        if end_row <= channel.run_start_row:
+            # Ended before its first sample in this buffer, after a split
+            channel.running = False
+            return
+        self.flush_samples(column, end_row)
+        samples, sample_times = self.buffer.column(
+            column, channel.run_start_row, end_row
+        )
+        self.buffer.retain()
+        journal_entry = self.buffer.journal_run_queued(
+            column, channel.run_start_row, end_row, channel.run_start_ns, run_end_ns
+        )
+        run = Run(
+            channel,
+            channel.run_start,
+            channel.run_start_ns,
+            run_end_ns,
+            samples,
+            sample_times,
+            self.missed_deadlines() - channel.run_missed_deadlines,
+            self.buffer,
+            channel.stats,
+            run_sample_rates(
+                channel.run_start_ns,
+                self.run_rate_since_ns,
+                self.idle_rate_hz,
+                self.data_rate_hz,
+            ),
+            journal_entry,
+        )
+        channel.running = False
+        try:
+            self.daq.run_queue.put_nowait(run)
+        except queue.Full:
+            run.release()
+            self.dropped_runs += 1
+            self.daq.log(
+                "Run processing queue is full ({} runs), dropping run from {}".format(
+                    self.daq.run_queue_size, run.start.strftime("%Y%m%d-%H:%M:%S")
+                ),
+                event="run_dropped",
+                channel=channel.number,
+            )
+
+    def stop(self):
+        # Ends run_loop after the current tick, e.g. from another thread
+        self.running = False
+
+    def log_max_data_sampling_rate(self):
+        # From the time the first PROBE_READS reads took
+        average_ns_per_daq = max(self.probe_ns / PROBE_READS, 1)
+
+        self.daq.log(
+            "Maximum Data rate of plate {} is: {:.2f} hz".format(
+                self.address, 1_000_000_000 / average_ns_per_daq
+            ),
+            event="max_data_rate",
+            plate=self.address,
+            max_data_rate_hz=1_000_000_000 / average_ns_per_daq,
+        )
+
+    def acquire_one_sample(self, channel):
+        return self.backend.read_channel(channel)
+
+    def acquire_all_samples(self):
+        # One call reads all eight inputs of the plate
+        return self.backend.read_all()
+
+    def acquire_samples(self):
+        if self.batched:
+            return np.array(self.acquire_all_samples(), dtype=np.float32)[
+                self.channel_indices
+            ]
+        return np.array(
+            [self.acquire_one_sample(self.channels[0].index)], dtype=np.float32
+        )
+
+    def start_run(self, column, tick_ns, row):
+        channel = self.channels[column]
+        channel.running = True
+        channel.run_start = datetime.fromtimestamp(tick_ns / 1_000_000_000)
+        channel.run_start_ns = tick_ns
+        channel.run_start_row = row
+        channel.run_written_row = row
+        channel.run_missed_deadlines = self.missed_deadlines()
+        channel.stats = RunStats(channel.conversion_factor, tick_ns)
+        self.buffer.journal_run_started(column, tick_ns, row, self.run_rate_since_ns)
+
+    def split_runs(self, tick_ns):
+        # The buffer is full, so every open run is closed here. The columns
+        # that were running are returned to start a new run in a fresh buffer.
+        split = []
+        for column, channel in enumerate(self.channels):
+            if not channel.running:
+                continue
+            self.daq.log(
+                "{} has been running for over {} seconds, splitting the run".format(
+                    channel.name, self.max_run_seconds
+                ),
+                event="run_split",
+                channel=channel.number,
+            )
+            self.queue_run(column, self.buffer.rows, tick_ns)
+            split.append(column)
+        self.buffer.release()
+        self.buffer = None
+        return split
+
+    def record_tick(self, tick_ns, values):
+        row = self.block_rows
+        self.block_times[row] = tick_ns
+        self.block_values[row] = values
+        self.block_rows = row + 1
+        # While idle every reading is checked right away
+        if self.block_rows == self.detection_block_rows or self.sampling_idle:
+            self.record_pending_block()
+
+    def record_pending_block(self):
+        if self.block_rows:
+            rows = self.block_rows
+            self.block_rows = 0
+            self.record_block(self.block_times[:rows], self.block_values[:rows])
+
+    def record_block(self, times, values):
+        events = self.detector.update(times, values)
+        holding = self.detector.holding().any()
+        self.adapt_sample_rate(holding)
+        if self.buffer is None and not holding and not events:
+            return
+        split = []
+        if self.buffer is not None and (
+            self.buffer.rows + len(times) > self.buffer.capacity
+        ):
+            split = self.split_runs(int(times[0]))
+        if self.buffer is None:
+            self.buffer = self.buffer_pool.get()
+            self.buffer.journal_sample_rates(self.idle_rate_hz, self.data_rate_hz)
+        self.buffer.append_block(times, values)
+        for column in split:
+            self.start_run(column, int(times[0]), 0)
+
+        for column, started, transition_ns in events:
+            row = self.buffer.row_at(transition_ns)
+            if started:
+                self.start_run(column, transition_ns, row)
+            else:
+                # Hand the run off and keep sampling
+                self.queue_run(column, row, transition_ns)
+
+        for column, channel in enumerate(self.channels):
+            if not channel.running:
+                continue
+            # Samples after a channel went off only belong to the run if it
+            # turns back on before min_off_seconds
+            end_row = self.buffer.rows
+            if not self.detector.on[column]:
+                end_row = self.buffer.row_at(self.detector.changed_ns[column])
+            if end_row - channel.run_written_row >= self.sample_block_rows:
+                self.flush_samples(column, end_row)
+
+        if not holding:
+            # Clear
+            self.buffer.release()
+            self.buffer = None
+
+    def adapt_sample_rate(self, holding):
+        if self.idle_sample_time == self.one_sample_time:
+            return
+        if holding != self.sampling_idle:
+            return
+        self.sampling_idle = not holding
+        if holding:
+            self.tick_ns = self.one_sample_time
+            self.run_rate_since_ns = time.time_ns()
+        else:
+            self.tick_ns = self.idle_sample_time
+        if self.scheduler is not None:
+            self.scheduler.set_period(self.tick_ns)
+
+    def should_sample_data(self, input_loop_time, one_sample_time):
+        if (time.time_ns() - input_loop_time) > one_sample_time:
+            return True
+        return False
+
+    def get_wait_ns(self, daq_loop_start, daq_loop_end):
+        self.loop_time = daq_loop_end
+        ns_elapsed = daq_loop_end - daq_loop_start
+        wait_ns = self.tick_ns - ns_elapsed
+        return wait_ns
+
+    def busy_wait_until_next_sample(self, now_ns, wait_ns):
+        end_ns = now_ns + wait_ns
+        while time.time_ns() < end_ns:
+            continue
+
+    def run_loop(self):
+        if self.scheduler is not None:
+            self.scheduler.start()
+
+        # running is set by start_daq_loop, so a stop() that comes first wins
+        previous_tick = 0
+        while self.running:
+            daq_loop_start = time.time_ns()
+            values = self.acquire_samples()
+            read_ns = time.time_ns() - daq_loop_start
+            self.read_latency.record(read_ns)
+            if previous_tick:
+                if self.sampling_idle:
+                    self.idle_tick_interval.record(daq_loop_start - previous_tick)
+                else:
+                    self.tick_interval.record(daq_loop_start - previous_tick)
+            previous_tick = daq_loop_start
+            self.ticks += 1
+            self.record_tick(daq_loop_start, values)
+            if self.ticks <= PROBE_READS:
+                self.probe_ns += read_ns
+                if self.ticks == PROBE_READS:
+                    self.log_max_data_sampling_rate()
+
+            # Wait until it is time to sample data again
+            if self.scheduler is not None:
+                self.scheduler.wait_for_next_tick()
+            else:
+                daq_loop_end = time.time_ns()
+                wait_ns = self.get_wait_ns(daq_loop_start, daq_loop_end)
+                if wait_ns < 0:
+                    self.busy_overruns += 1
+                    self.busy_missed_deadlines += -wait_ns // self.tick_ns
+                self.busy_wait_until_next_sample(daq_loop_end, wait_ns)
+
+    def sample_in_thread(self):
+        # A failing plate stops every plate, start_daq_loop raises its error
+        try:
+            self.run_loop()
+        except Exception as e:
+            self.error = e
+            self.daq.stop()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.sample_in_thread,
+            name="plate{}".format(self.address),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def finish(self):
+        # After sampling stopped, hands off the runs still going
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.record_pending_block()
+        for column, channel in enumerate(self.channels):
+            if channel.running:
+                self.queue_run(column, self.buffer.rows, time.time_ns())
 
 
 class DAQ:
-    def __init__(self, data_rate_hz):
-        self.base_dir = os.path.join(os.path.sep, "home", "pi", "home_das")
+    # The shared half of the DAQ: one processing thread, one sample writer and
+    # one database connection for every plate. Each plate is sampled by its
+    # own Plate. The plates share the Pi's SPI bus, so more plates means
+    # fewer reads per second for each (see the plate throughput log).
+    def __init__(
+        self,
+        data_rate_hz,
+        scheduler="busy",
+        channels=None,
+        plots="process",
+        backend=None,
+        base_dir=None,
+        idle_rate_hz=None,
+        plates=None,
+        config=None,
+        defer_startup=False,
+    ):
+        # The pump, sensor and retention settings, home_das.json by default
+        if config is None:
+            config = load_config()
+        self.config = config
+        if base_dir is None:
+            base_dir = config["base_dir"]
+        self.base_dir = base_dir
         self.log_file = "home_das.log"
         self.db_file = "home_das_db.db"
+        # Plots are rendered from the saved run file in a separate process.
+        # It is forked before any of the DAQ's threads, the log writer's
+        # included, exist, so the child can't inherit a lock one of them holds
+        self.plot_renderer = PlotRenderer(
+            self.base_dir,
+            os.path.join(self.base_dir, self.db_file),
+            plots,
+            log=self.log,
+        )
+        self.plot_renderer.start()
+        # Started next so everything below can log
+        self.log_writer = LogWriter(os.path.join(self.base_dir, self.log_file))
+        self.log_writer.start()
         self.current_user = pwd.getpwuid(os.getuid())[0]
         self.septic_data_table = "SEPTIC_data"
         self.water_usage_table = "WATER_USAGE_TABLE"
 
-        self.data_collection_voltage_threshold = 0.1
-        self.das_address = 0
+        self.data_collection_voltage_threshold = config["pump"]["threshold"]
+        self.das_address = config["plate_address"]
         self.data_rate_hz = data_rate_hz
 
-        self.loop_time = 0
+        self.running = False
 
         self.one_sample_time = 1_000_000_000 // data_rate_hz
-        self.tank_elevation = 7458  # Best Guess
-        self.field_elevation = 7558  # Best Guess
-        self.tank_depth = 6  # feet
-        self.pump_distance = 100  # feet
+        # With an idle rate a plate only polls that often until a channel
+        # crosses its threshold, then samples at data_rate_hz until every run
+        # has ended
+        self.idle_rate_hz = idle_rate_hz
+        if idle_rate_hz:
+            self.idle_sample_time = 1_000_000_000 // idle_rate_hz
+        else:
+            self.idle_sample_time = self.one_sample_time
+        pump = config["pump"]
+        self.tank_elevation = pump["tank_elevation"]
+        self.field_elevation = pump["field_elevation"]
+        self.tank_depth = pump["tank_depth"]  # feet
+        self.pump_distance = pump["pump_distance"]  # feet
         self.horizontal_and_vertical_discharge = (
             self.field_elevation
             - self.tank_elevation
             + self.tank_depth
             + self.pump_distance
         )
-        self.head_loss = 10.4  # ft
+        self.head_loss = pump["head_loss"]  # ft
         self.total_dynamic_head = (
             self.field_elevation - self.tank_elevation + self.head_loss
         )
 
-        self.pump_gallons_per_minute = (
-            43.5  # Per Anettes Engineering Docs, gallons per dose should be 107.2
-        )
+        self.pump_gallons_per_minute = pump["gallons_per_minute"]
         self.pump_gallons_per_second = self.pump_gallons_per_minute / 60
-        self.transport_volume = (
-            12.8  # Gallons that drain from the pipe after pumping is complete
-        )
+        # Gallons that drain from the pipe after pumping is complete
+        self.transport_volume = pump["transport_volume"]
 
         self.conversion_factor = self.get_raw_to_voltage_to_amps_conversion_factor()
-        self.samples = []
-        self.sample_times = []
-        self.data_collection_start = 0
+
+        # [(address, channels, backend)], by default the dosing pump on the
+        # DAQC2 plate at das_address
+        if plates is None:
+            if channels is None:
+                channels = [pump_channel(config, self.conversion_factor)]
+            plates = [(self.das_address, channels, backend)]
+
+        # Finished runs are handed to a background thread so sampling never
+        # pauses while a run is saved and graphed
+        self.run_queue_size = 8
+        self.run_queue = queue.Queue(maxsize=self.run_queue_size)
+        self.run_processor = threading.Thread(
+            target=self.process_runs, name="run_processor", daemon=True
+        )
+        # While idle the processor publishes what is running to this file
+        self.live_status_file = "live_status.json"
+        self.live_status_seconds = 1.0
+        self.published_running = True
+        # and logs how fast each plate is being read this often
+        self.throughput_seconds = 60.0
+        self.throughput_logged = time.monotonic()
+        self.throughput_ticks = {}
+
+        # One row of readings per tick is written into a preallocated buffer
+        # while any channel is running. Runs longer than max_run_seconds are
+        # split, which bounds memory even if a sensor gets stuck on. The
+        # buffers are journal files, so a run in progress survives a crash.
+        self.max_run_seconds = 30 * 60
+
+        # Run samples are streamed to SEPTIC_data in blocks of about a second
+        self.sample_writer = SampleWriter(
+            os.path.join(self.base_dir, self.db_file), log=self.log
+        )
+        self.reported_dropped_blocks = 0
+
+        self.plates = []
+        for address, plate_channels, plate_backend in plates:
+            # Where samples come from, the DAQC2 plate unless told otherwise
+            if plate_backend is None:
+                plate_backend = Daqc2Backend(address)
+            self.plates.append(
+                Plate(self, address, plate_channels, plate_backend, scheduler)
+            )
+        self.channels = [channel for plate in self.plates for channel in plate.channels]
+
+        self.metrics = self.init_metrics()
 
         self.startup()
+        # Everything sampling doesn't need. With defer_startup it is started
+        # by start_daq_loop in the background once sampling has begun.
+        self.services_thread = None
+        self.services_started = False
+        self.services_error = None
+        if not defer_startup:
+            self.start_services()
+
+    def start_services(self):
+        from pump_health import PumpHealth
+        from retention import RetentionEngine
+
+        services_start = time.monotonic_ns()
         self.db_connection = self.init_db()
         self.init_septic_data_table()
         self.init_water_usage_table()
+        self.pump_health = PumpHealth(self.db_connection)
+        if self.idle_rate_hz:
+            self.log(
+                "Pump health can't score the inrush of runs first seen at the idle rate, set idle_rate_hz to null to sample it"
+            )
+        # Old samples, rollups and run files are expired or archived in the
+        # background, only while no run is active
+        self.retention = RetentionEngine(
+            os.path.join(self.base_dir, self.db_file),
+            self.base_dir,
+            self.log,
+            self.no_runs_active,
+            **self.config["retention"],
+        )
+        self.sample_writer.start()
+        self.retention.start()
+        self.run_processor.start()
+        self.metrics.start()
+        self.services_started = True
+        for plate in self.plates:
+            plate.recover_journal()
+        self.log(
+            "Database and run processing started in {:.0f} ms".format(
+                (time.monotonic_ns() - services_start) / 1_000_000
+            ),
+            event="services_started",
+        )
+
+    def start_services_in_thread(self):
+        # Sampling can't go on for long without them, a failure stops it and
+        # start_daq_loop raises the error
+        try:
+            self.start_services()
+        except Exception as e:
+            self.services_error = e
+            self.stop()
+
+    def wait_for_services(self):
+        if self.services_thread is not None:
+            self.services_thread.join()
+        elif not self.services_started:
+            self.start_services()
+
+    def no_runs_active(self):
+        return self.run_queue.empty() and not any(
+            channel.running for channel in self.channels
+        )
+
+    def dropped_runs(self):
+        return sum(plate.dropped_runs for plate in self.plates)
+
+    def missed_deadlines(self):
+        return sum(plate.missed_deadlines() for plate in self.plates)
+
+    def overruns(self):
+        return sum(plate.overruns() for plate in self.plates)
 
     def init_db(self):
-        connection = db.connect(
-            os.path.join(self.base_dir, "home_das_db.db"),
-            detect_types=db.PARSE_DECLTYPES | db.PARSE_COLNAMES,
+        from database import connect
+
+        # The connection is created here but only used by the run processor
+        connection = connect(
+            os.path.join(self.base_dir, self.db_file), check_same_thread=False
         )
         return connection
 
@@ -72,210 +759,544 @@ class DAQ:
         self.db_connection.commit()
 
     def init_septic_data_table(self):
-        self.exec_and_commit_sql(
-            "CREATE TABLE IF NOT EXISTS SEPTIC_data(timestamp DATETIME, raw_sensor_voltage NUMERIC, amperage NUMERIC)"
-        )
+        self.sample_writer.init_table(self.db_connection)
 
     def init_water_usage_table(self):
-        self.exec_and_commit_sql(
-            "CREATE TABLE IF NOT EXISTS WATER_USAGE_DATA(timestamp DATETIME, gallons_pumped NUMERIC)"
-        )
+        from run_summaries import init_run_summary_table
+        from water_usage import init_water_usage_tables
+
+        init_water_usage_tables(self.db_connection)
+        init_run_summary_table(self.db_connection)
 
     def startup(self):
         self.log(
             "Startup @ {}. Current user is: {}".format(
                 datetime.now().strftime("%c"), self.current_user
-            )
+            ),
+            event="startup",
+            user=self.current_user,
         )
 
     def shutdown(self):
-        self.db_connection.close()
-        self.log("Graceful Shutdown @ {}".format(datetime.now().strftime("%c")))
+        self.stop()
+        self.wait_for_services()
+        for plate in self.plates:
+            plate.finish()
+        if self.services_started:
+            self.run_queue.put(None)
+            self.run_processor.join()
+            self.sample_writer.stop()
+            self.retention.stop()
+            self.metrics.stop()
+            self.db_connection.close()
+        self.plot_renderer.stop()
+        self.log(
+            "Graceful Shutdown @ {}".format(datetime.now().strftime("%c")),
+            event="shutdown",
+        )
+        self.log_writer.stop()
+
+    def log(self, message, **fields):
+        # Queued, the log writer's thread does the file I/O
+        self.log_writer.log(message, **fields)
 
-    def log(self, message):
-        log_file = open(os.path.join(self.base_dir, self.log_file), "a")
-        print(message)
-        log_file.write("{}\n".format(message))
-        log_file.close()
+    def save_run(self, run, file_time):
+        from run_file import build_header, run_file_path, write_run
+        from waveform import write_run_pyramid
 
-    def save_csv(self, array, fname):
-        np.savetxt(
-            os.path.join(self.base_dir, "{}.csv".format(fname)),
-            array,
-            delimiter=",",
+        header = build_header(
+            run.channel,
+            run.start,
+            run.start_ns,
+            run.end_ns,
+            self.data_rate_hz,
+            len(run.samples),
+            missed_deadlines=run.missed_deadlines,
+            stats=run.stats.summary(),
+            sample_rates=run.sample_rates,
         )
+        path = run_file_path(self.base_dir, file_time)
+        write_run(path, header, run.samples, run.sample_times)
+        write_run_pyramid(path, run.samples, run.sample_times)
+        return path
 
     def get_raw_to_voltage_to_amps_conversion_factor(self):
-        vin_min = 0.0
-        vin_max = 10.0
-        amps_min = 0.0
-        amps_max = 50.0
-
-        return (amps_max - amps_min) / (vin_max - vin_min)
+        return get_raw_to_voltage_to_amps_conversion_factor(**self.config["sensor"])
 
     def convert_raw_voltage_to_amps(self, raw_voltage):
         return raw_voltage * self.get_raw_to_voltage_to_amps_conversion_factor()
 
-    def parse_save_and_graph_data(self):
-        compute_start = time.time_ns()
-        # Parse the data, save it, clear it
-        # Parse
-        seconds = (time.time_ns() - self.data_collection_start) / 1000000000
-        raw_samples = copy.copy(self.samples)
-        samples = np.array(self.samples)
-        # Convert everything to amperage
-        samples = samples * self.conversion_factor
-        max_amps = np.max(samples)
-        average_amps = np.average(samples)
-        start_time = self.now.strftime("%Y%m%d-%H:%M:%S")
-        pumped_gallons = (
-            seconds * self.pump_gallons_per_second
-        ) - self.transport_volume
-
-        # Save
-        self.log(
-            "{}: Dosing pump ran for {:.2f} seconds, pumped {:.2f} gallons with a max amperage of {:.2f}A, an average amperage of {:.2f}A, and an average wattage of {:.2f}W".format(
-                start_time,
-                seconds,
-                pumped_gallons,
-                max_amps,
-                average_amps,
-                average_amps * 120.0,
+    def init_metrics(self):
+        # Recorded by the sampling loops, written out every 10s
+        metrics = MetricsExporter(
+            os.path.join(self.base_dir, "metrics.prom"), log=self.log
+        )
+        for plate in self.plates:
+            plate.add_metrics(metrics)
+        metrics.add_histogram(
+            "home_das_sample_flush_ns",
+            "Time to write a batch of samples to SEPTIC_data",
+            self.sample_writer.flush_latency,
+        )
+        metrics.add_counter(
+            "home_das_dropped_runs_total",
+            "Runs dropped because the processing queue was full",
+            self.dropped_runs,
+        )
+        metrics.add_counter(
+            "home_das_dropped_sample_blocks_total",
+            "Sample blocks dropped because the sample writer fell behind",
+            lambda: self.sample_writer.dropped_blocks,
+        )
+        metrics.add_counter(
+            "home_das_sample_rows_written_total",
+            "Rows written to SEPTIC_data",
+            lambda: self.sample_writer.rows_written,
+        )
+        for name, depth in (
+            ("run_processing", self.run_queue.qsize),
+            ("sample_writer", self.sample_writer.queue.qsize),
+            ("log_writer", self.log_writer.queue.qsize),
+        ):
+            metrics.add_gauge(
+                "home_das_queue_depth", "Items waiting", depth, {"queue": name}
             )
+        metrics.add_counter(
+            "home_das_cpu_seconds_total", "CPU time of the DAQ", time.process_time
         )
-
-        cursor = self.db_connection.cursor()
-        cursor.execute(
-            "INSERT INTO WATER_USAGE_DATA(timestamp, gallons_pumped) VALUES(?, ?)",
-            (self.now, pumped_gallons),
+        metrics.add_gauge(
+            "home_das_load_average", "1 minute load average", lambda: os.getloadavg()[0]
         )
+        return metrics
 
-        self.save_csv(samples, start_time)
-        self.save_csv(raw_samples, "RAW_{}".format(start_time))
-        self.save_csv(self.sample_times, "NS_{}".format(start_time))
+    def live_status(self):
+        status = []
+        for channel in self.channels:
+            stats = channel.stats
+            if not channel.running or stats is None:
+                continue
+            status.append(
+                {
+                    "channel": channel.number,
+                    "name": channel.name,
+                    "running_seconds": stats.seconds(time.time_ns()),
+                    "amps": stats.last_amps,
+                    "average_amps": stats.amps.mean,
+                    "max_amps": stats.amps.max if stats.amps.count else None,
+                    "amp_seconds": stats.amp_seconds,
+                }
+            )
+        return status
 
-        plt.plot(samples)
-        plt.ylabel("Amps")
-        plt.title("Septic Pump Run - {}".format(start_time))
-        plt.savefig(os.path.join(self.base_dir, "Amperage-{}.png".format(start_time)))
-        plt.close()
+    def publish_live_status(self):
+        status = self.live_status()
+        if not status and not self.published_running:
+            return
+        path = os.path.join(self.base_dir, self.live_status_file)
+        with open("{}.tmp".format(path), "w") as status_file:
+            json.dump({"updated": time.time(), "running": status}, status_file)
+        os.replace("{}.tmp".format(path), path)
+        self.published_running = bool(status)
 
-        plt.scatter(self.sample_times, samples, marker="x", s=1, linewidths=0)
-        plt.xlabel("Nanoseconds")
-        plt.ylabel("Amps")
-        plt.title("Dosing Tank Pump Run - Amps vs Nanoseconds - {}".format(start_time))
-        plt.savefig(os.path.join(self.base_dir, "AmpsVsNS-{}.png".format(start_time)))
-        plt.close()
+    def process_runs(self):
+        while True:
+            try:
+                run = self.run_queue.get(timeout=self.live_status_seconds)
+            except queue.Empty:
+                self.publish_live_status()
+                if time.monotonic() - self.throughput_logged >= self.throughput_seconds:
+                    self.log_plate_throughput()
+                continue
+            if run is None:
+                break
+            try:
+                self.parse_save_and_graph_data(run)
+            except Exception as e:
+                self.log(
+                    "Processing run from {} failed: {}".format(
+                        run.start.strftime("%Y%m%d-%H:%M:%S"), e
+                    )
+                )
+            finally:
+                run.release()
 
-        # Water Usage
+    def parse_save_and_graph_data(self, run):
+        from run_summaries import insert_run_summary
 
-        cursor.execute(
-            "SELECT * FROM WATER_USAGE_DATA",
-        )
+        compute_start = time.time_ns()
+        # Parse the data, save it
+        # Parse
+        channel = run.channel
+        seconds = (run.end_ns - run.start_ns) / 1000000000
+        # Amperage statistics were gathered while the run was in progress
+        max_amps = run.stats.amps.max
+        average_amps = run.stats.amps.mean
+        start_time = run.start.strftime("%Y%m%d-%H:%M:%S")
+        file_time = "{}{}".format(channel.file_prefix, start_time)
 
-        # What order are these in?
-        water_data = cursor.fetchall()
-        self.db_connection.commit()
-        print("Water data: ", water_data)
-        water_data_timestamps = [i[0] for i in water_data]
-        water_data_gallons_pumped = [i[1] for i in water_data]
-        water_data_gallons_pumped = np.cumsum(water_data_gallons_pumped)
-        print("Pump Timestamps: ", water_data_timestamps)
-        print("Gallons pumped: ", water_data_gallons_pumped)
+        run_fields = {
+            "event": "run",
+            "run_id": file_time,
+            "channel": channel.number,
+            "name": channel.name,
+            "start": run.start.isoformat(),
+            "seconds": seconds,
+            "samples": len(run.samples),
+            "max_amps": max_amps,
+            "average_amps": average_amps,
+            "amp_seconds": run.stats.amp_seconds,
+        }
+
+        # Save
+        if channel.tracks_water_usage():
+            pumped_gallons = channel.pumped_gallons(seconds)
+            run_fields["gallons"] = pumped_gallons
+            self.log(
+                "{}: {} ran for {:.2f} seconds, pumped {:.2f} gallons with a max amperage of {:.2f}A, an average amperage of {:.2f}A, and an average wattage of {:.2f}W".format(
+                    start_time,
+                    channel.name,
+                    seconds,
+                    pumped_gallons,
+                    max_amps,
+                    average_amps,
+                    average_amps * 120.0,
+                ),
+                **run_fields,
+            )
+        else:
+            self.log(
+                "{}: {} ran for {:.2f} seconds with a max amperage of {:.2f}A, an average amperage of {:.2f}A, and an average wattage of {:.2f}W".format(
+                    start_time,
+                    channel.name,
+                    seconds,
+                    max_amps,
+                    average_amps,
+                    average_amps * 120.0,
+                ),
+                **run_fields,
+            )
+
+        run_path = self.save_run(run, file_time)
+
+        if channel.tracks_water_usage():
+            self.update_water_usage(run.start, pumped_gallons)
+
+        self.score_pump_health(run, file_time, seconds)
+
+        # Graph
+        self.plot_renderer.render_run(run_path, file_time)
 
         # Data Analysis
-        time_btw_samples = np.diff(np.array(self.sample_times))
-        data_analysis_text = "The average time between samples is: {}ns, std dev is: {}ns, it should be {}ns".format(
-            np.average(time_btw_samples),
-            np.std(time_btw_samples),
+        data_analysis_text = "The average time between samples is: {}ns, std dev is: {}ns, it should be {}ns, missed {} sample deadline(s)".format(
+            run.stats.intervals.mean,
+            run.stats.intervals.std(),
             self.one_sample_time,
+            run.missed_deadlines,
         )
-        self.log(data_analysis_text)
+        self.log(
+            data_analysis_text,
+            event="sample_timing",
+            run_id=file_time,
+            interval_mean_ns=run.stats.intervals.mean,
+            interval_std_ns=run.stats.intervals.std(),
+            expected_interval_ns=self.one_sample_time,
+            missed_deadlines=run.missed_deadlines,
+        )
+        if len(run.sample_rates) > 1:
+            self.log(
+                "The run was first sampled at {} hz, then at {} hz after {:.3f} seconds".format(
+                    run.sample_rates[0][1],
+                    run.sample_rates[1][1],
+                    run.sample_rates[1][0],
+                ),
+                event="sample_rate",
+                run_id=file_time,
+                sample_rates=run.sample_rates,
+            )
+
+        dropped_blocks = self.sample_writer.dropped_blocks
+        if dropped_blocks > self.reported_dropped_blocks:
+            self.log(
+                "The sample writer fell behind and dropped {} block(s) of samples".format(
+                    dropped_blocks - self.reported_dropped_blocks
+                ),
+                event="dropped_samples",
+                blocks=dropped_blocks - self.reported_dropped_blocks,
+            )
+            self.reported_dropped_blocks = dropped_blocks
 
         compute_end = time.time_ns()
-        compute_log = "Parsing, Logging, Saving, and Graphing took {} ms".format(
-            (compute_end - compute_start) / 1000000
+        processing_ms = (compute_end - compute_start) / 1000000
+        compute_log = "Parsing, Logging, and Saving took {} ms".format(processing_ms)
+        self.log(
+            compute_log,
+            event="processing",
+            run_id=file_time,
+            processing_ms=processing_ms,
+        )
+        insert_run_summary(
+            self.db_connection,
+            {
+                "run_id": file_time,
+                "start": run.start,
+                "channel": channel.number,
+                "name": channel.name,
+                "seconds": seconds,
+                "samples": len(run.samples),
+                "gallons_pumped": run_fields.get("gallons"),
+                "max_amperage": max_amps,
+                "average_amperage": average_amps,
+                "conversion_factor": channel.conversion_factor,
+                "interval_mean_ns": run.stats.intervals.mean,
+                "interval_std_ns": run.stats.intervals.std(),
+                "processing_ms": processing_ms,
+                "run_file": os.path.basename(run_path),
+            },
         )
-        self.log(compute_log)
         return
 
-    def log_max_data_sampling_rate(self, channel):
-        max_data_rate_hz_start = time.time_ns()
-        max_data_rate_samples = 0
-        for i in range(10):
-            self.acquire_one_sample(channel)
-            max_data_rate_samples = max_data_rate_samples + 1
-
-        max_data_rate_hz_end = time.time_ns()
-        average_ns_per_daq = (
-            max_data_rate_hz_end - max_data_rate_hz_start
-        ) / max_data_rate_samples
+    def score_pump_health(self, run, file_time, seconds):
+        from pump_health import FEATURES, health_features
 
+        scoring_start = time.time_ns()
+        features = health_features(
+            run.samples * run.channel.conversion_factor,
+            run.sample_times,
+            seconds,
+            run.sample_rates,
+        )
+        z, score, anomalous = self.pump_health.score(
+            file_time, run.start, run.channel.number, features
+        )
+        scoring_ms = (time.time_ns() - scoring_start) / 1000000
+        # Nothing to report while the channel's baseline is being built
+        if score is None:
+            return
+        message = "Pump health score {:.2f}".format(score)
+        if anomalous:
+            worst = np.nanargmax(np.abs(z))
+            message = (
+                "{} ran unusually, {} is {:.1f} std devs from its baseline".format(
+                    run.channel.name, FEATURES[worst], z[worst]
+                )
+            )
         self.log(
-            "Maximum Data rate is: {:.2f} hz".format(1_000_000_000 / average_ns_per_daq)
+            message,
+            event="pump_health",
+            run_id=file_time,
+            score=score,
+            anomalous=anomalous,
+            features=dict(zip(FEATURES, features.tolist())),
+            z_scores=dict(zip(FEATURES, z.tolist())),
+            scoring_ms=scoring_ms,
         )
 
-    def acquire_one_sample(self, channel):
-        return das.getADC(self.das_address, channel)
+    def update_water_usage(self, start, pumped_gallons):
+        from water_usage import insert_water_usage, total_water_usage
 
-    def should_sample_data(self, input_loop_time, one_sample_time):
-        if (time.time_ns() - input_loop_time) > one_sample_time:
-            return True
-        return False
+        # Inserts the run and updates the rollups in one transaction
+        if not insert_water_usage(self.db_connection, start, pumped_gallons):
+            self.log(
+                "The run from {} is already in the water usage".format(
+                    start.strftime("%Y%m%d-%H:%M:%S")
+                )
+            )
+            return
 
-    def get_wait_ns(self, daq_loop_start, daq_loop_end):
-        self.loop_time = daq_loop_end
-        ns_elapsed = daq_loop_end - daq_loop_start
-        wait_ns = self.one_sample_time - ns_elapsed
-        return wait_ns
+        # Water Usage
+        total_gallons, total_runs = total_water_usage(self.db_connection)
+        self.log(
+            "Gallons pumped: {:.2f} over {} runs".format(total_gallons, total_runs),
+            event="water_usage",
+            total_gallons=total_gallons,
+            total_runs=total_runs,
+        )
 
-    def busy_wait_until_next_sample(self, now_ns, wait_ns):
-        end_ns = now_ns + wait_ns
-        while time.time_ns() < end_ns:
-            continue
+    def log_plate_throughput(self):
+        now = time.monotonic()
+        elapsed = now - self.throughput_logged
+        self.throughput_logged = now
+        for plate in self.plates:
+            ticks = plate.ticks - self.throughput_ticks.get(plate.address, 0)
+            self.throughput_ticks[plate.address] = plate.ticks
+            read_latency_ns = plate.read_latency.quantiles((0.5,))[0]
+            self.log(
+                "Plate {} read {:.1f} times/s ({:.1f} samples/s), median read took {:.0f}us".format(
+                    plate.address,
+                    ticks / elapsed,
+                    ticks * len(plate.channels) / elapsed,
+                    read_latency_ns / 1000,
+                ),
+                event="plate_throughput",
+                plate=plate.address,
+                reads_per_second=ticks / elapsed,
+                samples_per_second=ticks * len(plate.channels) / elapsed,
+                read_latency_p50_ns=read_latency_ns,
+            )
+
+    def stop(self):
+        # Ends start_daq_loop after the current tick, e.g. from another thread
+        self.running = False
+        for plate in self.plates:
+            plate.stop()
 
-    def start_daq_loop(self, channel):
+    def start_daq_loop(self):
         self.log("Monitoring data at {} sample(s) per second".format(self.data_rate_hz))
-        self.log("Amperage conversion factor is: {}".format(self.conversion_factor))
+        if self.idle_rate_hz:
+            self.log(
+                "Polling at {} sample(s) per second while no pump is running, runs miss their inrush and max amperage".format(
+                    self.idle_rate_hz
+                )
+            )
+        for channel in self.channels:
+            self.log(
+                "Channel {} ({}) amperage conversion factor is: {}, threshold is: {}V on, {}V off, debounced {}s on, {}s off".format(
+                    channel.number,
+                    channel.name,
+                    channel.conversion_factor,
+                    channel.threshold,
+                    channel.off_threshold,
+                    channel.min_on_seconds,
+                    channel.min_off_seconds,
+                )
+            )
+
+        self.log(
+            "Runs are split after {} seconds, run buffers use at most {:.1f} MB".format(
+                self.max_run_seconds,
+                sum(plate.buffer_pool.max_nbytes() for plate in self.plates)
+                / 1_000_000,
+            )
+        )
 
-        self.now = datetime.now()
         self.log("Starting Data Monitoring...")
 
-        while True:
-            daq_loop_start = time.time_ns()
-            data = self.acquire_one_sample(channel)
-
-            if data > self.data_collection_voltage_threshold:
-                if self.data_collection_start == 0:
-                    self.now = datetime.now()
-                    self.data_collection_start = daq_loop_start
-                self.samples.append(data)
-                self.sample_times.append(daq_loop_start)
-            else:
-                if len(self.samples) > 0:
-                    self.parse_save_and_graph_data()
+        self.running = True
+        for plate in self.plates:
+            plate.running = True
+        if not self.services_started and self.services_thread is None:
+            self.services_thread = threading.Thread(
+                target=self.start_services_in_thread, name="startup", daemon=True
+            )
+            self.services_thread.start()
 
-                    # Clear
-                    self.samples = []
-                    self.sample_times = []
-                    self.data_collection_start = 0
+        if len(self.plates) == 1:
+            self.plates[0].run_loop()
+        else:
+            for plate in self.plates:
+                plate.start()
+            for plate in self.plates:
+                # A timeout so KeyboardInterrupt still reaches this thread
+                while plate.thread.is_alive():
+                    plate.thread.join(0.5)
+        for plate in self.plates:
+            if plate.error is not None:
+                raise plate.error
+        if self.services_error is not None:
+            raise self.services_error
 
-            # Wait until it is time to sample data again
-            daq_loop_end = time.time_ns()
-            wait_ns = self.get_wait_ns(daq_loop_start, daq_loop_end)
-            self.busy_wait_until_next_sample(daq_loop_end, wait_ns)
-
-
-DATA_RATE_HZ = 120
-PI_PLATE_ADDRESS = 0
-daq = DAQ(DATA_RATE_HZ)
-
-try:
-    daq.log_max_data_sampling_rate(PI_PLATE_ADDRESS)
-    daq.start_daq_loop(PI_PLATE_ADDRESS)
-except (KeyboardInterrupt, SystemExit):
-    daq.shutdown()
-except Exception as e:
-    daq.log(e)
-    daq.shutdown()
-    raise
+
+def make_backend(args, address):
+    if args.backend == "replay":
+        if args.replay_file is None:
+            raise SystemExit("--backend replay needs --replay-file")
+        return ReplayBackend(args.replay_file, speed=args.speed)
+    if args.backend == "synthetic":
+        return SyntheticBackend(speed=args.speed)
+    return Daqc2Backend(address)
+
+
+def make_plates(args, config):
+    # None monitors the plate at plate_address: the dosing pump on channel 0,
+    # or every named channel of data_schema in one batched call. plates
+    # samples each {address: data_schema} in its own thread.
+    if config["plates"] is None:
+        if not config["data_schema"]:
+            return None
+        address = config["plate_address"]
+        return [
+            (
+                address,
+                channels_from_schema(config["data_schema"]),
+                make_backend(args, address),
+            )
+        ]
+    return [
+        (
+            int(address),
+            channels_from_schema(schema, int(address)),
+            make_backend(args, int(address)),
+        )
+        for address, schema in sorted(
+            config["plates"].items(), key=lambda item: int(item[0])
+        )
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Home DAS data acquisition")
+    parser.add_argument(
+        "--config", help="Settings file, home_das.json next to main2.py by default"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["daqc2", "replay", "synthetic"],
+        default="daqc2",
+        help="Read the DAQC2 plate, replay a recorded run or generate pump runs",
+    )
+    parser.add_argument(
+        "--replay-file", help="A .run file or RAW_<ts>.csv (with its NS_<ts>.csv)"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="How many times faster than real time replayed or synthetic runs play",
+    )
+    parser.add_argument("--rate", type=int, help="Samples/s, overrides the config")
+    parser.add_argument(
+        "--scheduler",
+        choices=["busy", "deadline"],
+        help="How the loop waits for the next sample, overrides the config",
+    )
+    parser.add_argument(
+        "--idle-rate",
+        type=int,
+        help="Samples/s while no pump is running, 0 to always sample at --rate",
+    )
+    parser.add_argument("--base-dir", help="Where logs, runs and the database live")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    # The sampling threads share the GIL with run processing and the writers.
+    # Python only asks a thread to give it up every 5 ms by default, which is
+    # most of a sample interval at 120 Hz, so ask every 0.5 ms instead. Set
+    # here for the whole process rather than by DAQ, which other tools build.
+    sys.setswitchinterval(0.0005)
+    plates = make_plates(args, config)
+    # The single plate's backend, only when no plates are configured, so a
+    # replay file isn't loaded (or a plate opened) twice
+    backend = None
+    if plates is None:
+        backend = make_backend(args, config["plate_address"])
+    daq = DAQ(
+        args.rate or config["data_rate_hz"],
+        args.scheduler or config["scheduler"],
+        None,
+        config["plots"],
+        backend,
+        args.base_dir,
+        config["idle_rate_hz"] if args.idle_rate is None else args.idle_rate,
+        plates,
+        config,
+        defer_startup=True,
+    )
+
+    try:
+        daq.start_daq_loop()
+    except (KeyboardInterrupt, SystemExit):
+        daq.shutdown()
+    except Exception as e:
+        daq.log(e)
+        daq.shutdown()
+        raise
@@ -0,0 +1,140 @@
+import os
+import threading
+
+# Cheap enough to stay on in the sampling loop. LatencyHistogram keeps
+# HDR-style log-linear buckets: values below 2**SUB_BUCKET_BITS get a bucket
+# each, larger ones are bucketed with SUB_BUCKET_BITS - 1 significant bits
+# (~3% resolution), so recording is a bit_length, two shifts and an add.
+#
+# MetricsExporter writes everything in the Prometheus text format to a file
+# every flush_seconds, e.g. for node_exporter's textfile collector, and once
+# more on stop().
+
+SUB_BUCKET_BITS = 5
+# Enough buckets for anything up to 2**64 ns
+BUCKETS = (64 - SUB_BUCKET_BITS + 1) << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value):
+    exponent = max(value.bit_length() - SUB_BUCKET_BITS, 0)
+    return (exponent << SUB_BUCKET_BITS) | (value >> exponent)
+
+
+def bucket_upper_bound(index):
+    exponent = index >> SUB_BUCKET_BITS
+    sub_bucket = index & ((1 << SUB_BUCKET_BITS) - 1)
+    return ((sub_bucket + 1) << exponent) - 1
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantiles(self, quantiles=QUANTILES):
+        # Upper bounds of the buckets the quantiles fall in
+        counts = list(self.counts)
+        total = sum(counts)
+        results = []
+        seen = 0
+        index = 0
+        for quantile in quantiles:
+            target = quantile * total
+            while index < len(counts) - 1 and seen + counts[index] < target:
+                seen += counts[index]
+                index += 1
+            results.append(min(bucket_upper_bound(index), self.max) if total else 0)
+        return results
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, value) for name, value in sorted(labels.items())
+        )
+    )
+
+
+class MetricsExporter:
+    def __init__(self, path, flush_seconds=10.0, log=print):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.log = log
+        # name -> (type, help, [(labels, source)])
+        self.metrics = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.export_metrics, name="metrics_exporter", daemon=True
+        )
+
+    def add(self, kind, name, help_text, source, labels=None):
+        metric = self.metrics.setdefault(name, (kind, help_text, []))
+        metric[2].append((labels or {}, source))
+
+    def add_counter(self, name, help_text, source, labels=None):
+        # source is a function returning the current value
+        self.add("counter", name, help_text, source, labels)
+
+    def add_gauge(self, name, help_text, source, labels=None):
+        self.add("gauge", name, help_text, source, labels)
+
+    def add_histogram(self, name, help_text, histogram, labels=None):
+        self.add("summary", name, help_text, histogram, labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, series) in self.metrics.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, source in series:
+                if kind != "summary":
+                    lines.append(
+                        "{}{} {}".format(name, format_labels(labels), source())
+                    )
+                    continue
+                for quantile, value in zip(QUANTILES, source.quantiles()):
+                    quantile_labels = dict(labels, quantile=quantile)
+                    lines.append(
+                        "{}{} {}".format(name, format_labels(quantile_labels), value)
+                    )
+                lines.append(
+                    "{}_sum{} {}".format(name, format_labels(labels), source.sum)
+                )
+                lines.append(
+                    "{}_count{} {}".format(name, format_labels(labels), source.count)
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        with open("{}.tmp".format(self.path), "w") as metrics_file:
+            metrics_file.write(self.render())
+        os.replace("{}.tmp".format(self.path), self.path)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def export_metrics(self):
+        while not self.stopped.wait(self.flush_seconds):
+            try:
+                self.write()
+            except Exception as e:
+                self.log("Writing metrics failed: {}".format(e))
+        self.write()
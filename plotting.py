@@ -0,0 +1,203 @@
+import argparse
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+# matplotlib is only imported inside the plotting process (or by the command
+# line below), never by the DAQ itself. The run file, waveform and database
+# modules are only imported where plots are rendered too, so main2.py can
+# start sampling without them.
+
+RUN_PLOTS = ("amperage", "amps_vs_ns", "sample_times")
+PLOT_PREFIXES = {
+    "amperage": "Amperage",
+    "amps_vs_ns": "AmpsVsNS",
+    "sample_times": "SampleTimes",
+    "water_usage": "WaterUsage",
+}
+DEFAULT_PLOTS = ("amperage", "amps_vs_ns")
+# A 640px wide figure can't show more than this many points anyway
+DEFAULT_MAX_POINTS = 2000
+
+
+def pyplot():
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def plot_path(base_dir, kind, file_time):
+    return os.path.join(base_dir, "{}-{}.png".format(PLOT_PREFIXES[kind], file_time))
+
+
+def render_run_plots(
+    run_path, base_dir, file_time, plots=DEFAULT_PLOTS, max_points=DEFAULT_MAX_POINTS
+):
+    from run_file import read_run
+    from waveform import decimate_min_max, run_waveform
+
+    render_start = time.time_ns()
+    plt = pyplot()
+    # The pyramid level that fits max_points, not every sample
+    header, rows, times, amps = run_waveform(run_path, max_points)
+    name = header["name"]
+    start_time = header["start"]
+
+    if "amperage" in plots:
+        plt.plot(rows, amps)
+        plt.ylabel("Amps")
+        plt.title("{} Run - {}".format(name, start_time))
+        plt.savefig(plot_path(base_dir, "amperage", file_time))
+        plt.close()
+
+    if "amps_vs_ns" in plots:
+        plt.scatter(times, amps, marker="x", s=1, linewidths=0)
+        plt.xlabel("Nanoseconds")
+        plt.ylabel("Amps")
+        plt.title("{} Run - Amps vs Nanoseconds - {}".format(name, start_time))
+        plt.savefig(plot_path(base_dir, "amps_vs_ns", file_time))
+        plt.close()
+
+    if "sample_times" in plots:
+        x, y = decimate_min_max(read_run(run_path)[2], max_points)
+        plt.plot(x, y)
+        plt.ylabel("Sample Time (ns)")
+        plt.title("Sample Times - {}".format(start_time))
+        plt.savefig(plot_path(base_dir, "sample_times", file_time))
+        plt.close()
+
+    return (time.time_ns() - render_start) / 1_000_000
+
+
+def render_water_usage_plot(db_path, base_dir, file_time):
+    import sqlite3 as db
+
+    render_start = time.time_ns()
+    plt = pyplot()
+    connection = db.connect(db_path)
+    rows = connection.execute(
+        "SELECT day, gallons_pumped FROM WATER_USAGE_DAILY ORDER BY day"
+    ).fetchall()
+    connection.close()
+    if rows:
+        days = np.array([np.datetime64(row[0]) for row in rows])
+        gallons = np.cumsum([row[1] for row in rows])
+        plt.plot(days, gallons)
+        plt.ylabel("Gallons")
+        plt.title("Water Usage: {} - {}".format(rows[0][0], rows[-1][0]))
+        plt.savefig(plot_path(base_dir, "water_usage", file_time))
+        plt.close()
+    return (time.time_ns() - render_start) / 1_000_000
+
+
+def start_plotting_process():
+    # Plots are the lowest priority work on the Pi, and Ctrl-C is left to the
+    # DAQ, which shuts this process down once pending plots are done
+    os.nice(10)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class PlotRenderer:
+    # Renders plots in one separate process so they never hold the DAQ's GIL.
+    # mode is "process" to render every run as it is saved, or "off" to only
+    # render on request with `python3 plotting.py <run file>`.
+    def __init__(
+        self,
+        base_dir,
+        db_path,
+        mode="process",
+        plots=DEFAULT_PLOTS,
+        max_points=DEFAULT_MAX_POINTS,
+        log=print,
+    ):
+        if mode not in ("process", "off"):
+            raise ValueError("Unknown plot mode: {}".format(mode))
+        self.base_dir = base_dir
+        self.db_path = db_path
+        self.mode = mode
+        self.plots = tuple(plots)
+        self.max_points = max_points
+        self.log = log
+        self.executor = None
+
+    def start(self):
+        if self.mode == "off":
+            return
+        # Forked now, so call it before starting any threads, and kept for
+        # reuse
+        self.executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=get_context("fork"),
+            initializer=start_plotting_process,
+        )
+        self.executor.submit(time.time).result()
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def log_result(self, description):
+        def done(future):
+            try:
+                self.log("Graphing {} took {} ms".format(description, future.result()))
+            except Exception as e:
+                self.log("Graphing {} failed: {}".format(description, e))
+
+        return done
+
+    def render_run(self, run_path, file_time):
+        if self.executor is None:
+            return
+        run_plots = tuple(kind for kind in self.plots if kind in RUN_PLOTS)
+        if run_plots:
+            future = self.executor.submit(
+                render_run_plots,
+                run_path,
+                self.base_dir,
+                file_time,
+                run_plots,
+                self.max_points,
+            )
+            future.add_done_callback(self.log_result(file_time))
+        if "water_usage" in self.plots:
+            future = self.executor.submit(
+                render_water_usage_plot, self.db_path, self.base_dir, file_time
+            )
+            future.add_done_callback(
+                self.log_result("water usage for {}".format(file_time))
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render plots for saved runs")
+    parser.add_argument("run_files", nargs="+", help="Run files to plot")
+    parser.add_argument(
+        "--plots",
+        nargs="+",
+        choices=RUN_PLOTS,
+        default=list(DEFAULT_PLOTS),
+        help="Which plots to render",
+    )
+    parser.add_argument("--max-points", type=int, default=DEFAULT_MAX_POINTS)
+    args = parser.parse_args()
+
+    from run_file import RUN_FILE_EXTENSION
+
+    for run_path in args.run_files:
+        file_time = os.path.basename(run_path)[: -len(RUN_FILE_EXTENSION)]
+        milliseconds = render_run_plots(
+            run_path,
+            os.path.dirname(os.path.abspath(run_path)),
+            file_time,
+            args.plots,
+            args.max_points,
+        )
+        print("Graphing {} took {} ms".format(file_time, milliseconds))
@@ -0,0 +1,230 @@
+import argparse
+import os
+import sqlite3 as db
+from datetime import datetime
+
+import numpy as np
+from run_features import inrush_peak, started_at_idle_rate
+from run_file import RUN_FILE_EXTENSION, RUN_TIME_FORMAT, read_amps, read_header
+
+# Scores every finished run against a rolling baseline of the channel's past
+# runs, so a run like the 26 second / 21.5A ones among the usual 185 second
+# ones stands out without anyone reading the log.
+#
+# Each run is reduced to FEATURES: inrush peak amps, steady amps (mean of the
+# middle half), seconds, and spectral energy, the power of the steady part's
+# amperage above SPECTRAL_MIN_HZ relative to its mean squared (a worn or
+# clogged pump ripples more). The baseline keeps an exponentially weighted
+# mean and variance of each, an average of the runs so far until there have
+# been BASELINE_RUNS, and is updated in place with every run, never
+# recomputed from the archive. Outliers are clipped to ANOMALY_SCORE before
+# they are added so a bad run can't drag the baseline along with it.
+#
+# A run's score is its largest |z| over the features and a score over
+# ANOMALY_SCORE marks it anomalous. Until the baseline has MIN_BASELINE_RUNS
+# runs its variances mean nothing yet, so those runs only add to it and get a
+# NULL score. A run first seen at the idle rate has no inrush peak (NaN), it
+# is left out of that run's score and of the inrush baseline. Scores go into
+# PUMP_HEALTH_SCORES, keyed by run id with the same timestamp as the run's
+# WATER_USAGE_DATA row, in the transaction that updates PUMP_HEALTH_BASELINE.
+
+FEATURES = ("inrush_amps", "steady_amps", "seconds", "spectral_energy")
+BASELINE_RUNS = 50
+MIN_BASELINE_RUNS = 10
+ANOMALY_SCORE = 4.0
+# Keeps a feature that has never varied from scoring everything as anomalous
+MIN_RELATIVE_STD = 0.01
+SPECTRAL_SAMPLES = 4096
+SPECTRAL_MIN_HZ = 1.0
+
+
+def steady_part(values):
+    quarter = len(values) // 4
+    return values[quarter : len(values) - quarter]
+
+
+def spectral_energy(amps, times):
+    # At most SPECTRAL_SAMPLES from the middle of the run, so the FFT costs
+    # the same for any run length
+    amps = steady_part(amps)
+    times = steady_part(times)
+    start = max((len(amps) - SPECTRAL_SAMPLES) // 2, 0)
+    amps = np.asarray(amps[start : start + SPECTRAL_SAMPLES], dtype=float)
+    times = times[start : start + SPECTRAL_SAMPLES]
+    if len(amps) < 16:
+        return 0.0
+    interval_s = float(np.median(np.diff(times))) / 1_000_000_000
+    mean = amps.mean()
+    if interval_s <= 0 or mean == 0:
+        return 0.0
+    power = np.abs(np.fft.rfft(amps - mean)) ** 2 / len(amps) ** 2
+    frequencies = np.fft.rfftfreq(len(amps), interval_s)
+    return float(power[frequencies >= SPECTRAL_MIN_HZ].sum() / mean**2)
+
+
+def health_features(amps, times, seconds, sample_rates=None):
+    if len(amps) == 0:
+        return np.zeros(len(FEATURES))
+    steady = steady_part(amps)
+    if started_at_idle_rate(sample_rates):
+        inrush = float("nan")
+    else:
+        inrush = inrush_peak(amps, times)
+    return np.array(
+        [
+            inrush,
+            float(np.mean(steady)) if len(steady) else float(np.mean(amps)),
+            seconds,
+            spectral_energy(amps, times),
+        ]
+    )
+
+
+def none_for_nan(values):
+    # NaN as NULL in the tables
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+
+class PumpHealth:
+    # Baselines are cached per channel and written back with each score
+    def __init__(self, connection):
+        self.connection = connection
+        self.init_tables()
+        # channel -> [runs, means, variances]
+        self.baselines = {}
+        columns = ", ".join("{0}_mean, {0}_var".format(feature) for feature in FEATURES)
+        for row in connection.execute(
+            "SELECT channel, runs, {} FROM PUMP_HEALTH_BASELINE".format(columns)
+        ):
+            values = np.array(row[2:], dtype=float)
+            self.baselines[row[0]] = [row[1], values[0::2], values[1::2]]
+
+    def init_tables(self):
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS PUMP_HEALTH_BASELINE(channel INTEGER PRIMARY KEY, runs INTEGER, {})".format(
+                    ", ".join(
+                        "{0}_mean NUMERIC, {0}_var NUMERIC".format(feature)
+                        for feature in FEATURES
+                    )
+                )
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS PUMP_HEALTH_SCORES(run_id TEXT PRIMARY KEY, timestamp DATETIME, channel INTEGER, {}, {}, score NUMERIC, anomalous INTEGER)".format(
+                    ", ".join("{} NUMERIC".format(feature) for feature in FEATURES),
+                    ", ".join("{}_z NUMERIC".format(feature) for feature in FEATURES),
+                )
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS PUMP_HEALTH_SCORES_timestamp ON PUMP_HEALTH_SCORES(timestamp)"
+            )
+
+    def z_scores(self, channel, features):
+        baseline = self.baselines.get(channel)
+        if baseline is None:
+            return np.zeros(len(FEATURES)), 0
+        runs, means, variances = baseline
+        stds = np.sqrt(variances) + np.abs(means) * MIN_RELATIVE_STD + 1e-12
+        return (features - means) / stds, runs
+
+    def update_baseline(self, channel, features, z):
+        baseline = self.baselines.get(channel)
+        if baseline is None:
+            self.baselines[channel] = [1, features.copy(), np.zeros(len(FEATURES))]
+            return
+        runs, means, variances = baseline
+        if runs >= MIN_BASELINE_RUNS:
+            stds = np.sqrt(variances) + np.abs(means) * MIN_RELATIVE_STD + 1e-12
+            features = np.where(
+                np.isnan(means),
+                features,
+                means + np.clip(z, -ANOMALY_SCORE, ANOMALY_SCORE) * stds,
+            )
+        # Missing features leave their baseline as it is, and the first value
+        # of a feature that was missing so far starts it
+        measured = ~np.isnan(features)
+        first = measured & np.isnan(means)
+        means[first] = features[first]
+        variances[first] = 0.0
+        update = measured & ~first
+        alpha = max(1.0 / (runs + 1), 1.0 / BASELINE_RUNS)
+        difference = features[update] - means[update]
+        means[update] += alpha * difference
+        variances[update] = (1 - alpha) * (variances[update] + alpha * difference**2)
+        baseline[0] = runs + 1
+
+    def score(self, run_id, timestamp, channel, features):
+        # (z scores, score, anomalous) for a run, recorded with the baseline.
+        # score is None while the baseline is too short to judge it by, or if
+        # the run was already scored before a crash and is being processed
+        # again, which leaves the baseline as it is
+        if self.connection.execute(
+            "SELECT 1 FROM PUMP_HEALTH_SCORES WHERE run_id = ?", (run_id,)
+        ).fetchone():
+            return np.full(len(FEATURES), np.nan), None, False
+        z, runs = self.z_scores(channel, features)
+        scored = np.abs(z[~np.isnan(z)])
+        if runs < MIN_BASELINE_RUNS or len(scored) == 0:
+            score = None
+            anomalous = False
+        else:
+            score = float(scored.max())
+            anomalous = score > ANOMALY_SCORE
+        self.update_baseline(channel, features, z)
+        runs, means, variances = self.baselines[channel]
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO PUMP_HEALTH_SCORES VALUES({})".format(
+                    ", ".join("?" * (5 + 2 * len(FEATURES)))
+                ),
+                (run_id, timestamp, channel)
+                + tuple(none_for_nan(features))
+                + tuple(none_for_nan(z) if score is not None else [None] * len(z))
+                + (score, int(anomalous)),
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO PUMP_HEALTH_BASELINE VALUES({})".format(
+                    ", ".join("?" * (2 + 2 * len(FEATURES)))
+                ),
+                (channel, runs)
+                + tuple(
+                    value
+                    for pair in zip(none_for_nan(means), none_for_nan(variances))
+                    for value in pair
+                ),
+            )
+        return z, score, anomalous
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score saved runs, oldest first, to build the pump baselines"
+    )
+    parser.add_argument("db_file")
+    parser.add_argument("run_files", nargs="+")
+    args = parser.parse_args()
+
+    connection = db.connect(args.db_file)
+    health = PumpHealth(connection)
+    runs = sorted(
+        (datetime.strptime(read_header(run_path)["start"], RUN_TIME_FORMAT), run_path)
+        for run_path in args.run_files
+    )
+    for start, run_path in runs:
+        header, amps, times = read_amps(run_path)
+        seconds = (header["end_ns"] - header["start_ns"]) / 1_000_000_000
+        z, score, anomalous = health.score(
+            os.path.basename(run_path)[: -len(RUN_FILE_EXTENSION)],
+            start,
+            header["channel"],
+            health_features(amps, times, seconds, header.get("sample_rates")),
+        )
+        if score is None:
+            print("{}: not scored, already scored or too few runs yet".format(run_path))
+            continue
+        print(
+            "{}: score {:.2f}{}".format(
+                run_path, score, " ANOMALOUS" if anomalous else ""
+            )
+        )
+    connection.close()
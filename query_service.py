@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3 as db
+import threading
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from config import load_config
+from database import connect_read_only
+from water_usage import (
+    daily_water_usage,
+    first_water_usage_day,
+    recent_runs,
+    total_water_usage,
+    water_usage_between,
+    weekday_water_usage,
+)
+
+# A small read-only JSON API over the water usage rollups for the dashboard.
+# The database is opened read-only, main2.py creates the tables and keeps the
+# rollups up to date (backfill.py fills them in for an older database).
+# Responses are cached in memory until a run is inserted (the totals row
+# changes) or the day changes, and carry an ETag so unchanged pages are a 304.
+#
+#   /api/total                          gallons and runs overall
+#   /api/weekday                        totals per weekday, Monday first
+#   /api/calendar?start=&end=           gallons per day, YYYY-MM-DD, end excluded,
+#                                       from the first day with a run by default
+#   /api/pay-periods                    every pay period so far
+#   /api/runs?page=0&per_page=100       run log, newest first
+
+FIRST_PAY_PERIOD = date(2020, 10, 1)
+PAY_PERIOD_MONTHS = 4
+WEEKDAYS = (
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+)
+MAX_RUNS_PER_PAGE = 1000
+
+
+def add_months(day, months):
+    years, month = divmod(day.month - 1 + months, 12)
+    return date(day.year + years, month + 1, day.day)
+
+
+def pay_periods(today):
+    # [(start, next start)] up to the one containing today
+    periods = []
+    start = FIRST_PAY_PERIOD
+    while start <= today:
+        end = add_months(start, PAY_PERIOD_MONTHS)
+        periods.append((start, end))
+        start = end
+    return periods
+
+
+def parse_day(params, name, default):
+    if name not in params:
+        return default
+    return date.fromisoformat(params[name][0])
+
+
+def parse_int(params, name, default, minimum, maximum):
+    value = int(params.get(name, [default])[0])
+    if not minimum <= value <= maximum:
+        raise ValueError("{} must be {}-{}".format(name, minimum, maximum))
+    return value
+
+
+def total_endpoint(connection, params, today):
+    gallons, runs = total_water_usage(connection)
+    return {"gallons_pumped": gallons or 0.0, "runs": runs}
+
+
+def weekday_endpoint(connection, params, today):
+    usage = {
+        weekday: (gallons, runs)
+        for weekday, gallons, runs in weekday_water_usage(connection)
+    }
+    # strftime('%w') counts from Sunday, the dashboard's weeks start on Monday
+    return [
+        {
+            "day": name,
+            "gallons_pumped": usage.get((number + 1) % 7, (0.0, 0))[0],
+            "runs": usage.get((number + 1) % 7, (0.0, 0))[1],
+        }
+        for number, name in enumerate(WEEKDAYS)
+    ]
+
+
+def calendar_endpoint(connection, params, today):
+    start = parse_day(params, "start", first_water_usage_day(connection) or today)
+    end = parse_day(params, "end", today + timedelta(days=1))
+    return [
+        {"day": day, "gallons_pumped": gallons, "runs": runs}
+        for day, gallons, runs in daily_water_usage(connection, start, end)
+    ]
+
+
+def pay_periods_endpoint(connection, params, today):
+    periods = []
+    for start, end in pay_periods(today):
+        last_day = end - timedelta(days=1)
+        if start.year == last_day.year:
+            start_name = start.strftime("%b")
+        else:
+            start_name = start.strftime("%b %Y")
+        gallons, runs = water_usage_between(connection, start, end)
+        # Like the dashboard, a period is its whole days less the last one
+        days = (end - start).days - 1
+        days_so_far = days
+        if end > today:
+            days_so_far = (today - start).days + 1
+        average = gallons / days_so_far
+        periods.append(
+            {
+                "name": "{} - {}".format(start_name, last_day.strftime("%b %Y")),
+                "start": start.isoformat(),
+                "end": last_day.isoformat(),
+                "days": days,
+                "days_so_far": days_so_far,
+                "gallons_pumped": gallons,
+                "runs": runs,
+                "average_daily_gallons": average,
+                "estimated_gallons": average * days,
+            }
+        )
+    return periods
+
+
+def runs_endpoint(connection, params, today):
+    page = parse_int(params, "page", 0, 0, 1_000_000)
+    per_page = parse_int(params, "per_page", 100, 1, MAX_RUNS_PER_PAGE)
+    # One extra row for the time since the run before the last one shown
+    rows = recent_runs(connection, per_page + 1, page * per_page)
+    runs = []
+    for row, previous in zip(rows, rows[1:] + [None]):
+        seconds_since_previous = None
+        if previous is not None:
+            seconds_since_previous = (
+                datetime.fromisoformat(str(row[0]))
+                - datetime.fromisoformat(str(previous[0]))
+            ).total_seconds()
+        runs.append(
+            {
+                "timestamp": str(row[0]),
+                "gallons_pumped": row[1],
+                "seconds_since_previous": seconds_since_previous,
+            }
+        )
+    return {
+        "page": page,
+        "per_page": per_page,
+        "total_runs": total_water_usage(connection)[1],
+        "runs": runs[:per_page],
+    }
+
+
+ENDPOINTS = {
+    "/api/total": total_endpoint,
+    "/api/weekday": weekday_endpoint,
+    "/api/calendar": calendar_endpoint,
+    "/api/pay-periods": pay_periods_endpoint,
+    "/api/runs": runs_endpoint,
+}
+
+
+class QueryService:
+    def __init__(self, db_path, max_cached=256):
+        # Request threads take turns on one read connection
+        self.connection = connect_read_only(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.max_cached = max_cached
+        self.cache = {}
+        self.cache_version = None
+
+    def data_version(self):
+        # Changes with every inserted run, and with the date for averages
+        row = self.connection.execute(
+            "SELECT runs, last_run FROM WATER_USAGE_TOTALS WHERE id = 0"
+        ).fetchone()
+        return row, date.today()
+
+    def get(self, path, query):
+        # (etag, JSON body), KeyError for unknown paths, ValueError for bad
+        # parameters
+        endpoint = ENDPOINTS[path]
+        params = parse_qs(query)
+        key = (
+            path,
+            tuple(sorted((name, tuple(values)) for name, values in params.items())),
+        )
+        with self.lock:
+            version = self.data_version()
+            if version != self.cache_version:
+                self.cache = {}
+                self.cache_version = version
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            body = json.dumps(
+                endpoint(self.connection, params, version[1]), default=str
+            ).encode("utf-8")
+            cached = ('"{}"'.format(hashlib.sha1(body).hexdigest()), body)
+            if len(self.cache) >= self.max_cached:
+                self.cache = {}
+            self.cache[key] = cached
+            return cached
+
+    def close(self):
+        self.connection.close()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", "no-cache")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, json.dumps({"error": message}).encode("utf-8"))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            etag, body = self.service.get(url.path.rstrip("/"), url.query)
+        except KeyError:
+            self.send_error_json(404, "Unknown endpoint {}".format(url.path))
+            return
+        except ValueError as e:
+            self.send_error_json(400, str(e))
+            return
+        except db.OperationalError as e:
+            # e.g. the DAQ hasn't created the water usage tables yet
+            self.send_error_json(503, str(e))
+            return
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_json(200, body, etag)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Water usage API for the dashboard")
+    parser.add_argument("--config", help="Settings file with the data directory")
+    parser.add_argument(
+        "--db-file", help="home_das_db.db, in base_dir from the config by default"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    if args.db_file is None:
+        args.db_file = os.path.join(
+            load_config(args.config)["base_dir"], "home_das_db.db"
+        )
+    QueryHandler.service = QueryService(args.db_file)
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    print(
+        "Serving water usage from {} on {}:{}".format(
+            args.db_file, args.host, args.port
+        )
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    QueryHandler.service.close()
@@ -0,0 +1,291 @@
+import argparse
+import glob
+import os
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta
+
+from config import load_config
+from database import connect
+from plotting import PLOT_PREFIXES
+from run_file import RUN_FILE_EXTENSION, parse_stem
+from waveform import (
+    PYRAMID_EXTENSION,
+    day_seconds,
+    init_septic_data_minmax_table,
+    rebuild_septic_data_minmax,
+)
+
+# Keeps the SD card from filling up. Data ages through three tiers:
+#
+#   raw samples     SEPTIC_data rows, kept RAW_SAMPLE_DAYS
+#   rollups         SEPTIC_DATA_MINMAX min/max/mean buckets from 1 to 600
+#                   seconds, kept ROLLUP_DAYS
+#   run summaries   RUN_SUMMARIES, WATER_USAGE_* and PUMP_HEALTH_*, kept
+#
+# A day's buckets are rebuilt from its raw rows right before they are
+# deleted, so the rollups are complete even for data written before the
+# means were kept. Runs older than FILE_DAYS are moved into one zip per
+# month in <base_dir>/archive/, their .run and CSV files compressed and the
+# pyramids and PNGs, which can be made again from them, deleted.
+#
+# Deleting rows leaves free pages in the database. With auto_vacuum set to
+# INCREMENTAL (new databases are, see database.py) they are handed back to
+# the file system VACUUM_PAGES at a time. Everything happens a day or a
+# month at a time and only while no run is active, so it never holds the
+# database for long or competes with a pump run.
+
+RAW_SAMPLE_DAYS = 30
+ROLLUP_DAYS = 365
+FILE_DAYS = 90
+ARCHIVE_DIR = "archive"
+VACUUM_PAGES = 256
+# How often a pass is tried, and how often it has to succeed
+CHECK_SECONDS = 60.0
+PASS_SECONDS = 60 * 60.0
+
+CSV_PREFIXES = ("", "RAW_", "NS_")
+
+
+def run_file_names(stem):
+    # Source files of a run, then the ones made from them
+    sources = [stem + RUN_FILE_EXTENSION]
+    sources += ["{}{}.csv".format(prefix, stem) for prefix in CSV_PREFIXES]
+    derived = [stem + PYRAMID_EXTENSION]
+    derived += ["{}-{}.png".format(prefix, stem) for prefix in PLOT_PREFIXES.values()]
+    return sources, derived
+
+
+def run_starts(base_dir):
+    # {stem: start} of every run with a .run or RAW_/NS_ CSV file, runs that
+    # can't be told from their name go by the file's modification time
+    starts = {}
+    paths = glob.glob(os.path.join(base_dir, "*" + RUN_FILE_EXTENSION))
+    paths += glob.glob(os.path.join(base_dir, "RAW_*.csv"))
+    paths += glob.glob(os.path.join(base_dir, "NS_*.csv"))
+    for path in paths:
+        name = os.path.basename(path)
+        if name.endswith(RUN_FILE_EXTENSION):
+            stem = name[: -len(RUN_FILE_EXTENSION)]
+        else:
+            stem = name.split("_", 1)[1][: -len(".csv")]
+        try:
+            starts[stem] = parse_stem(stem)[1]
+        except ValueError:
+            starts.setdefault(stem, datetime.fromtimestamp(os.path.getmtime(path)))
+    return starts
+
+
+class RetentionEngine:
+    def __init__(
+        self,
+        db_path,
+        base_dir,
+        log,
+        is_idle=lambda: True,
+        raw_sample_days=RAW_SAMPLE_DAYS,
+        rollup_days=ROLLUP_DAYS,
+        file_days=FILE_DAYS,
+    ):
+        self.db_path = db_path
+        self.base_dir = base_dir
+        self.is_idle = is_idle
+        self.log = log
+        self.raw_sample_days = raw_sample_days
+        self.rollup_days = rollup_days
+        self.file_days = file_days
+        self.last_pass = None
+        self.warned_auto_vacuum = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.enforce, name="retention", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def idle(self):
+        return self.is_idle() and not self.stopped.is_set()
+
+    def enforce(self):
+        connection = connect(self.db_path)
+        init_septic_data_minmax_table(connection)
+        while not self.stopped.wait(CHECK_SECONDS):
+            if not self.idle():
+                continue
+            try:
+                if (
+                    self.last_pass is None
+                    or time.monotonic() - self.last_pass >= PASS_SECONDS
+                ):
+                    if self.run_pass(connection):
+                        self.last_pass = time.monotonic()
+                self.vacuum(connection)
+            except Exception as e:
+                self.log("Retention pass failed: {}".format(e))
+        connection.close()
+
+    def run_pass(self, connection):
+        # True once everything due has been done, False if a run started
+        today = date.today()
+        expired_samples = self.expire_samples(
+            connection, today - timedelta(days=self.raw_sample_days)
+        )
+        expired_rollups = self.expire_rollups(
+            connection, today - timedelta(days=self.rollup_days)
+        )
+        archived_runs = self.archive_runs(
+            datetime.combine(
+                today - timedelta(days=self.file_days), datetime.min.time()
+            )
+        )
+        if expired_samples or expired_rollups or archived_runs:
+            self.log(
+                "Retention deleted {} raw sample(s) and {} rollup bucket(s), archived {} run(s)".format(
+                    expired_samples, expired_rollups, archived_runs
+                ),
+                event="retention",
+                expired_samples=expired_samples,
+                expired_rollups=expired_rollups,
+                archived_runs=archived_runs,
+            )
+        return self.idle()
+
+    def expire_samples(self, connection, cutoff):
+        # Rolls each day before cutoff up and deletes its raw rows
+        deleted = 0
+        while self.idle():
+            first = connection.execute("SELECT MIN(timestamp) FROM SEPTIC_data")
+            first = first.fetchone()[0]
+            if first is None:
+                break
+            day = datetime.fromisoformat(str(first)).date()
+            if day >= cutoff:
+                break
+            rebuild_septic_data_minmax(connection, day, day + timedelta(days=1))
+            with connection:
+                deleted += connection.execute(
+                    "DELETE FROM SEPTIC_data WHERE timestamp < ?",
+                    (datetime.combine(day + timedelta(days=1), datetime.min.time()),),
+                ).rowcount
+        return deleted
+
+    def expire_rollups(self, connection, cutoff):
+        deleted = 0
+        cutoff_s = day_seconds(cutoff)
+        while self.idle():
+            first_s = connection.execute("SELECT MIN(start_s) FROM SEPTIC_DATA_MINMAX")
+            first_s = first_s.fetchone()[0]
+            if first_s is None or first_s >= cutoff_s:
+                break
+            with connection:
+                deleted += connection.execute(
+                    "DELETE FROM SEPTIC_DATA_MINMAX WHERE start_s < ?",
+                    (min(first_s // 86400 * 86400 + 86400, cutoff_s),),
+                ).rowcount
+        return deleted
+
+    def archive_runs(self, cutoff):
+        months = {}
+        for stem, start in run_starts(self.base_dir).items():
+            if start < cutoff:
+                months.setdefault(start.strftime("%Y-%m"), []).append(stem)
+        if not months:
+            return 0
+        archive_dir = os.path.join(self.base_dir, ARCHIVE_DIR)
+        os.makedirs(archive_dir, exist_ok=True)
+        archived = 0
+        for month, stems in sorted(months.items()):
+            if not self.idle():
+                break
+            archive_path = os.path.join(archive_dir, "runs-{}.zip".format(month))
+            remove = []
+            with zipfile.ZipFile(archive_path, "a", zipfile.ZIP_DEFLATED) as archive:
+                archived_names = set(archive.namelist())
+                for stem in stems:
+                    sources, derived = run_file_names(stem)
+                    for name in sources:
+                        path = os.path.join(self.base_dir, name)
+                        if not os.path.exists(path):
+                            continue
+                        # Already there if the last pass stopped before removing it
+                        if name not in archived_names:
+                            archive.write(path, name)
+                        remove.append(path)
+                    remove += [os.path.join(self.base_dir, name) for name in derived]
+            # Only once the archive has been closed
+            for path in remove:
+                if os.path.exists(path):
+                    os.remove(path)
+            archived += len(stems)
+        return archived
+
+    def vacuum(self, connection):
+        auto_vacuum = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != 2:
+            if not self.warned_auto_vacuum:
+                self.log(
+                    "The database doesn't use incremental auto_vacuum, `python3 retention.py --enable-incremental-vacuum` converts it"
+                )
+                self.warned_auto_vacuum = True
+            return
+        while self.idle():
+            free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages == 0:
+                break
+            self.vacuum_step(connection)
+            # Lets the sample writer in between steps
+            self.stopped.wait(0.05)
+
+    def vacuum_step(self, connection):
+        # incremental_vacuum frees one page per step of the statement and
+        # execute() only steps it once, executescript() runs it to the end
+        connection.executescript("PRAGMA incremental_vacuum({});".format(VACUUM_PAGES))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Expire old samples and rollups, archive old runs and vacuum"
+    )
+    parser.add_argument(
+        "--config", help="Settings file with the data directory and retention days"
+    )
+    parser.add_argument(
+        "--base-dir",
+        help="Where logs, runs and the database live, base_dir from the config by default",
+    )
+    parser.add_argument("--db-file", default="home_das_db.db")
+    parser.add_argument("--raw-sample-days", type=int, help="Overrides the config")
+    parser.add_argument("--rollup-days", type=int, help="Overrides the config")
+    parser.add_argument("--file-days", type=int, help="Overrides the config")
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="Switch the database to incremental auto_vacuum, rewrites it once",
+    )
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    base_dir = args.base_dir or config["base_dir"]
+    days = config["retention"]
+    for name in ("raw_sample_days", "rollup_days", "file_days"):
+        if getattr(args, name) is not None:
+            days[name] = getattr(args, name)
+
+    db_path = os.path.join(base_dir, args.db_file)
+    connection = connect(db_path)
+    if args.enable_incremental_vacuum:
+        connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.execute("VACUUM")
+    init_septic_data_minmax_table(connection)
+    engine = RetentionEngine(
+        db_path, base_dir, lambda message, **fields: print(message), **days
+    )
+    engine.run_pass(connection)
+    engine.vacuum(connection)
+    connection.close()
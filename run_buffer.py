@@ -0,0 +1,321 @@
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+
+# Memory use is bounded by design. One RunBuffer holds capacity rows of
+# float32 readings (one column per channel) plus an int64 timestamp per row,
+# so it takes capacity * (4 * channels + 8) bytes. The DAQ writes into one
+# buffer at a time and every queued or processing run keeps its buffer alive,
+# so at most run_queue_size + 2 buffers exist. A run that would outgrow its
+# buffer (a stuck sensor) is split into consecutive runs instead of growing.
+# At 120 Hz with 30 minute buffers one channel needs ~2.6 MB per buffer.
+#
+# With a journal_dir each buffer is a memory mapped journal file instead,
+# run_buffer_<n>.journal, so a run survives the process dying. Appending is
+# the same array writes as before and nothing is ever fsynced, the OS writes
+# the pages back in the background. The file starts with JOURNAL_HEADER_BYTES
+# of int64 state:
+#
+#   magic, version, capacity, channels, rows, in use, idle hz, run hz
+#   per channel: running, run start ns, run start row, run rate since ns
+#   JOURNAL_RUNS entries: column, start row, end row, start ns, end ns,
+#                         run rate since ns, state
+#
+# "run rate since" is when the plate last switched from the idle rate to the
+# run rate, so a run that started before it is known to have been sampled
+# at the idle rate first. An entry is added when a run is handed off for
+# processing and marked done once it has been processed. On startup, a
+# journal still in use has its queued runs processed again and its open runs
+# ended at their last sample (unfinished_runs()). A journal in use that
+# can't be read back, from another version or set of channels, is renamed to
+# <name>.<time>.old and left for inspection. Files are sparse, so only what
+# was written takes space.
+
+JOURNAL_MAGIC = 0x314C4E524A534144  # b"DASJRNL1"
+JOURNAL_VERSION = 2
+JOURNAL_HEADER_BYTES = 8192
+JOURNAL_RUNS = 64
+JOURNAL_EXTENSION = ".journal"
+SET_ASIDE_EXTENSION = ".old"
+
+MAGIC, VERSION, CAPACITY, CHANNELS, ROWS, IN_USE, IDLE_RATE_HZ, RUN_RATE_HZ = range(8)
+HEADER_FIELDS = 8
+OPEN_RUN_FIELDS = 4
+RUN_FIELDS = 7
+RUN_QUEUED, RUN_DONE = 1, 2
+
+
+def read_journal_header(path):
+    # (capacity, channels) of a journal this version can read, else None
+    header = np.fromfile(path, dtype=np.int64, count=CHANNELS + 1)
+    if (
+        len(header) > CHANNELS
+        and header[MAGIC] == JOURNAL_MAGIC
+        and header[VERSION] == JOURNAL_VERSION
+    ):
+        return int(header[CAPACITY]), int(header[CHANNELS])
+    return None
+
+
+class RunBuffer:
+    def __init__(self, capacity, channels, pool=None, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.state = None
+        if path is None:
+            self.values = np.zeros((capacity, channels), dtype=np.float32)
+            self.times = np.zeros(capacity, dtype=np.int64)
+        else:
+            self.open_journal(capacity, channels)
+        self.rows = 0
+        self.pool = pool
+        self.references = 0
+        self.lock = threading.Lock()
+
+    def open_journal(self, capacity, channels):
+        # An existing journal keeps its capacity, rows and state
+        if os.path.exists(self.path):
+            header = read_journal_header(self.path)
+            if header is not None:
+                capacity, channels = header
+            else:
+                os.remove(self.path)
+        values_offset = JOURNAL_HEADER_BYTES
+        times_offset = values_offset + (capacity * channels * 4 + 7) // 8 * 8
+        size = times_offset + capacity * 8
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as journal_file:
+                journal_file.truncate(size)
+        self.capacity = capacity
+        self.state = np.memmap(
+            self.path, np.int64, "r+", shape=(JOURNAL_HEADER_BYTES // 8,)
+        )
+        self.values = np.memmap(
+            self.path,
+            np.float32,
+            "r+",
+            offset=values_offset,
+            shape=(capacity, channels),
+        )
+        self.times = np.memmap(
+            self.path, np.int64, "r+", offset=times_offset, shape=(capacity,)
+        )
+        if self.state[MAGIC] != JOURNAL_MAGIC:
+            self.state[:] = 0
+            self.state[:ROWS] = (JOURNAL_MAGIC, JOURNAL_VERSION, capacity, channels)
+
+    def channels(self):
+        return self.values.shape[1]
+
+    def nbytes(self):
+        return self.values.nbytes + self.times.nbytes
+
+    def reset(self):
+        self.rows = 0
+        if self.state is not None:
+            self.state[ROWS:] = 0
+            self.state[IN_USE] = 1
+
+    def append_block(self, times, values):
+        first_row = self.rows
+        self.rows = first_row + len(times)
+        self.values[first_row : self.rows] = values
+        self.times[first_row : self.rows] = times
+        if self.state is not None:
+            self.state[ROWS] = self.rows
+        return first_row
+
+    def row_at(self, tick_ns):
+        # First row sampled at or after tick_ns
+        return int(np.searchsorted(self.times[: self.rows], tick_ns))
+
+    def column(self, column, start_row, end_row):
+        # Views, nothing is copied
+        return self.values[start_row:end_row, column], self.times[start_row:end_row]
+
+    def open_run_fields(self, column):
+        first = HEADER_FIELDS + column * OPEN_RUN_FIELDS
+        return slice(first, first + OPEN_RUN_FIELDS)
+
+    def run_fields(self, entry):
+        first = HEADER_FIELDS + self.channels() * OPEN_RUN_FIELDS + entry * RUN_FIELDS
+        return slice(first, first + RUN_FIELDS)
+
+    def journal_sample_rates(self, idle_rate_hz, run_rate_hz):
+        if self.state is not None:
+            self.state[IDLE_RATE_HZ] = idle_rate_hz or 0
+            self.state[RUN_RATE_HZ] = run_rate_hz
+
+    def sample_rates_hz(self):
+        # (idle rate, run rate) journaled with journal_sample_rates()
+        return int(self.state[IDLE_RATE_HZ]), int(self.state[RUN_RATE_HZ])
+
+    def journal_run_started(self, column, start_ns, start_row, run_rate_since_ns):
+        if self.state is not None:
+            self.state[self.open_run_fields(column)] = (
+                1,
+                start_ns,
+                start_row,
+                run_rate_since_ns,
+            )
+
+    def journal_run_queued(self, column, start_row, end_row, start_ns, end_ns):
+        # The entry to pass to journal_run_done(), None without a journal or
+        # once the buffer has had JOURNAL_RUNS runs
+        if self.state is None:
+            return None
+        run_rate_since_ns = self.state[self.open_run_fields(column)][-1]
+        self.state[self.open_run_fields(column)] = 0
+        for entry in range(JOURNAL_RUNS):
+            fields = self.run_fields(entry)
+            if self.state[fields][-1] == 0:
+                self.state[fields] = (
+                    column,
+                    start_row,
+                    end_row,
+                    start_ns,
+                    end_ns,
+                    run_rate_since_ns,
+                    RUN_QUEUED,
+                )
+                return entry
+        return None
+
+    def journal_run_done(self, entry):
+        if self.state is not None and entry is not None:
+            self.state[self.run_fields(entry)][-1] = RUN_DONE
+
+    def in_use(self):
+        return self.state is not None and self.state[IN_USE] == 1
+
+    def unfinished_runs(self):
+        # [(column, start row, end row, start ns, end ns, run rate since ns,
+        # entry)] of a journal left in use, open runs are queued ending at
+        # the last row
+        self.rows = int(self.state[ROWS])
+        if self.rows == 0:
+            return []
+        for column in range(self.channels()):
+            running, start_ns, start_row = self.state[self.open_run_fields(column)][:3]
+            if running and start_row < self.rows:
+                self.journal_run_queued(
+                    column, start_row, self.rows, start_ns, self.times[self.rows - 1]
+                )
+        runs = []
+        for entry in range(JOURNAL_RUNS):
+            fields = self.state[self.run_fields(entry)]
+            if fields[-1] == RUN_QUEUED:
+                runs.append(tuple(int(value) for value in fields[:-1]) + (entry,))
+        return runs
+
+    def retain(self):
+        with self.lock:
+            self.references += 1
+
+    def release(self):
+        with self.lock:
+            self.references -= 1
+            unused = self.references == 0
+        if unused:
+            if self.state is not None:
+                self.state[IN_USE] = 0
+            if self.pool is not None:
+                self.pool.put_back(self)
+
+
+class RunBufferPool:
+    def __init__(self, capacity, channels, max_buffers, journal_dir=None, log=print):
+        self.capacity = capacity
+        self.channels = channels
+        self.max_buffers = max_buffers
+        self.journal_dir = journal_dir
+        self.log = log
+        self.allocated = 0
+        self.free = []
+        self.lock = threading.Lock()
+        if journal_dir is not None:
+            os.makedirs(journal_dir, exist_ok=True)
+
+    def buffer_nbytes(self):
+        return self.capacity * (4 * self.channels + 8)
+
+    def max_nbytes(self):
+        return self.max_buffers * self.buffer_nbytes()
+
+    def journal_path(self, number):
+        return os.path.join(
+            self.journal_dir, "run_buffer_{}{}".format(number, JOURNAL_EXTENSION)
+        )
+
+    def recover(self):
+        # Buffers whose journal was still in use, retained once each. Every
+        # journal is taken into the pool so its file gets reused.
+        unfinished = []
+        if self.journal_dir is None:
+            return unfinished
+        paths = glob.glob(os.path.join(self.journal_dir, "*" + JOURNAL_EXTENSION))
+        for path in sorted(paths):
+            header = read_journal_header(path)
+            if header is None:
+                reason = "was written by another version"
+            elif header[1] != self.channels:
+                reason = "has {} channels instead of {}".format(
+                    header[1], self.channels
+                )
+            else:
+                reason = None
+            if reason is not None:
+                # Only worth keeping if it may hold a run
+                state = np.fromfile(path, dtype=np.int64, count=IN_USE + 1)
+                if len(state) > IN_USE and state[IN_USE] == 1:
+                    self.set_aside(path, reason)
+                else:
+                    os.remove(path)
+                continue
+            buffer = RunBuffer(self.capacity, self.channels, self, path)
+            with self.lock:
+                self.allocated += 1
+            if buffer.in_use():
+                buffer.retain()
+                unfinished.append(buffer)
+            else:
+                self.put_back(buffer)
+        return unfinished
+
+    def set_aside(self, path, reason):
+        # Kept, any run in it has to be recovered by hand
+        aside = "{}.{}{}".format(
+            path, time.strftime("%Y%m%d-%H%M%S"), SET_ASIDE_EXTENSION
+        )
+        os.replace(path, aside)
+        self.log("Journal {} {}, moved it to {}".format(path, reason, aside))
+
+    def get(self):
+        with self.lock:
+            if self.free:
+                buffer = self.free.pop()
+            elif self.allocated < self.max_buffers:
+                self.allocated += 1
+                buffer = None
+            else:
+                raise MemoryError(
+                    "All {} run buffers are in use".format(self.max_buffers)
+                )
+            number = self.allocated
+        if buffer is None:
+            path = None
+            if self.journal_dir is not None:
+                while os.path.exists(self.journal_path(number)):
+                    number += 1
+                path = self.journal_path(number)
+            buffer = RunBuffer(self.capacity, self.channels, self, path)
+        buffer.reset()
+        buffer.retain()
+        return buffer
+
+    def put_back(self, buffer):
+        with self.lock:
+            self.free.append(buffer)
@@ -0,0 +1,67 @@
+import numpy as np
+
+# Run detection over blocks of samples, one column per channel. A channel
+# turns on above its on threshold and only turns off again below its lower
+# off threshold (hysteresis), so noise around a single threshold can't toggle
+# it. A run only starts once the channel has stayed on for min_on_ns and only
+# ends once it has stayed off for min_off_ns (debounce), which drops short
+# spikes and bridges short dropouts. Confirmed starts and ends are reported
+# with the time of the transition that began them.
+
+
+class RunDetector:
+    def __init__(self, on_thresholds, off_thresholds, min_on_ns, min_off_ns):
+        self.on_thresholds = np.asarray(on_thresholds, dtype=np.float32)
+        self.off_thresholds = np.asarray(off_thresholds, dtype=np.float32)
+        self.min_on_ns = np.asarray(min_on_ns, dtype=np.int64)
+        self.min_off_ns = np.asarray(min_off_ns, dtype=np.int64)
+        channels = len(self.on_thresholds)
+        # Hysteresis state after the last sample and when it last changed
+        self.on = np.zeros(channels, dtype=bool)
+        self.changed_ns = np.zeros(channels, dtype=np.int64)
+        # Confirmed runs
+        self.running = np.zeros(channels, dtype=bool)
+
+    def holding(self):
+        # Channels whose samples may still end up in a run
+        return self.on | self.running
+
+    def confirm(self, column, until_ns, events):
+        # The current on or off streak of column lasted until until_ns
+        duration = until_ns - self.changed_ns[column]
+        if self.on[column]:
+            if not self.running[column] and duration >= self.min_on_ns[column]:
+                self.running[column] = True
+                events.append((int(column), True, int(self.changed_ns[column])))
+        elif self.running[column] and duration >= self.min_off_ns[column]:
+            self.running[column] = False
+            events.append((int(column), False, int(self.changed_ns[column])))
+
+    def update(self, times, values):
+        # [(column, started, transition_ns)] in time order for one block of
+        # times (rows,) and values (rows, channels)
+        above = values > self.on_thresholds
+        decided = above | (values < self.off_thresholds)
+        # Between the thresholds a sample keeps the state of the last sample
+        # that was above or below them
+        rows = np.arange(len(times))[:, np.newaxis]
+        last_decided = np.maximum.accumulate(np.where(decided, rows, -1), axis=0)
+        state = np.take_along_axis(above, np.maximum(last_decided, 0), axis=0)
+        state = np.where(last_decided >= 0, state, self.on)
+
+        events = []
+        previous = np.vstack((self.on, state[:-1]))
+        for row, column in zip(*np.nonzero(state != previous)):
+            transition_ns = times[row]
+            self.confirm(column, transition_ns, events)
+            self.on[column] = state[row, column]
+            self.changed_ns[column] = transition_ns
+
+        # Streaks still going at the end of the block
+        duration = times[-1] - self.changed_ns
+        pending = (self.on != self.running) & (
+            duration >= np.where(self.on, self.min_on_ns, self.min_off_ns)
+        )
+        for column in np.flatnonzero(pending):
+            self.confirm(column, times[-1], events)
+        return events
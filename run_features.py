@@ -0,0 +1,94 @@
+import numpy as np
+
+# Per-run features for comparing runs with each other, from a run's amps and
+# sample times (memory mapped columns work, nothing is kept around):
+#
+#   inrush peak       highest amps in the first INRUSH_SECONDS, NaN if the
+#                     run was first seen at the idle rate, which polls too
+#                     seldom to catch the inrush (inrush sampled is False,
+#                     and the peak amps are only the steady draw's)
+#   steady amps       median of the middle half of the run
+#   settling seconds  until a SETTLING_WINDOW_SECONDS moving average has
+#                     stayed within SETTLING_BAND of the steady amps for
+#                     SETTLING_HOLD_SECONDS
+#   interval stats    mean, standard deviation (jitter) and max of the time
+#                     between samples
+
+INRUSH_SECONDS = 0.5
+SETTLING_BAND = 0.1
+SETTLING_WINDOW_SECONDS = 0.1
+SETTLING_HOLD_SECONDS = 1.0
+
+
+def samples_in(seconds, times):
+    # From the middle of the run, its start may have been sampled at the
+    # idle rate
+    middle = len(times) // 2
+    interval = float(np.median(np.diff(times[max(middle - 500, 0) : middle + 500])))
+    return max(1, int(seconds * 1_000_000_000 / interval)) if interval > 0 else 1
+
+
+def steady_amps(amps):
+    quarter = len(amps) // 4
+    return float(np.median(amps[quarter : len(amps) - quarter]))
+
+
+def started_at_idle_rate(sample_rates):
+    # sample_rates from the run file header, [(seconds into the run, hz)]
+    if not sample_rates:
+        return False
+    return sample_rates[0][1] < max(rate for offset, rate in sample_rates)
+
+
+def inrush_peak(amps, times):
+    end = np.searchsorted(times, times[0] + int(INRUSH_SECONDS * 1_000_000_000))
+    return float(np.max(amps[: max(end, 1)]))
+
+
+def settling_seconds(amps, times, steady):
+    if len(amps) < 2 or steady <= 0:
+        return float("nan")
+    window = samples_in(SETTLING_WINDOW_SECONDS, times)
+    hold = samples_in(SETTLING_HOLD_SECONDS, times)
+    if len(amps) < window + hold:
+        return float("nan")
+    sums = np.cumsum(np.concatenate(([0.0], amps)))
+    # smooth[i] is the mean of the window ending at sample i + window - 1
+    smooth = (sums[window:] - sums[:-window]) / window
+    within = np.abs(smooth - steady) <= SETTLING_BAND * steady
+    counts = np.cumsum(np.concatenate(([0], within)))
+    settled = np.flatnonzero(counts[hold:] - counts[:-hold] == hold)
+    if len(settled) == 0:
+        return float("nan")
+    return (times[settled[0] + window - 1] - times[0]) / 1_000_000_000
+
+
+def interval_stats(times):
+    # (mean, std, max) nanoseconds between samples
+    if len(times) < 2:
+        return float("nan"), float("nan"), float("nan")
+    intervals = np.diff(times)
+    return float(intervals.mean()), float(intervals.std()), float(intervals.max())
+
+
+def run_features(amps, times, sample_rates=None):
+    if len(amps) == 0:
+        return {}
+    steady = steady_amps(amps)
+    interval_mean, interval_std, interval_max = interval_stats(times)
+    inrush_sampled = not started_at_idle_rate(sample_rates)
+    if inrush_sampled:
+        inrush = inrush_peak(amps, times)
+    else:
+        inrush = float("nan")
+    return {
+        "mean_amps": float(np.mean(amps)),
+        "peak_amps": float(np.max(amps)),
+        "inrush_peak_amps": inrush,
+        "inrush_sampled": inrush_sampled,
+        "steady_amps": steady,
+        "settling_seconds": settling_seconds(amps, times, steady),
+        "interval_mean_ns": interval_mean,
+        "interval_std_ns": interval_std,
+        "interval_max_ns": interval_max,
+    }
@@ -0,0 +1,274 @@
+import argparse
+import glob
+import json
+import os
+import struct
+from datetime import datetime
+
+import numpy as np
+from channels import NUMBER_OF_CHANNELS, Channel
+
+# A run file is one binary file per run:
+#
+#   magic         8 bytes   b"HOMEDAS1"
+#   header size   4 bytes   little endian uint32
+#   header        JSON, padded with spaces to a multiple of 8 bytes
+#   raw volts     float32 little endian, one per sample
+#   padding       to a multiple of 8 bytes
+#   timestamps    int64 little endian nanoseconds, one per sample
+#
+# The header records the channel, conversion factor, start time, sample rate,
+# sample count and the byte offsets of both columns, so the columns can be
+# opened with np.memmap without reading the whole file.
+
+RUN_FILE_MAGIC = b"HOMEDAS1"
+RUN_FILE_VERSION = 1
+RUN_FILE_EXTENSION = ".run"
+RUN_TIME_FORMAT = "%Y%m%d-%H:%M:%S"
+VOLTS_DTYPE = np.dtype("<f4")
+TIMES_DTYPE = np.dtype("<i8")
+
+
+def pad_to(size, multiple=8):
+    return (size + multiple - 1) // multiple * multiple
+
+
+def run_file_path(base_dir, file_time):
+    return os.path.join(base_dir, "{}{}".format(file_time, RUN_FILE_EXTENSION))
+
+
+def build_header(channel, start, start_ns, end_ns, sample_rate_hz, samples, **extra):
+    header = {
+        "version": RUN_FILE_VERSION,
+        "channel": channel.number,
+        "plate": channel.plate,
+        "name": channel.name,
+        "conversion_factor": channel.conversion_factor,
+        "threshold": channel.threshold,
+        "start": start.strftime(RUN_TIME_FORMAT),
+        "start_ns": int(start_ns),
+        "end_ns": int(end_ns),
+        "sample_rate_hz": sample_rate_hz,
+        "samples": int(samples),
+    }
+    header.update(extra)
+    return header
+
+
+def encode_header(header):
+    # The offsets depend on the header size, which depends on the offsets.
+    # They only ever grow, so this settles after a pass or two.
+    volts_size = pad_to(header["samples"] * VOLTS_DTYPE.itemsize)
+    header["volts_offset"] = 0
+    header["times_offset"] = 0
+    while True:
+        encoded = json.dumps(header, sort_keys=True).encode("utf-8")
+        volts_offset = pad_to(len(RUN_FILE_MAGIC) + 4 + len(encoded))
+        if header["volts_offset"] == volts_offset:
+            break
+        header["volts_offset"] = volts_offset
+        header["times_offset"] = volts_offset + volts_size
+    return encoded.ljust(volts_offset - len(RUN_FILE_MAGIC) - 4, b" ")
+
+
+def write_run(path, header, raw_volts, times):
+    raw_volts = np.asarray(raw_volts, dtype=VOLTS_DTYPE)
+    times = np.asarray(times, dtype=TIMES_DTYPE)
+    header["samples"] = len(raw_volts)
+    encoded = encode_header(header)
+    volts_padding = header["times_offset"] - header["volts_offset"] - raw_volts.nbytes
+
+    # Written to a temporary name and renamed so a partial file is never seen
+    temporary_path = "{}.tmp".format(path)
+    with open(temporary_path, "wb") as run_file:
+        run_file.write(RUN_FILE_MAGIC)
+        run_file.write(struct.pack("<I", len(encoded)))
+        run_file.write(encoded)
+        run_file.write(raw_volts.tobytes())
+        run_file.write(b"\0" * volts_padding)
+        run_file.write(times.tobytes())
+    os.replace(temporary_path, path)
+    return header
+
+
+def read_header(path):
+    with open(path, "rb") as run_file:
+        magic = run_file.read(len(RUN_FILE_MAGIC))
+        if magic != RUN_FILE_MAGIC:
+            raise ValueError("{} is not a home_das run file".format(path))
+        (header_size,) = struct.unpack("<I", run_file.read(4))
+        header = json.loads(run_file.read(header_size).decode("utf-8"))
+    if header["version"] > RUN_FILE_VERSION:
+        raise ValueError(
+            "{} is run file version {}, only {} is supported".format(
+                path, header["version"], RUN_FILE_VERSION
+            )
+        )
+    return header
+
+
+def read_run(path):
+    # Returns the header plus memory mapped raw volt and timestamp columns
+    header = read_header(path)
+    samples = header["samples"]
+    if samples == 0:
+        return header, np.zeros(0, VOLTS_DTYPE), np.zeros(0, TIMES_DTYPE)
+    raw_volts = np.memmap(
+        path, VOLTS_DTYPE, "r", offset=header["volts_offset"], shape=(samples,)
+    )
+    times = np.memmap(
+        path, TIMES_DTYPE, "r", offset=header["times_offset"], shape=(samples,)
+    )
+    return header, raw_volts, times
+
+
+def read_amps(path):
+    header, raw_volts, times = read_run(path)
+    return header, raw_volts * header["conversion_factor"], times
+
+
+# CSV archive conversion
+
+
+def csv_run_stems(base_dir):
+    # Runs with a RAW_ file, and the amperage-only <ts>.csv runs without one.
+    # Other CSV files in the directory aren't named like a run
+    stems = set()
+    for path in glob.glob(os.path.join(base_dir, "*.csv")):
+        name = os.path.basename(path)[: -len(".csv")]
+        if name.startswith("RAW_"):
+            stems.add(name[len("RAW_") :])
+        elif not name.startswith("NS_"):
+            try:
+                parse_stem(name)
+            except ValueError:
+                continue
+            stems.add(name)
+    return sorted(stems)
+
+
+def parse_stem(stem):
+    # (channel number, start). Channel 0 runs are named by time alone, other
+    # channels carry CH<n>_ and channels on other plates P<plate>_CH<n>_
+    number = 0
+    if stem.startswith("P"):
+        prefix, stem = stem.split("_", 1)
+        number = int(prefix[1:]) * NUMBER_OF_CHANNELS
+    if stem.startswith("CH"):
+        prefix, stem = stem.split("_", 1)
+        number += int(prefix[2:])
+    return number, datetime.strptime(stem, RUN_TIME_FORMAT)
+
+
+def estimate_conversion_factor(raw_volts, amps, default):
+    # Older runs used a different amperage range, so the factor is recovered
+    # from the pair of files instead of assumed
+    if amps is None or len(amps) != len(raw_volts):
+        return default
+    nonzero = raw_volts != 0
+    if not nonzero.any():
+        return default
+    return float(np.median(amps[nonzero] / raw_volts[nonzero]))
+
+
+def load_csv_column(path):
+    if not os.path.exists(path):
+        return None
+    return np.atleast_1d(np.loadtxt(path, delimiter=",", ndmin=1))
+
+
+def load_csv_run(
+    base_dir, stem, start=None, default_rate_hz=120, default_conversion_factor=5.0
+):
+    # (header, raw volts, times). start overrides the time in the stem, which
+    # some early channel 0 runs wrote day first
+    number = 0
+    if start is None:
+        number, start = parse_stem(stem)
+    raw_volts = load_csv_column(os.path.join(base_dir, "RAW_{}.csv".format(stem)))
+    amps = load_csv_column(os.path.join(base_dir, "{}.csv".format(stem)))
+    times = load_csv_column(os.path.join(base_dir, "NS_{}.csv".format(stem)))
+
+    extra = {"source": "csv"}
+    if raw_volts is None:
+        if amps is None:
+            raise ValueError("no RAW_ or amperage CSV")
+        # Amperages alone, undo the factor the run was logged with
+        raw_volts = amps / default_conversion_factor
+    if times is not None and len(times) == len(raw_volts):
+        times = times.astype(np.int64)
+    else:
+        # The earliest runs have no NS_ file, spread the samples evenly
+        start_ns = int(start.timestamp() * 1_000_000_000)
+        times = start_ns + np.arange(len(raw_volts), dtype=np.int64) * (
+            1_000_000_000 // default_rate_hz
+        )
+        extra["estimated_times"] = True
+
+    if len(times) > 1:
+        sample_rate_hz = 1_000_000_000 / float(np.median(np.diff(times)))
+    else:
+        sample_rate_hz = default_rate_hz
+
+    channel = Channel(
+        number % NUMBER_OF_CHANNELS,
+        "Dosing pump" if number == 0 else "Channel {}".format(number),
+        estimate_conversion_factor(raw_volts, amps, default_conversion_factor),
+        plate=number // NUMBER_OF_CHANNELS,
+    )
+    end_ns = times[-1] if len(times) else 0
+    header = build_header(
+        channel,
+        start,
+        times[0] if len(times) else 0,
+        end_ns,
+        sample_rate_hz,
+        len(raw_volts),
+        **extra,
+    )
+    return header, raw_volts, times
+
+
+def convert_csv_run(base_dir, stem, default_rate_hz=120, default_conversion_factor=5.0):
+    header, raw_volts, times = load_csv_run(
+        base_dir,
+        stem,
+        default_rate_hz=default_rate_hz,
+        default_conversion_factor=default_conversion_factor,
+    )
+    path = run_file_path(base_dir, stem)
+    write_run(path, header, raw_volts, times)
+    return path
+
+
+def convert_csv_archive(base_dir, delete=False):
+    converted = 0
+    for stem in csv_run_stems(base_dir):
+        if os.path.exists(run_file_path(base_dir, stem)):
+            continue
+        try:
+            convert_csv_run(base_dir, stem)
+        except ValueError as e:
+            print("Skipping {}: {}".format(stem, e))
+            continue
+        converted += 1
+        if delete:
+            for name in ("{}.csv", "RAW_{}.csv", "NS_{}.csv"):
+                path = os.path.join(base_dir, name.format(stem))
+                if os.path.exists(path):
+                    os.remove(path)
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert RAW_/NS_ CSV runs into binary run files"
+    )
+    parser.add_argument("base_dir", help="Directory holding the CSV run archive")
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="Remove the CSV files of each converted run",
+    )
+    args = parser.parse_args()
+    print("Converted {} run(s)".format(convert_csv_archive(args.base_dir, args.delete)))
@@ -0,0 +1,108 @@
+import math
+
+import numpy as np
+
+
+class RunningStats:
+    # Count, mean, variance, min and max that blocks are merged into with
+    # Welford/Chan updates, so nothing has to be kept or rescanned
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def add_block(self, values):
+        count = len(values)
+        if count == 0:
+            return
+        block_mean = float(np.mean(values, dtype=np.float64))
+        block_m2 = float(np.sum(np.square(values - block_mean, dtype=np.float64)))
+        total = self.count + count
+        delta = block_mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += block_m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / self.count
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std(),
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+class RunStats:
+    # Everything the run summary needs, updated while the run is in progress:
+    # amperage statistics, energy in amp-seconds and sample interval statistics
+    def __init__(self, conversion_factor, start_ns=0):
+        self.conversion_factor = conversion_factor
+        self.start_ns = start_ns
+        self.amps = RunningStats()
+        self.intervals = RunningStats()
+        self.amp_seconds = 0.0
+        self.last_amps = None
+        self.last_ns = None
+
+    def add(self, raw_voltage, tick_ns):
+        amps = raw_voltage * self.conversion_factor
+        if self.last_ns is not None:
+            interval = tick_ns - self.last_ns
+            self.intervals.add(interval)
+            self.amp_seconds += self.last_amps * interval / 1_000_000_000
+        self.amps.add(amps)
+        self.last_amps = amps
+        self.last_ns = tick_ns
+
+    def add_block(self, raw_voltages, times):
+        if len(times) == 0:
+            return
+        amps = raw_voltages * self.conversion_factor
+        if self.last_ns is not None:
+            # Carry on from the last sample of the previous block
+            amps_before = np.concatenate(([self.last_amps], amps[:-1]))
+            intervals = np.diff(times, prepend=self.last_ns)
+        else:
+            amps_before = amps[:-1]
+            intervals = np.diff(times)
+        self.intervals.add_block(intervals)
+        self.amp_seconds += float(np.dot(amps_before, intervals)) / 1_000_000_000
+        self.amps.add_block(amps)
+        self.last_amps = float(amps[-1])
+        self.last_ns = int(times[-1])
+
+    def seconds(self, now_ns=None):
+        if now_ns is None:
+            now_ns = self.last_ns if self.last_ns is not None else self.start_ns
+        return (now_ns - self.start_ns) / 1_000_000_000
+
+    def summary(self):
+        return {
+            "seconds": self.seconds(),
+            "amps": self.amps.summary(),
+            "amp_seconds": self.amp_seconds,
+            "interval_ns": self.intervals.summary(),
+        }
@@ -0,0 +1,51 @@
+# RUN_SUMMARIES keeps one row per run, keyed by its file time (the run
+# file's name without the extension), with what the log line for it says.
+# The DAQ adds a row after every run and backfill.py fills in older runs
+# without replacing the DAQ's own rows, so importing twice is harmless.
+
+RUN_SUMMARY_COLUMNS = (
+    "run_id",
+    "start",
+    "channel",
+    "name",
+    "seconds",
+    "samples",
+    "gallons_pumped",
+    "max_amperage",
+    "average_amperage",
+    "conversion_factor",
+    "interval_mean_ns",
+    "interval_std_ns",
+    "processing_ms",
+    "run_file",
+)
+
+
+def init_run_summary_table(connection):
+    with connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS RUN_SUMMARIES(run_id TEXT PRIMARY KEY, start DATETIME, channel INTEGER, name TEXT, seconds NUMERIC, samples INTEGER, gallons_pumped NUMERIC, max_amperage NUMERIC, average_amperage NUMERIC, conversion_factor NUMERIC, interval_mean_ns NUMERIC, interval_std_ns NUMERIC, processing_ms NUMERIC, run_file TEXT)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS RUN_SUMMARIES_start ON RUN_SUMMARIES(start)"
+        )
+
+
+def insert_run_summaries(cursor, summaries, replace=True):
+    # summaries are dicts keyed by RUN_SUMMARY_COLUMNS, missing ones are NULL
+    cursor.executemany(
+        "INSERT OR {} INTO RUN_SUMMARIES({}) VALUES({})".format(
+            "REPLACE" if replace else "IGNORE",
+            ", ".join(RUN_SUMMARY_COLUMNS),
+            ", ".join("?" * len(RUN_SUMMARY_COLUMNS)),
+        ),
+        (
+            tuple(summary.get(column) for column in RUN_SUMMARY_COLUMNS)
+            for summary in summaries
+        ),
+    )
+
+
+def insert_run_summary(connection, summary):
+    with connection:
+        insert_run_summaries(connection.cursor(), [summary])
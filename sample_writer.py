@@ -0,0 +1,197 @@
+import queue
+import threading
+import time
+from datetime import datetime
+from itertools import repeat
+
+import numpy as np
+from metrics import LatencyHistogram
+
+# The database and waveform modules are imported by the writer thread, so the
+# sampling loop can build SampleBlocks before either is loaded.
+
+
+class SampleBlock:
+    # recovered marks a run's samples from the journal after a crash, some of
+    # which the writer may have written before it
+    def __init__(self, channel, raw_voltages, sample_times, recovered=False):
+        self.channel = channel
+        self.raw_voltages = raw_voltages
+        self.sample_times = sample_times
+        self.recovered = recovered
+
+    def amperages(self):
+        return self.raw_voltages * self.channel.conversion_factor
+
+    def timestamps(self):
+        return [datetime.fromtimestamp(ns / 1_000_000_000) for ns in self.sample_times]
+
+    def rows(self):
+        amperages = self.amperages()
+        timestamps = self.timestamps()
+        return zip(
+            timestamps,
+            self.raw_voltages.tolist(),
+            amperages.tolist(),
+            repeat(self.channel.number),
+        )
+
+
+class SampleWriter:
+    # Owns its own connection and fills SEPTIC_data off the sampling thread.
+    # Blocks are buffered and written with executemany in one transaction once
+    # batch_rows samples are waiting or the oldest one is flush_seconds old.
+    def __init__(
+        self, db_path, batch_rows=4096, flush_seconds=5.0, queue_size=1024, log=print
+    ):
+        self.db_path = db_path
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.log = log
+        self.pending = []
+        self.pending_rows = 0
+        self.oldest_pending = 0
+        self.rows_written = 0
+        self.dropped_blocks = 0
+        # How long each flush takes, SD card stalls show up here
+        self.flush_latency = LatencyHistogram()
+        self.thread = threading.Thread(
+            target=self.write_samples, name="sample_writer", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def add(self, block):
+        # Never blocks the caller, a full queue means the SD card fell behind
+        try:
+            self.queue.put_nowait(block)
+        except queue.Full:
+            self.dropped_blocks += 1
+            return False
+        return True
+
+    def init_table(self, connection):
+        from waveform import init_septic_data_minmax_table
+
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS SEPTIC_data(timestamp DATETIME, raw_sensor_voltage NUMERIC, amperage NUMERIC)"
+            )
+            columns = [
+                row[1] for row in connection.execute("PRAGMA table_info(SEPTIC_data)")
+            ]
+            # The first databases named the voltage column raw_voltage
+            if "raw_voltage" in columns and "raw_sensor_voltage" not in columns:
+                connection.execute(
+                    "ALTER TABLE SEPTIC_data RENAME COLUMN raw_voltage TO raw_sensor_voltage"
+                )
+            if "channel" not in columns:
+                connection.execute(
+                    "ALTER TABLE SEPTIC_data ADD COLUMN channel INTEGER DEFAULT 0"
+                )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS SEPTIC_data_timestamp ON SEPTIC_data(timestamp)"
+            )
+        init_septic_data_minmax_table(connection)
+
+    def unwritten(self, cursor, block):
+        # The samples of a recovered block after the last one of its channel
+        # already in SEPTIC_data. The writer writes a run in order, so those
+        # before it were flushed before the crash, and are left out of the
+        # rows and the min/max buckets both. A timestamp index range lookup.
+        timestamps = block.timestamps()
+        written = cursor.execute(
+            "SELECT MAX(timestamp) FROM SEPTIC_data WHERE timestamp >= ? AND timestamp <= ? AND channel = ?",
+            (timestamps[0], timestamps[-1], block.channel.number),
+        ).fetchone()[0]
+        if written is None:
+            return block
+        written = datetime.fromisoformat(written)
+        unwritten = np.array([timestamp > written for timestamp in timestamps])
+        return SampleBlock(
+            block.channel,
+            block.raw_voltages[unwritten],
+            block.sample_times[unwritten],
+        )
+
+    def flush(self, connection):
+        from waveform import add_to_septic_data_minmax
+
+        if not self.pending:
+            return
+        flush_start = time.monotonic_ns()
+        rows = 0
+        with connection:
+            cursor = connection.cursor()
+            blocks = [
+                self.unwritten(cursor, block) if block.recovered else block
+                for block in self.pending
+            ]
+            blocks = [block for block in blocks if len(block.sample_times)]
+            for block in blocks:
+                cursor.executemany(
+                    "INSERT INTO SEPTIC_data(timestamp, raw_sensor_voltage, amperage, channel) VALUES(?, ?, ?, ?)",
+                    block.rows(),
+                )
+                rows += len(block.sample_times)
+            # Min/max buckets for browsing whole days, one pass per channel
+            for channel in {block.channel.number for block in blocks}:
+                channel_blocks = [
+                    block for block in blocks if block.channel.number == channel
+                ]
+                add_to_septic_data_minmax(
+                    cursor,
+                    channel,
+                    np.concatenate([block.sample_times for block in channel_blocks]),
+                    np.concatenate([block.amperages() for block in channel_blocks]),
+                )
+        self.flush_latency.record(time.monotonic_ns() - flush_start)
+        self.rows_written += rows
+        self.pending = []
+        self.pending_rows = 0
+
+    def write_samples(self):
+        from database import connect
+
+        connection = connect(self.db_path)
+        self.init_table(connection)
+        running = True
+        while running:
+            timeout = None
+            if self.pending:
+                timeout = max(
+                    self.oldest_pending + self.flush_seconds - time.monotonic(), 0
+                )
+            try:
+                block = self.queue.get(timeout=timeout)
+                if block is None:
+                    running = False
+                else:
+                    if not self.pending:
+                        self.oldest_pending = time.monotonic()
+                    self.pending.append(block)
+                    self.pending_rows += len(block.raw_voltages)
+            except queue.Empty:
+                pass
+
+            if (
+                not running
+                or self.pending_rows >= self.batch_rows
+                or (
+                    self.pending
+                    and time.monotonic() - self.oldest_pending >= self.flush_seconds
+                )
+            ):
+                try:
+                    self.flush(connection)
+                except Exception as e:
+                    self.log("Writing samples to SEPTIC_data failed: {}".format(e))
+                    self.pending = []
+                    self.pending_rows = 0
+        connection.close()
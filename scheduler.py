@@ -0,0 +1,64 @@
+import time
+
+
+class DeadlineScheduler:
+    # Ticks on an absolute grid (start + n * period) so timing errors never add
+    # up. Most of each interval is slept away, only the last spin_ns is spent
+    # busy waiting to hit the deadline precisely. The spin window widens when
+    # the OS oversleeps past a deadline and slowly narrows again after.
+    def __init__(self, period_ns, spin_ns=200_000):
+        self.period_ns = period_ns
+        self.base_spin_ns = spin_ns
+        self.min_spin_ns = min(spin_ns, period_ns)
+        self.max_spin_ns = period_ns // 2
+        self.spin_ns = self.min_spin_ns
+        self.next_deadline = 0
+        self.ticks = 0
+        self.overruns = 0
+        self.missed_deadlines = 0
+
+    def start(self):
+        self.next_deadline = time.monotonic_ns()
+        self.ticks = 0
+        self.overruns = 0
+        self.missed_deadlines = 0
+
+    def set_period(self, period_ns):
+        # The grid restarts from now, the next tick is period_ns away
+        self.period_ns = period_ns
+        self.min_spin_ns = min(self.base_spin_ns, period_ns)
+        self.max_spin_ns = period_ns // 2
+        self.spin_ns = min(max(self.spin_ns, self.min_spin_ns), self.max_spin_ns)
+        self.next_deadline = time.monotonic_ns()
+
+    def wait_for_next_tick(self):
+        self.next_deadline += self.period_ns
+        now = time.monotonic_ns()
+        late_ns = now - self.next_deadline
+
+        if late_ns >= 0:
+            # Overran the interval. If less than a whole period was lost the
+            # tick fires right away and the following waits are shorter, so
+            # the grid catches back up. Whole periods that went by are missed
+            # deadlines and are skipped instead of being sampled in a burst.
+            self.overruns += 1
+            missed = late_ns // self.period_ns
+            if missed > 0:
+                self.missed_deadlines += missed
+                self.next_deadline += missed * self.period_ns
+            self.ticks += 1
+            return self.next_deadline
+
+        sleep_ns = -late_ns - self.spin_ns
+        if sleep_ns > 0:
+            time.sleep(sleep_ns / 1_000_000_000)
+            spin_left_ns = self.next_deadline - time.monotonic_ns()
+            if spin_left_ns <= 0:
+                self.spin_ns = min(self.spin_ns * 2, self.max_spin_ns)
+            elif spin_left_ns > self.spin_ns // 2:
+                self.spin_ns = max(self.spin_ns - self.spin_ns // 16, self.min_spin_ns)
+        while time.monotonic_ns() < self.next_deadline:
+            continue
+
+        self.ticks += 1
+        return self.next_deadline
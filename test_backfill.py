@@ -0,0 +1,54 @@
+import json
+
+from backfill import parse_log_file
+from config import DEFAULT_CONFIG, pump_channel
+
+PUMP = pump_channel(DEFAULT_CONFIG)
+
+# One of each way the conversion factor has been logged, each followed by a
+# run: main.py's, the plain text per channel one and the JSON log's
+LOG_LINES = [
+    "Startup @ Sun Jan 31 20:59:58 2021. Current user is: pi",
+    "Amperage conversion factor is: 5.0",
+    "20210131-21:00:00: Dosing pump ran for 190.4 seconds with a max amperage of 21.5A and an average amperage of 11.2A",
+    "Startup @ Mon Feb  1 08:59:58 2021. Current user is: pi",
+    "Channel 0 (Dosing pump) amperage conversion factor is: 4.5, threshold is: 0.1V on, 0.05V off, debounced 0.05s on, 0.25s off",
+    "20210201-09:00:00: Dosing pump ran for 185.0 seconds, pumped 121.3 gallons with a max amperage of 21.0A, an average amperage of 11.1A",
+    json.dumps(
+        {
+            "time": "2021-02-02T08:59:58",
+            "level": "INFO",
+            "message": "Channel 0 (Dosing pump) amperage conversion factor is: 6.25, threshold is: 0.1V on, 0.05V off, debounced 0.05s on, 0.25s off",
+        }
+    ),
+    json.dumps(
+        {
+            "time": "2021-02-02T09:03:05",
+            "level": "INFO",
+            "message": "Dosing pump ran for 185.0 seconds",
+            "event": "run",
+            "run_id": "20210202-09:00:00",
+            "channel": 0,
+            "name": "Dosing pump",
+            "start": "2021-02-02T09:00:00",
+            "seconds": 185.0,
+            "samples": 22200,
+            "max_amps": 21.0,
+            "average_amps": 11.1,
+        }
+    ),
+]
+
+
+def test_conversion_factor_of_every_log_format(tmp_path):
+    path = tmp_path / "home_das.log"
+    path.write_text("\n".join(LOG_LINES) + "\n")
+    factors = {
+        summary["run_id"]: summary["conversion_factor"]
+        for summary in parse_log_file(str(path), PUMP)
+    }
+    assert factors == {
+        "20210131-21:00:00": 5.0,
+        "20210201-09:00:00": 4.5,
+        "20210202-09:00:00": 6.25,
+    }
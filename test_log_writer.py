@@ -0,0 +1,40 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+from log_writer import LogWriter
+
+WEEK = 7 * 24 * 60 * 60
+
+
+def write_first_record(path, age):
+    record = {
+        "time": (datetime.now() - age).isoformat(),
+        "level": "INFO",
+        "message": "Startup",
+    }
+    with open(path, "w") as log_file:
+        log_file.write(json.dumps(record) + "\n")
+
+
+def log_once(path):
+    writer = LogWriter(path, max_age_seconds=WEEK, console=False)
+    writer.start()
+    writer.log("Startup")
+    writer.stop()
+
+
+def test_age_is_kept_across_restarts(tmp_path):
+    path = str(tmp_path / "home_das.log")
+    write_first_record(path, timedelta(days=8))
+    log_once(path)
+    assert os.path.exists(path + ".1")
+
+
+def test_recent_log_is_not_rotated(tmp_path):
+    path = str(tmp_path / "home_das.log")
+    write_first_record(path, timedelta(days=1))
+    log_once(path)
+    assert not os.path.exists(path + ".1")
+    with open(path) as log_file:
+        assert len(log_file.readlines()) == 2
@@ -0,0 +1,44 @@
+import sqlite3
+
+import numpy as np
+
+from pump_health import MIN_BASELINE_RUNS, PumpHealth, health_features
+
+RATE_HZ = 120
+
+
+def pump_run(number, seconds=185.0):
+    # A run sampled at RATE_HZ, a ~50 ms inrush then the steady draw
+    times = np.arange(int(seconds * RATE_HZ), dtype=np.int64) * (
+        1_000_000_000 // RATE_HZ
+    )
+    amps = np.full(len(times), 11.2 + 0.01 * (number % 3))
+    amps[3:9] = 21.5 + 0.1 * (number % 5)
+    return amps, times, seconds
+
+
+def score_runs(health, sample_rates):
+    for number in range(MIN_BASELINE_RUNS + 1):
+        amps, times, seconds = pump_run(number)
+        z, score, anomalous = health.score(
+            "run{}".format(number),
+            "2021-02-{:02d} 09:00:00".format(number + 1),
+            0,
+            health_features(amps, times, seconds, sample_rates),
+        )
+    return z, score
+
+
+def test_full_rate_run_scores_its_inrush():
+    health = PumpHealth(sqlite3.connect(":memory:"))
+    z, score = score_runs(health, [(0.0, RATE_HZ)])
+    assert score is not None
+    assert np.isfinite(z[0])
+
+
+def test_idle_rate_run_leaves_out_its_inrush():
+    health = PumpHealth(sqlite3.connect(":memory:"))
+    z, score = score_runs(health, [(0.0, 5), (0.2, RATE_HZ)])
+    assert score is not None
+    assert np.isnan(z[0])
+    assert np.isfinite(z[1:]).all()
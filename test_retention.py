@@ -0,0 +1,29 @@
+from database import connect
+from retention import VACUUM_PAGES, RetentionEngine
+
+
+def free_pages(connection):
+    return connection.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def test_vacuum_step_frees_vacuum_pages(tmp_path):
+    db_path = str(tmp_path / "home_das_db.db")
+    connection = connect(db_path)
+    connection.execute("CREATE TABLE SEPTIC_data(timestamp DATETIME, value BLOB)")
+    with connection:
+        connection.executemany(
+            "INSERT INTO SEPTIC_data VALUES(?, ?)",
+            ((row, bytes(1000)) for row in range(16 * VACUUM_PAGES)),
+        )
+    with connection:
+        connection.execute("DELETE FROM SEPTIC_data")
+    engine = RetentionEngine(db_path, str(tmp_path), lambda message, **fields: None)
+
+    before = free_pages(connection)
+    assert before > 2 * VACUUM_PAGES
+    engine.vacuum_step(connection)
+    assert before - free_pages(connection) == VACUUM_PAGES
+
+    engine.vacuum(connection)
+    assert free_pages(connection) == 0
+    connection.close()
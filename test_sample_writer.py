@@ -0,0 +1,46 @@
+import numpy as np
+
+from config import DEFAULT_CONFIG, pump_channel
+from database import connect
+from sample_writer import SampleBlock, SampleWriter
+
+PUMP = pump_channel(DEFAULT_CONFIG)
+START_NS = 1_612_170_000_000_000_000
+INTERVAL_NS = 1_000_000_000 // 120
+
+
+def write(writer, connection, *blocks):
+    writer.pending = list(blocks)
+    writer.flush(connection)
+
+
+def test_recovered_run_fills_in_what_was_not_written(tmp_path):
+    db_path = str(tmp_path / "home_das_db.db")
+    connection = connect(db_path)
+    writer = SampleWriter(db_path)
+    writer.init_table(connection)
+    sample_times = START_NS + np.arange(1000, dtype=np.int64) * INTERVAL_NS
+    raw_voltages = np.linspace(1.0, 3.0, 1000, dtype=np.float32)
+
+    # The first 400 samples were flushed before the crash
+    write(writer, connection, SampleBlock(PUMP, raw_voltages[:400], sample_times[:400]))
+    write(
+        writer,
+        connection,
+        SampleBlock(PUMP, raw_voltages, sample_times, recovered=True),
+    )
+
+    timestamps = [
+        row[0]
+        for row in connection.execute("SELECT timestamp FROM SEPTIC_data ORDER BY 1")
+    ]
+    assert len(timestamps) == 1000
+    assert len(set(timestamps)) == 1000
+    assert writer.rows_written == 1000
+    assert (
+        connection.execute(
+            "SELECT SUM(samples) FROM SEPTIC_DATA_MINMAX WHERE seconds = 1"
+        ).fetchone()[0]
+        == 1000
+    )
+    connection.close()
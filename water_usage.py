@@ -0,0 +1,190 @@
+import argparse
+import sqlite3 as db
+from datetime import date, datetime, timedelta
+
+# WATER_USAGE_DATA keeps one row per pump run. The rollup tables below are
+# updated in the same transaction as each insert, so totals, daily and weekly
+# usage never need a scan of the raw rows. Weeks start on Monday.
+
+ROLLUP_TABLES = ("WATER_USAGE_TOTALS", "WATER_USAGE_DAILY", "WATER_USAGE_WEEKLY")
+
+# Modifiers that turn a timestamp into its rollup key
+DAY_SQL = "date({})"
+WEEK_SQL = "date({}, 'weekday 0', '-6 days')"
+
+
+def init_water_usage_tables(connection):
+    with connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS WATER_USAGE_DATA(timestamp DATETIME, gallons_pumped NUMERIC)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS WATER_USAGE_DATA_timestamp ON WATER_USAGE_DATA(timestamp)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS WATER_USAGE_TOTALS(id INTEGER PRIMARY KEY CHECK (id = 0), gallons_pumped NUMERIC, runs INTEGER, first_run DATETIME, last_run DATETIME)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS WATER_USAGE_DAILY(day DATE PRIMARY KEY, gallons_pumped NUMERIC, runs INTEGER)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS WATER_USAGE_WEEKLY(week_start DATE PRIMARY KEY, gallons_pumped NUMERIC, runs INTEGER)"
+        )
+
+    # Databases from before the rollups existed get them filled in once
+    has_totals = connection.execute(
+        "SELECT COUNT(*) FROM WATER_USAGE_TOTALS"
+    ).fetchone()[0]
+    if not has_totals:
+        rebuild_rollups(connection)
+
+
+def add_to_rollups(cursor, timestamp, gallons_pumped, runs=1):
+    cursor.execute(
+        "INSERT OR IGNORE INTO WATER_USAGE_TOTALS(id, gallons_pumped, runs, first_run, last_run) VALUES(0, 0, 0, ?, ?)",
+        (timestamp, timestamp),
+    )
+    cursor.execute(
+        "UPDATE WATER_USAGE_TOTALS SET gallons_pumped = gallons_pumped + ?, runs = runs + ?, first_run = MIN(first_run, ?), last_run = MAX(last_run, ?) WHERE id = 0",
+        (gallons_pumped, runs, timestamp, timestamp),
+    )
+    for table, key, key_sql in (
+        ("WATER_USAGE_DAILY", "day", DAY_SQL),
+        ("WATER_USAGE_WEEKLY", "week_start", WEEK_SQL),
+    ):
+        cursor.execute(
+            "INSERT OR IGNORE INTO {0}({1}, gallons_pumped, runs) VALUES({2}, 0, 0)".format(
+                table, key, key_sql.format("?")
+            ),
+            (timestamp,),
+        )
+        cursor.execute(
+            "UPDATE {0} SET gallons_pumped = gallons_pumped + ?, runs = runs + ? WHERE {1} = {2}".format(
+                table, key, key_sql.format("?")
+            ),
+            (gallons_pumped, runs, timestamp),
+        )
+
+
+def insert_water_usage(connection, timestamp, gallons_pumped):
+    # False if a run starting at timestamp is already recorded, e.g. one
+    # processed again from the journal after a crash. The rollups only count
+    # runs that were inserted.
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            "INSERT INTO WATER_USAGE_DATA(timestamp, gallons_pumped) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM WATER_USAGE_DATA WHERE timestamp = ?)",
+            (timestamp, gallons_pumped, timestamp),
+        )
+        if cursor.rowcount == 0:
+            return False
+        add_to_rollups(cursor, timestamp, gallons_pumped)
+    return True
+
+
+def rebuild_rollups(connection):
+    with connection:
+        for table in ROLLUP_TABLES:
+            connection.execute("DELETE FROM {}".format(table))
+        connection.execute(
+            "INSERT INTO WATER_USAGE_TOTALS(id, gallons_pumped, runs, first_run, last_run) SELECT 0, SUM(gallons_pumped), COUNT(*), MIN(timestamp), MAX(timestamp) FROM WATER_USAGE_DATA HAVING COUNT(*) > 0"
+        )
+        connection.execute(
+            "INSERT INTO WATER_USAGE_DAILY(day, gallons_pumped, runs) SELECT {0}, SUM(gallons_pumped), COUNT(*) FROM WATER_USAGE_DATA GROUP BY {0}".format(
+                DAY_SQL.format("timestamp")
+            )
+        )
+        connection.execute(
+            "INSERT INTO WATER_USAGE_WEEKLY(week_start, gallons_pumped, runs) SELECT {0}, SUM(gallons_pumped), COUNT(*) FROM WATER_USAGE_DATA GROUP BY {0}".format(
+                WEEK_SQL.format("timestamp")
+            )
+        )
+
+
+def total_water_usage(connection):
+    # (gallons, runs), a single row lookup
+    row = connection.execute(
+        "SELECT gallons_pumped, runs FROM WATER_USAGE_TOTALS WHERE id = 0"
+    ).fetchone()
+    if row is None:
+        return 0.0, 0
+    return row[0], row[1]
+
+
+def daily_water_usage(connection, start_day, end_day):
+    # [(day, gallons, runs)] for start_day <= day < end_day, a primary key range
+    return connection.execute(
+        "SELECT day, gallons_pumped, runs FROM WATER_USAGE_DAILY WHERE day >= ? AND day < ? ORDER BY day",
+        (start_day.isoformat(), end_day.isoformat()),
+    ).fetchall()
+
+
+def first_water_usage_day(connection):
+    # The earliest day with a run, or None, the first primary key
+    row = connection.execute("SELECT MIN(day) FROM WATER_USAGE_DAILY").fetchone()
+    if row[0] is None:
+        return None
+    return date.fromisoformat(row[0])
+
+
+def weekly_water_usage(connection, start_day, end_day):
+    return connection.execute(
+        "SELECT week_start, gallons_pumped, runs FROM WATER_USAGE_WEEKLY WHERE week_start >= ? AND week_start < ? ORDER BY week_start",
+        (start_day.isoformat(), end_day.isoformat()),
+    ).fetchall()
+
+
+def water_usage_between(connection, start_day, end_day):
+    # (gallons, runs) for whole days, e.g. a pay period
+    row = connection.execute(
+        "SELECT COALESCE(SUM(gallons_pumped), 0), COALESCE(SUM(runs), 0) FROM WATER_USAGE_DAILY WHERE day >= ? AND day < ?",
+        (start_day.isoformat(), end_day.isoformat()),
+    ).fetchone()
+    return row[0], row[1]
+
+
+def weekday_water_usage(connection):
+    # [(weekday, gallons, runs)] with 0 for Sunday, like strftime('%w')
+    return connection.execute(
+        "SELECT CAST(strftime('%w', day) AS INTEGER) AS weekday, SUM(gallons_pumped), SUM(runs) FROM WATER_USAGE_DAILY GROUP BY weekday ORDER BY weekday"
+    ).fetchall()
+
+
+def recent_runs(connection, limit, offset=0):
+    # Newest first, served by the timestamp index
+    return connection.execute(
+        "SELECT timestamp, gallons_pumped FROM WATER_USAGE_DATA ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+        (limit, offset),
+    ).fetchall()
+
+
+def runs_between(connection, start, end):
+    # Raw runs in [start, end), served by the timestamp index
+    return connection.execute(
+        "SELECT timestamp, gallons_pumped FROM WATER_USAGE_DATA WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+        (start, end),
+    ).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Water usage rollup maintenance")
+    parser.add_argument("db_file", help="Path to home_das_db.db")
+    parser.add_argument(
+        "command", choices=["rebuild", "summary"], help="What to do with the rollups"
+    )
+    args = parser.parse_args()
+
+    connection = db.connect(
+        args.db_file, detect_types=db.PARSE_DECLTYPES | db.PARSE_COLNAMES
+    )
+    init_water_usage_tables(connection)
+    if args.command == "rebuild":
+        rebuild_rollups(connection)
+    gallons, runs = total_water_usage(connection)
+    print("Total: {:.2f} gallons over {} runs".format(gallons or 0.0, runs))
+    today = datetime.now().date()
+    gallons, runs = water_usage_between(
+        connection, today - timedelta(days=6), today + timedelta(days=1)
+    )
+    print("Last 7 days: {:.2f} gallons over {} runs".format(gallons, runs))
+    connection.close()
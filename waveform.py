@@ -0,0 +1,321 @@
+import argparse
+import os
+import sqlite3 as db
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from run_file import RUN_FILE_EXTENSION, read_amps, read_header
+
+# Min/max pyramids so plots and viewers only ever load about as many points
+# as the screen is wide.
+#
+# Every run file gets a <file_time>.pyramid.npz next to it when it is saved.
+# Level n keeps the min and max raw volts of each bucket of
+# PYRAMID_FIRST_BUCKET * PYRAMID_FACTOR**n samples and the time of the
+# bucket's first sample, built from the level below it. Levels stop once
+# they are down to PYRAMID_MIN_BUCKETS buckets.
+#
+# SEPTIC_data gets the same idea as SEPTIC_DATA_MINMAX, min and max amperage
+# per channel over buckets of SEPTIC_DATA_MINMAX_SECONDS, plus the sum and
+# count of the amperages for the mean. The sample writer updates it with
+# every batch it writes, and it outlives the raw rows (retention.py). Bucket
+# starts are seconds since 1970 in local time, like the SEPTIC_data
+# timestamps, so a day is a plain range.
+
+PYRAMID_EXTENSION = ".pyramid.npz"
+PYRAMID_FIRST_BUCKET = 8
+PYRAMID_FACTOR = 4
+PYRAMID_MIN_BUCKETS = 256
+SEPTIC_DATA_MINMAX_SECONDS = (1, 10, 60, 600)
+
+
+def decimate_min_max(values, max_points, times=None):
+    # Keeps the min and max of each bucket so spikes survive the decimation
+    values = np.asarray(values)
+    if times is None:
+        times = np.arange(len(values))
+    buckets = max_points // 2
+    if len(values) <= max_points or buckets == 0:
+        return np.asarray(times), values
+
+    usable = len(values) // buckets * buckets
+    bucketed = values[:usable].reshape(buckets, -1)
+    bucket_times = np.asarray(times[:usable]).reshape(buckets, -1)
+    rows = np.arange(buckets)
+    min_index = bucketed.argmin(axis=1)
+    max_index = bucketed.argmax(axis=1)
+    first = np.minimum(min_index, max_index)
+    second = np.maximum(min_index, max_index)
+
+    decimated_values = np.empty(buckets * 2, dtype=values.dtype)
+    decimated_values[0::2] = bucketed[rows, first]
+    decimated_values[1::2] = bucketed[rows, second]
+    decimated_times = np.empty(buckets * 2, dtype=bucket_times.dtype)
+    decimated_times[0::2] = bucket_times[rows, first]
+    decimated_times[1::2] = bucket_times[rows, second]
+    return decimated_times, decimated_values
+
+
+def pyramid_path(run_path):
+    return run_path[: -len(RUN_FILE_EXTENSION)] + PYRAMID_EXTENSION
+
+
+def bucket_starts(length, bucket_rows):
+    return np.arange(0, length, bucket_rows)
+
+
+def build_pyramid(raw_volts, times):
+    # [(bucket_rows, mins, maxs, times)], coarsest level last
+    levels = []
+    bucket_rows = PYRAMID_FIRST_BUCKET
+    mins, maxs, level_times, step = raw_volts, raw_volts, times, bucket_rows
+    while len(mins) > PYRAMID_MIN_BUCKETS:
+        starts = bucket_starts(len(mins), step)
+        mins = np.minimum.reduceat(mins, starts)
+        maxs = np.maximum.reduceat(maxs, starts)
+        level_times = level_times[starts]
+        levels.append((bucket_rows, mins, maxs, level_times))
+        bucket_rows *= PYRAMID_FACTOR
+        step = PYRAMID_FACTOR
+    return levels
+
+
+def write_pyramid(path, levels):
+    arrays = {"bucket_rows": np.array([level[0] for level in levels], np.int64)}
+    for number, (bucket_rows, mins, maxs, times) in enumerate(levels):
+        arrays["min_{}".format(number)] = mins
+        arrays["max_{}".format(number)] = maxs
+        arrays["times_{}".format(number)] = times
+    with open("{}.tmp".format(path), "wb") as pyramid_file:
+        np.savez(pyramid_file, **arrays)
+    os.replace("{}.tmp".format(path), path)
+
+
+def write_run_pyramid(run_path, raw_volts, times):
+    path = pyramid_path(run_path)
+    write_pyramid(path, build_pyramid(raw_volts, times))
+    return path
+
+
+def min_max_points(rows, times, mins, maxs):
+    # Each bucket becomes two points at the same spot, its min then its max
+    return (
+        np.repeat(rows, 2),
+        np.repeat(times, 2),
+        np.column_stack((mins, maxs)).ravel(),
+    )
+
+
+def run_waveform(run_path, max_points):
+    # (header, sample numbers, times, amps) with at most about max_points
+    # points, from the finest pyramid level that fits
+    header = read_header(run_path)
+    samples = header["samples"]
+    path = pyramid_path(run_path)
+    if samples > max_points and os.path.exists(path):
+        with np.load(path) as pyramid:
+            for number, bucket_rows in enumerate(pyramid["bucket_rows"]):
+                if 2 * -(-samples // bucket_rows) > max_points:
+                    continue
+                mins = pyramid["min_{}".format(number)]
+                rows, times, raw_volts = min_max_points(
+                    bucket_starts(samples, bucket_rows),
+                    pyramid["times_{}".format(number)],
+                    mins,
+                    pyramid["max_{}".format(number)],
+                )
+                return header, rows, times, raw_volts * header["conversion_factor"]
+
+    # Short runs, or runs saved before pyramids existed
+    header, amps, times = read_amps(run_path)
+    rows, decimated = decimate_min_max(amps, max_points)
+    return header, rows, np.asarray(times)[rows], decimated
+
+
+# SEPTIC_data
+
+
+def init_septic_data_minmax_table(connection):
+    with connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS SEPTIC_DATA_MINMAX(seconds INTEGER, channel INTEGER, start_s INTEGER, min_amperage NUMERIC, max_amperage NUMERIC, sum_amperage NUMERIC, samples INTEGER, PRIMARY KEY(seconds, channel, start_s))"
+        )
+        columns = [
+            row[1]
+            for row in connection.execute("PRAGMA table_info(SEPTIC_DATA_MINMAX)")
+        ]
+        # Buckets from before the means were kept have no sum until they are
+        # rebuilt, or rolled up again before their raw rows expire
+        if "sum_amperage" not in columns:
+            connection.execute(
+                "ALTER TABLE SEPTIC_DATA_MINMAX ADD COLUMN sum_amperage NUMERIC"
+            )
+            connection.execute(
+                "ALTER TABLE SEPTIC_DATA_MINMAX ADD COLUMN samples INTEGER"
+            )
+
+
+def local_seconds(sample_times):
+    # Local time seconds, bucketed the same way as the SEPTIC_data timestamps
+    offset = time.localtime(sample_times[0] / 1_000_000_000).tm_gmtoff
+    return sample_times // 1_000_000_000 + offset
+
+
+def add_to_septic_data_minmax(cursor, channel, sample_times, amperages):
+    # sample_times in order, from one channel
+    if len(sample_times) == 0:
+        return
+    seconds = local_seconds(np.asarray(sample_times))
+    for width in SEPTIC_DATA_MINMAX_SECONDS:
+        buckets = seconds // width
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        for start_s, min_amps, max_amps, sum_amps, samples in zip(
+            (buckets[starts] * width).tolist(),
+            np.minimum.reduceat(amperages, starts).tolist(),
+            np.maximum.reduceat(amperages, starts).tolist(),
+            np.add.reduceat(amperages, starts, dtype=float).tolist(),
+            np.diff(np.append(starts, len(buckets))).tolist(),
+        ):
+            cursor.execute(
+                "INSERT OR IGNORE INTO SEPTIC_DATA_MINMAX(seconds, channel, start_s, min_amperage, max_amperage, sum_amperage, samples) VALUES(?, ?, ?, ?, ?, 0, 0)",
+                (width, channel, start_s, min_amps, max_amps),
+            )
+            cursor.execute(
+                "UPDATE SEPTIC_DATA_MINMAX SET min_amperage = MIN(min_amperage, ?), max_amperage = MAX(max_amperage, ?), sum_amperage = sum_amperage + ?, samples = samples + ? WHERE seconds = ? AND channel = ? AND start_s = ?",
+                (min_amps, max_amps, sum_amps, samples, width, channel, start_s),
+            )
+
+
+def rebuild_septic_data_minmax(connection, start=None, end=None):
+    # Rebuilds the buckets of the days from start up to end from the raw rows.
+    # By default from the first day SEPTIC_data still has through today, the
+    # buckets before it are all that is left of expired samples.
+    if start is None:
+        first = connection.execute("SELECT MIN(timestamp) FROM SEPTIC_data")
+        first = first.fetchone()[0]
+        if first is None:
+            return
+        start = datetime.fromisoformat(str(first)).date()
+    if end is None:
+        end = date.today() + timedelta(days=1)
+    first_s, end_s = day_seconds(start), day_seconds(end)
+    start = datetime.combine(start, datetime.min.time())
+    end = datetime.combine(end, datetime.min.time())
+    with connection:
+        connection.execute(
+            "DELETE FROM SEPTIC_DATA_MINMAX WHERE start_s >= ? AND start_s < ?",
+            (first_s, end_s),
+        )
+        for width in SEPTIC_DATA_MINMAX_SECONDS:
+            connection.execute(
+                "INSERT INTO SEPTIC_DATA_MINMAX(seconds, channel, start_s, min_amperage, max_amperage, sum_amperage, samples) SELECT ?, channel, CAST(strftime('%s', timestamp) AS INTEGER) / ? * ? AS start_s, MIN(amperage), MAX(amperage), SUM(amperage), COUNT(*) FROM SEPTIC_data WHERE timestamp >= ? AND timestamp < ? GROUP BY channel, start_s",
+                (width, width, width, start, end),
+            )
+
+
+def day_seconds(day):
+    return int(
+        (
+            datetime.combine(day, datetime.min.time()) - datetime(1970, 1, 1)
+        ).total_seconds()
+    )
+
+
+def day_waveform(connection, day, channel=0, max_points=2000):
+    # (bucket seconds, local datetimes, amps) for one day of SEPTIC_data,
+    # raw rows when they fit, otherwise the finest min/max level that does
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    rows = connection.execute(
+        "SELECT COUNT(*) FROM SEPTIC_data WHERE timestamp >= ? AND timestamp < ? AND channel = ?",
+        (start, end, channel),
+    ).fetchone()[0]
+    if rows <= max_points:
+        samples = connection.execute(
+            "SELECT timestamp, amperage FROM SEPTIC_data WHERE timestamp >= ? AND timestamp < ? AND channel = ? ORDER BY timestamp",
+            (start, end, channel),
+        ).fetchall()
+        return (
+            0,
+            np.array([np.datetime64(row[0]) for row in samples]),
+            np.array([row[1] for row in samples], dtype=float),
+        )
+
+    first_s = day_seconds(day)
+    for width in SEPTIC_DATA_MINMAX_SECONDS:
+        buckets = connection.execute(
+            "SELECT COUNT(*) FROM SEPTIC_DATA_MINMAX WHERE seconds = ? AND channel = ? AND start_s >= ? AND start_s < ?",
+            (width, channel, first_s, first_s + 86400),
+        ).fetchone()[0]
+        if 2 * buckets <= max_points or width == SEPTIC_DATA_MINMAX_SECONDS[-1]:
+            break
+    minmax = np.array(
+        connection.execute(
+            "SELECT start_s, min_amperage, max_amperage FROM SEPTIC_DATA_MINMAX WHERE seconds = ? AND channel = ? AND start_s >= ? AND start_s < ? ORDER BY start_s",
+            (width, channel, first_s, first_s + 86400),
+        ).fetchall(),
+        dtype=float,
+    ).reshape(-1, 3)
+    times = np.datetime64("1970-01-01") + minmax[:, 0].astype(np.int64).astype(
+        "timedelta64[s]"
+    )
+    return (
+        width,
+        np.repeat(times, 2),
+        np.column_stack((minmax[:, 1], minmax[:, 2])).ravel(),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Min/max pyramids for runs and days")
+    commands = parser.add_subparsers(dest="command")
+    build = commands.add_parser("build", help="Build pyramids for saved runs")
+    build.add_argument("run_files", nargs="+")
+    rebuild = commands.add_parser("rebuild", help="Rebuild SEPTIC_DATA_MINMAX")
+    rebuild.add_argument("db_file")
+    day_plot = commands.add_parser("day", help="Plot a day of SEPTIC_data")
+    day_plot.add_argument("db_file")
+    day_plot.add_argument("day", help="YYYY-MM-DD")
+    day_plot.add_argument("--channel", type=int, default=0)
+    day_plot.add_argument("--max-points", type=int, default=2000)
+    day_plot.add_argument("--output", help="Save to this PNG instead of showing it")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from run_file import read_run
+
+        for run_path in args.run_files:
+            header, raw_volts, times = read_run(run_path)
+            print(write_run_pyramid(run_path, raw_volts, times))
+    elif args.command == "rebuild":
+        connection = db.connect(args.db_file)
+        init_septic_data_minmax_table(connection)
+        rebuild_septic_data_minmax(connection)
+        connection.close()
+    elif args.command == "day":
+        day = date.fromisoformat(args.day)
+        connection = db.connect(args.db_file)
+        width, times, amps = day_waveform(
+            connection, day, args.channel, args.max_points
+        )
+        connection.close()
+        if args.output:
+            from plotting import pyplot
+
+            plt = pyplot()
+        else:
+            import matplotlib.pyplot as plt
+        plt.plot(times, amps)
+        plt.ylabel("Amps")
+        plt.title(
+            "Channel {} - {} ({})".format(
+                args.channel, day, "{}s buckets".format(width) if width else "raw"
+            )
+        )
+        if args.output:
+            plt.savefig(args.output)
+        else:
+            plt.show()
+    else:
+        parser.print_help()